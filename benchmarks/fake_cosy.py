@@ -0,0 +1,130 @@
+"""A stand-in for the `cosy` executable for benchmarking the Python side.
+
+It reads the voltages and the output file from a rendered FOX script, waits as long as
+a COSY run is supposed to take and writes what the script would have written,
+
+    Write 11 S(obj);        a synthetic objective of the voltages
+    Write 11 S(MA(1,1))...  one value per element, separated like in the script
+    Write 11 S(objVector(1))...
+                            one synthetic objective per value, with different minima
+    PA 11                   a small third order map in the layout PA prints
+
+Every Write takes the voltages assigned before it, so a script that assigns and writes
+several lens tables, like the batches of `SpeemOptimizer.batch_objective`, gets a line
+for each.
+
+Relative output files are written to the working directory like COSY does. The
+environment variables FAKE_COSY_TIME (seconds per run, default 0.05) and
+FAKE_COSY_FAILURE_RATE (fraction of runs that write nothing, default 0) control it.
+"""
+
+import os, re, sys, time, random, itertools
+
+OPEN_PATTERN = re.compile(r"OpenF\s+11\s+'([^']+)'", re.IGNORECASE)
+ASSIGNMENT_PATTERN = re.compile(r"^\s*(baseline|V\d\d)\s*:=\s*([^;]+);", re.IGNORECASE)
+
+PA_ORDER = 3
+N_COORDINATES = 6
+
+
+def parse_script(
+    lines: list[str],
+) -> tuple[str | None, list[tuple[dict[str, float], str, int]], bool]:
+    """
+    The output file, the voltages at every Write with its expression and how many
+    Writes came before it since the last assignment, and whether the map is printed.
+    """
+    output_file = None
+    voltages = {}
+    writes = []
+    index = 0
+    prints_map = False
+    for line in lines:
+        if (match := OPEN_PATTERN.search(line)) is not None:
+            output_file = match.group(1)
+        elif (match := ASSIGNMENT_PATTERN.match(line)) is not None:
+            index = 0
+            try:
+                voltages[match.group(1)] = float(match.group(2))
+            except ValueError:
+                # assigned from another variable, e.g. V02:=V00
+                pass
+        elif line.strip().startswith(("Write 11", "PA 11")):
+            writes.append((dict(voltages), line, index))
+            index += 1
+            prints_map = prints_map or line.strip().startswith("PA 11")
+    return output_file, writes, prints_map
+
+
+def synthetic_objective(voltages: dict[str, float], shift: float = 0) -> float:
+    """A smooth bowl with its minimum at a different voltage for every electrode."""
+    return sum(
+        (voltage / 100 - 1 - 0.1 * i - shift) ** 2
+        for i, (_, voltage) in enumerate(sorted(voltages.items()))
+    )
+
+
+def map_lines(voltages: dict[str, float]) -> list[str]:
+    scale = 1 + synthetic_objective(voltages)
+    lines = []
+    for order in range(1, PA_ORDER + 1):
+        for exponents in itertools.product(range(order + 1), repeat=N_COORDINATES):
+            if sum(exponents) != order or exponents[4] or exponents[5]:
+                continue
+            coefficients = [
+                scale
+                * (j + 1)
+                / (order + sum(e * (k + 1) for k, e in enumerate(exponents)))
+                for j in range(5)
+            ]
+            lines.append(
+                " "
+                + "".join(f"{c:14.6E}" for c in coefficients)
+                + " "
+                + "".join(str(e) for e in exponents)
+                + "\n"
+            )
+    lines.append("     ------------------------------------------------\n")
+    return lines
+
+
+def write_line(voltages: dict[str, float], expression: str, index: int) -> str:
+    """The values of a Write, the `index`th one since the voltages were assigned."""
+    objective = synthetic_objective(voltages)
+    n_values = expression.count("S(")
+    if "S(MA(" not in expression:
+        return (
+            " ".join(
+                f"{synthetic_objective(voltages, 0.5 * j):.15E}"
+                for j in range(n_values)
+            )
+            + "\n"
+        )
+    separator = "," if "','" in expression else " "
+    return (
+        separator.join(
+            f"{objective * (index + 1) * (j + 1):.15E}" for j in range(n_values)
+        )
+        + "\n"
+    )
+
+
+def main() -> None:
+    with open(sys.argv[1], "rt") as f:
+        output_file, writes, prints_map = parse_script(f.readlines())
+
+    time.sleep(float(os.environ.get("FAKE_COSY_TIME", 0.05)))
+    if output_file is None:
+        return
+    if random.random() < float(os.environ.get("FAKE_COSY_FAILURE_RATE", 0)):
+        return
+
+    with open(output_file, "wt") as f:
+        if prints_map:
+            f.writelines(map_lines(writes[-1][0] if writes else {}))
+            return
+        f.writelines(write_line(*write) for write in writes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""Benchmarks of everything around the COSY runs, against fake_cosy.py.
+
+COSY itself is replaced by fake_cosy.py, which takes a fixed time per run, so the
+numbers measure the Python orchestration: template rendering, file handling, process
+spawning, the pools and parsing. Every benchmark writes rows with the same columns,
+
+    benchmark   case   n   seconds   rate [1/s]   overhead [ms]
+
+where `rate` is evaluations (or calls) per second and `overhead` the time per evaluation
+not spent in the fake COSY run. The rows are printed as a fixed width table and with
+--json also written to a file, which --compare takes to print the change of every rate.
+
+```
+python benchmarks/run_benchmarks.py --json baseline.json
+python benchmarks/run_benchmarks.py --compare baseline.json
+```
+"""
+
+import os, sys, json, time, random, argparse, platform
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import matplotlib
+
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+
+from cosy.constants import Electrode
+from cosy.data_gen import DataGenerator
+from cosy.objective import StandardObjectiveFunction
+from cosy.optimizer import SpeemOptimizer
+from cosy.plots import conversion_map, plot_rays
+from cosy.profiling import read_trace, summarize, STAGES
+from cosy.raytrace import write_rays
+
+REPORT_VERSION = 1
+FAKE_COSY = Path(__file__).parent.absolute() / "fake_cosy.py"
+
+LENS_LIMITS = {
+    Electrode.V00: [0, 600],
+    Electrode.V01: [0, 600],
+    Electrode.V11: [0, 600],
+    Electrode.V12: [0, 600],
+    Electrode.V13: [0, 600],
+}
+COLUMNS = ("benchmark", "case", "n", "seconds", "rate", "overhead_ms")
+
+
+@contextmanager
+def quiet():
+    """Silence stdout, including that of child processes."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, "wb") as devnull:
+        os.dup2(devnull.fileno(), 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def install_fake_cosy(bin_dir: Path, cosy_time: float) -> None:
+    """Put a `cosy` that runs fake_cosy.py first on the PATH."""
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    launcher = bin_dir / "cosy"
+    launcher.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_COSY}" "$@"\n')
+    launcher.chmod(0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ["FAKE_COSY_TIME"] = str(cosy_time)
+
+
+def row(benchmark: str, case: str, n: int, seconds: float, overhead: float = None):
+    return {
+        "benchmark": benchmark,
+        "case": case,
+        "n": n,
+        "seconds": seconds,
+        "rate": n / seconds if seconds else 0.0,
+        "overhead_ms": None if overhead is None else 1000 * overhead,
+    }
+
+
+def make_optimizer(fox_dir: Path, trace_file: Path) -> SpeemOptimizer:
+    optimizer = SpeemOptimizer(
+        objectives=[StandardObjectiveFunction.CLEAR_APERTURE_0],
+        lens_limits=LENS_LIMITS,
+        fox_dir=fox_dir,
+        trace_file=trace_file,
+    )
+    optimizer.record = []
+    optimizer.record_file = fox_dir / "optimization_record.json"
+    return optimizer
+
+
+def random_table() -> np.ndarray:
+    return np.array([random.uniform(*limits) for limits in LENS_LIMITS.values()])
+
+
+def bench_objective(optimizer: SpeemOptimizer, n: int) -> tuple[list, dict]:
+    since = time.time()
+    start = time.perf_counter()
+    for _ in range(n):
+        optimizer.objective(random_table())
+    seconds = time.perf_counter() - start
+
+    summary = summarize(read_trace(optimizer.profiler.trace_file, since=since))
+    overhead = (seconds - summary["stages"]["compute"]["total"]) / n
+    return [row("objective", "serial", n, seconds, overhead)], summary
+
+
+def bench_batch_objective(
+    optimizer: SpeemOptimizer, processes: list[int], n: int
+) -> list:
+    tables = np.array([random_table() for _ in range(n)])
+    rows = []
+    for n_processes in processes:
+        since = time.time()
+        start = time.perf_counter()
+        optimizer.batch_objective(tables, n_processes)
+        seconds = time.perf_counter() - start
+
+        summary = summarize(read_trace(optimizer.profiler.trace_file, since=since))
+        compute = summary["stages"]["compute"]["total"]
+        overhead = (seconds * n_processes - compute) / n
+        rows.append(
+            row("batch_objective", f"{n_processes} processes", n, seconds, overhead)
+        )
+    return rows
+
+
+def bench_global_optimize(
+    optimizer: SpeemOptimizer, processes: list[int], max_fun_evals: int
+) -> list:
+    rows = []
+    for n_processes in processes:
+        since = time.time()
+        start = time.perf_counter()
+        with quiet():
+            optimizer.global_optimize(
+                n_runs=n_processes,
+                n_processes=n_processes,
+                bads_options={"max_fun_evals": max_fun_evals},
+            )
+        seconds = time.perf_counter() - start
+
+        summary = summarize(read_trace(optimizer.profiler.trace_file, since=since))
+        n = summary["evaluations"]["n"]
+        compute = summary["stages"]["compute"]["total"] if n else 0.0
+        overhead = (seconds * n_processes - compute) / n if n else None
+        rows.append(
+            row("global_optimize", f"{n_processes} processes", n, seconds, overhead)
+        )
+    return rows
+
+
+def bench_data_gen(
+    fox_dir: Path, result_folder: Path, processes: list[int], n_samples: int
+) -> list:
+    generator = DataGenerator(LENS_LIMITS, fox_dir, result_folder)
+    rows = []
+    for n_processes in processes:
+        with quiet():
+            report = generator.parallel_data_gen(
+                f"bench_{n_processes}", n_processes, n_samples=n_samples
+            )
+        rows.append(
+            row(
+                "parallel_data_gen",
+                f"{n_processes} processes",
+                report["samples"],
+                report["elapsed"],
+            )
+        )
+    return rows
+
+
+def bench_save_record(
+    optimizer: SpeemOptimizer, n_records: int, n_terms: int, repeat: int
+) -> list:
+    aberrations = [
+        [f"{random.uniform(-1, 1):14.6E}" for _ in range(5)] + [" 100000"]
+        for _ in range(n_terms)
+    ]
+    record = optimizer._objective_parameters()
+    record["optimal_objective"] = 1.0
+    record["optimal_lens_table"] = dict(zip(LENS_LIMITS, random_table()))
+    record["aberrations"] = {"aper0Z": aberrations}
+    record["optimization_type"] = "global"
+    optimizer.record = [record] * n_records
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        optimizer.save_record()
+    seconds = time.perf_counter() - start
+    return [
+        row("save_record", f"{n_records} records x {n_terms} terms", repeat, seconds)
+    ]
+
+
+def write_plot_inputs(root: Path, n_angs: int, n_energies: int) -> None:
+    # rays.txt from 3 spots x n_angs angles
+    z = np.linspace(0, 0.784, 400)
+    r = np.outer(np.linspace(-1, 1, 3 * n_angs), np.sin(z * 8)) * 1e-3
+    write_rays(root / "rays.txt", z, r, np.zeros_like(r))
+    with open(root / "lensTable.txt", "w") as f:
+        f.write("benchmark\n")
+        # plot_rays lays out a full lens table
+        f.writelines(f"{name}: 100\n" for name in Electrode)
+    with open(root / "zrElec.txt", "w") as f:
+        f.writelines(
+            f"{z_i:27.16E} {r_i:27.16E}\n"
+            for z_i, r_i in zip(np.linspace(0, 0.784, 5000), np.full(5000, 0.02))
+        )
+
+    # conversionMap.txt for n_energies x 5 angles x 3 spots
+    with open(root / "conversionMap.txt", "w") as f:
+        f.write("resolved: angle\n")
+        for energy in np.arange(1, n_energies + 1):
+            for angle in range(5):
+                for spot in (-50, 0, 50):
+                    radius = angle * 2 + spot * 1e-3
+                    flight_time = 100 / np.sqrt(energy) + angle * 0.1
+                    f.write(f"{energy} {angle} {spot} {radius} {flight_time}\n")
+
+
+def bench_plots(root: Path, repeat: int) -> list:
+    write_plot_inputs(root, n_angs=10, n_energies=20)
+    rows = []
+    for name, plot in (("plot_rays", plot_rays), ("conversion_map", conversion_map)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            plot(root)
+            plt.close("all")
+        rows.append(row(name, "parse and draw", repeat, time.perf_counter() - start))
+    return rows
+
+
+def format_report(report: dict, baseline: dict = None) -> str:
+    """The fixed width table of a report, with the change of every rate to `baseline`."""
+    previous = {}
+    if baseline is not None:
+        previous = {(r["benchmark"], r["case"]): r for r in baseline["rows"]}
+
+    settings = report["settings"]
+    lines = [
+        f"cosy benchmarks v{report['version']}  python {settings['python']}  "
+        f"{settings['cpus']} cpus  fake cosy {settings['cosy_time']:.3f}s per run",
+        f"{'benchmark':<20}{'case':<28}{'n':>7}{'seconds':>10}{'rate [1/s]':>12}"
+        f"{'overhead [ms]':>15}{'change':>9}",
+    ]
+    for r in report["rows"]:
+        overhead = "" if r["overhead_ms"] is None else f"{r['overhead_ms']:.2f}"
+        change = ""
+        old = previous.get((r["benchmark"], r["case"]))
+        if old is not None and old["rate"]:
+            change = f"{r['rate'] / old['rate'] - 1:+.1%}"
+        lines.append(
+            f"{r['benchmark']:<20}{r['case']:<28}{r['n']:>7d}{r['seconds']:>10.3f}"
+            f"{r['rate']:>12.2f}{overhead:>15}{change:>9}"
+        )
+
+    stages = report.get("stages")
+    if stages:
+        lines.append("")
+        lines.append(f"{'objective stage':<20}{'mean [ms]':>12}{'p95 [ms]':>12}")
+        for name in STAGES:
+            stage = stages[name]
+            lines.append(
+                f"{name:<20}{1000 * stage['mean']:>12.3f}{1000 * stage['p95']:>12.3f}"
+            )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--cosy-time", type=float, default=0.05)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--evaluations", type=int, default=100)
+    parser.add_argument("--max-fun-evals", type=int, default=60)
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--quick", action="store_true", help="small sizes, for a check")
+    parser.add_argument("--json", type=Path, help="write the report here")
+    parser.add_argument("--compare", type=Path, help="a report written with --json")
+    args = parser.parse_args()
+    if args.quick:
+        args.processes = [1, 2]
+        args.evaluations = 10
+        args.max_fun_evals = 20
+        args.samples = 10
+
+    random.seed(0)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        fox_dir = tmp / "fox"
+        result_folder = tmp / "results"
+        fox_dir.mkdir()
+        result_folder.mkdir()
+        install_fake_cosy(tmp / "bin", args.cosy_time)
+
+        optimizer = make_optimizer(fox_dir, tmp / "trace.jsonl")
+        objective_rows, summary = bench_objective(optimizer, args.evaluations)
+        rows += objective_rows
+        rows += bench_batch_objective(optimizer, args.processes, args.evaluations)
+        rows += bench_global_optimize(optimizer, args.processes, args.max_fun_evals)
+        rows += bench_data_gen(fox_dir, result_folder, args.processes, args.samples)
+        rows += bench_save_record(optimizer, 20, 500, repeat=10)
+        rows += bench_plots(tmp, repeat=3)
+
+    report = {
+        "version": REPORT_VERSION,
+        "settings": {
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "cosy_time": args.cosy_time,
+            "processes": args.processes,
+        },
+        "rows": [{column: r[column] for column in COLUMNS} for r in rows],
+        "stages": summary["stages"],
+    }
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(format_report(report, baseline))
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""Field models for geometries too large for BuildModel.fox.
+
+BuildModel.fox holds G and its inverse in memory (nTotal^2 each) and dumps the inverse as
+text, which is tens of GB once there are tens of thousands of boundary points.
+`build_model_out_of_core` places the same points in Python, assembles G block by block
+into a memory mapped file and LU factorizes it in place. The factorization is kept next
+to the other model files so `FieldModel` can solve for charges on demand. gMatrixI.bin
+is only written when asked for, for the COSY procedures that need it.
+
+```
+model = build_model_out_of_core(lens, root, write_inverse=True)
+charges = model.charges({0: 0, 1: 1000})
+```
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from scipy.linalg import lu_factor, lu_solve
+
+from .constants import FOX_DIR
+from .field import FieldModel, FORTRAN_RECORD, LU_FILE, PIVOT_FILE, _kernel
+from .lens import Lens, PieceTable, ARC, GRADED_LINE, _fit_graded_spacing
+from .model import MODEL_FILES, GEOMETRY_FILES, _remove
+
+__all__ = [
+    "BoundaryPoints",
+    "discretize",
+    "assemble_green",
+    "write_green_inverse",
+    "build_model_out_of_core",
+]
+
+MM_TO_M = 1e-3
+# BuildModel.fox only checks the potential between points inside these limits (m)
+R_MAX = 25 * MM_TO_M
+Z_MAX = 1000 * MM_TO_M
+# BuildModel.fox treats a line coordinate as constant if it changes less than this (mm)
+CONSTANT_TOLERANCE = 1e-7
+# number of columns of G assembled at once
+DEFAULT_BLOCK_SIZE = 1024
+
+
+def _fortran_e(value: float) -> str:
+    """`value` formatted like Fortran's E24.16E2, which BuildModel.fox writes."""
+    mantissa, exponent = f"{value:.15e}".split("e")
+    sign = "-" if mantissa.startswith("-") else ""
+    digits = mantissa.lstrip("-").replace(".", "")
+    exponent = int(exponent) + 1 if value != 0 else 0
+    return f"{sign}0.{digits}E{exponent:+03d}".rjust(24)
+
+
+def _piece_points(piece: np.void) -> tuple[np.ndarray, ...]:
+    """The points of one piece, at the middle and the end of each segment (mm)."""
+    n_points = int(piece["n_points"])
+    coef = piece["coef"]
+    j = np.arange(1, n_points + 1)
+    mid = (j - 0.5) / n_points
+    end = j / n_points
+
+    if piece["type"] == ARC:
+        start, stop, radius, z_center, r_center = coef[[0, 2, 4, 5, 6]]
+        theta_mid = np.radians(start + (stop - start) * mid)
+        theta_end = np.radians(start + (stop - start) * end)
+        return (
+            z_center + radius * np.cos(theta_mid),
+            r_center + radius * np.sin(theta_mid),
+            z_center + radius * np.cos(theta_end),
+            r_center + radius * np.sin(theta_end),
+        )
+
+    z_start, r_start, z_stop, r_stop = coef[:4]
+    if piece["type"] == GRADED_LINE:
+        # the spacings are accumulated along the line
+        delta = coef[4] + (coef[5] - coef[4]) * mid
+        length = np.hypot(z_stop - z_start, r_stop - r_start)
+        end = np.cumsum(delta) / length
+        mid = end - delta / length / 2
+
+    points = []
+    for start, stop in ((z_start, z_stop), (r_start, r_stop)):
+        if abs(stop - start) < CONSTANT_TOLERANCE:
+            points.append((np.full(n_points, start), np.full(n_points, start)))
+        else:
+            points.append((start + (stop - start) * mid, start + (stop - start) * end))
+    (z_mid, z_end), (r_mid, r_end) = points
+    return z_mid, r_mid, z_end, r_end
+
+
+@dataclass
+class BoundaryPoints:
+    """The points BuildModel.fox writes to zrRing, zrElec, zrTest and voltage.txt (m)."""
+
+    z_ring: np.ndarray
+    r_ring: np.ndarray
+    z_elec: np.ndarray
+    r_elec: np.ndarray
+    z_test: np.ndarray
+    r_test: np.ndarray
+    groups: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.z_ring)
+
+    def write(self, root: Path) -> None:
+        """Write the points in the same layout as BuildModel.fox."""
+        for file, z, r in (
+            ("zrRing.txt", self.z_ring, self.r_ring),
+            ("zrTest.txt", self.z_test, self.r_test),
+            ("zrElec.txt", self.z_elec, self.r_elec),
+        ):
+            with open(root / file, "w") as f:
+                f.writelines(
+                    f"{_fortran_e(z_i)}   {_fortran_e(r_i)}\n" for z_i, r_i in zip(z, r)
+                )
+        with open(root / "voltage.txt", "w") as f:
+            f.writelines(
+                f"{i:5d}   {_fortran_e(group)}\n"
+                for i, group in enumerate(self.groups, start=1)
+            )
+
+
+def discretize(table: PieceTable) -> BoundaryPoints:
+    """Place the rings and electrode points of `table` the way BuildModel.fox does."""
+    table.check()
+    rings = _fit_graded_spacing(table.rings)
+    electrodes = _fit_graded_spacing(table.electrodes)
+
+    z_ring, r_ring = [], []
+    for piece in rings:
+        z_mid, r_mid, _, _ = _piece_points(piece)
+        z_ring.append(z_mid)
+        r_ring.append(r_mid)
+
+    z_elec, r_elec, z_test, r_test, groups = [], [], [], [], []
+    for piece in electrodes:
+        z_mid, r_mid, z_end, r_end = _piece_points(piece)
+        z_elec.append(z_mid)
+        r_elec.append(r_mid)
+        z_test.append(z_end)
+        r_test.append(r_end)
+        groups.append(np.full(len(z_mid), piece["voltage"]))
+
+    return BoundaryPoints(
+        *(MM_TO_M * np.concatenate(points) for points in (z_ring, r_ring)),
+        *(MM_TO_M * np.concatenate(points) for points in (z_elec, r_elec)),
+        *(MM_TO_M * np.concatenate(points) for points in (z_test, r_test)),
+        np.concatenate(groups),
+    )
+
+
+def assemble_green(
+    points: BoundaryPoints, out: np.ndarray, block_size: int = DEFAULT_BLOCK_SIZE
+) -> np.ndarray:
+    """
+    Fill `out` with G one block of columns at a time so only `out` (usually a
+    Fortran ordered memmap) has to hold the whole matrix.
+    """
+    z_elec = points.z_elec[:, np.newaxis]
+    r_elec = points.r_elec[:, np.newaxis]
+    for start in range(0, len(points), block_size):
+        columns = slice(start, start + block_size)
+        out[:, columns] = _kernel(
+            z_elec, r_elec, points.z_ring[columns], points.r_ring[columns]
+        )
+    return out
+
+
+def write_green_inverse(
+    factorization: tuple[np.ndarray, np.ndarray],
+    path: Path,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> None:
+    """
+    Write the inverse of G to `path` in the layout of gMatrixI.bin, solving for a
+    block of rows at a time.
+    """
+    n_total = len(factorization[1])
+    records = np.memmap(path, dtype=FORTRAN_RECORD, mode="w+", shape=(n_total, n_total))
+    for start in range(0, n_total, block_size):
+        stop = min(start + block_size, n_total)
+        unit = np.zeros((n_total, stop - start))
+        unit[np.arange(start, stop), np.arange(stop - start)] = 1
+        # rows of the inverse are the solutions of the transposed system
+        rows = lu_solve(factorization, unit, trans=1, check_finite=False).T
+        block = records[start:stop]
+        block["head"] = block["tail"] = FORTRAN_RECORD["value"].itemsize
+        block["value"] = rows
+    records.flush()
+
+
+def _write_residuals(path: Path, indices: np.ndarray, residuals: np.ndarray) -> None:
+    with open(path, "w") as f:
+        f.writelines(f"{i:5d}    {v:.15e}\n" for i, v in zip(indices, residuals))
+
+
+def build_model_out_of_core(
+    lens: Lens,
+    root: Path = FOX_DIR,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    write_inverse: bool = False,
+    check: bool = True,
+) -> FieldModel:
+    """
+    Build the field model of `lens` in `root` without holding G in memory.
+
+    Args
+    ----
+    lens : Lens
+        The geometry. Its coefR.txt and coefE.txt are written to `root` as well.
+    root : Path
+        Where the model files go.
+    block_size : int
+        Number of columns of G assembled (and rows of the inverse solved) at once.
+    write_inverse : bool
+        Also write gMatrixI.bin for COSY procedures that load the model. This needs
+        another nTotal^2 entries on disk and nTotal solves.
+    check : bool
+        Write test-volt.txt, test-volt_Alt.txt and zrvolt.txt like BuildModel.fox.
+
+    Returns
+    -------
+    model : FieldModel
+        The model, solving with the stored factorization.
+    """
+    for file in MODEL_FILES + GEOMETRY_FILES + (LU_FILE, PIVOT_FILE):
+        _remove(root / file)
+
+    lens.print(root)
+    points = discretize(lens.table)
+    points.write(root)
+
+    n_total = len(points)
+    matrix = np.memmap(
+        root / LU_FILE, dtype="<f8", mode="w+", shape=(n_total, n_total), order="F"
+    )
+    assemble_green(points, matrix, block_size)
+    # a Fortran ordered float64 array is factorized in place
+    lu, pivots = lu_factor(matrix, overwrite_a=True, check_finite=False)
+    matrix.flush()
+    np.save(root / PIVOT_FILE, pivots)
+    del lu, matrix
+
+    model = FieldModel.from_directory(root, use_inverse=False)
+    if write_inverse:
+        write_green_inverse(model._lu, root / "gMatrixI.bin", block_size)
+
+    if check:
+        # BuildModel.fox checks the charges for the voltage group ids as voltages
+        charges = model.solve(points.groups.astype(float))
+        voltages = {group: group for group in np.unique(points.groups)}
+        residuals = model.boundary_residuals(charges, voltages)
+        _write_residuals(root / "test-volt.txt", np.arange(1, n_total + 1), residuals)
+
+        inside = np.flatnonzero((points.r_test < R_MAX) & (points.z_test < Z_MAX))
+        residuals = (
+            model.potential(points.z_test[inside], points.r_test[inside], charges)
+            - points.groups[inside]
+        )
+        _write_residuals(root / "test-volt_Alt.txt", inside + 1, residuals)
+
+        z = (10 + np.arange(401) / 20) * MM_TO_M
+        with open(root / "zrvolt.txt", "w") as f:
+            f.writelines(
+                f"{i:5d}  {z_i:.15e}  {0:.15e}  {v:.15e}\n"
+                for i, (z_i, v) in enumerate(zip(z, model.axial_potential(z, charges)))
+            )
+
+    return model
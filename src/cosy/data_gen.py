@@ -1,22 +1,45 @@
 """To train ML models, you need a lot of data. The `DataGenerator` class allows for easy
 data generation. Assuming you have a working COSY model and template file, you can
 simply create an instance of the class with whatever `lens_limits` and call
-`parallel_data_gen` to continuously generate data. There's no easy way to gracefully
-shut down the data generation, so I just interrupt it and trim out the resulting bad
-data when loading it later.
+`parallel_data_gen` to generate data. It runs until `n_samples` rows are written, the
+`time_budget` is used up or it gets SIGINT/SIGTERM, and then lets every worker finish
+the row it's working on.
+
+Every worker process appends its rows to its own shard,
+`{filename}_model_data/{host}_{pid}.csv`, a batch at a time with a single write, so
+workers never wait on each other and a killed job never leaves half a row behind.
+`read_model_data` presents all shards as one array and `merge_model_data` packs them
+into `{filename}_model_data.npy`.
+
+`active_data_gen` generates the data in rounds instead. After a space-filling start it
+refits an `EnsembleSurrogate` to everything collected so far each round and simulates
+the lens tables where the surrogate is least certain or predicts the best objective.
 """
 
-import subprocess, random, time, os
+import subprocess, time, os, signal, socket
+from collections import Counter
+from copy import copy
+from typing import Callable
 from datetime import timedelta
 from itertools import count
 from multiprocessing import (
     Pool,
-    Lock,
+    Event,
+    Value,
     current_process,
 )
 import numpy as np
 
 from cosy.utils import process_file, create_file_from_template, LensTable
+from cosy.sampling import (
+    Sampler,
+    UniformSampler,
+    SobolSampler,
+    UncertaintySampler,
+    TableSampler,
+    load_state,
+)
+from cosy.surrogate import EnsembleSurrogate
 from cosy.constants import (
     FOX_DIR,
     RESULTS_DIR,
@@ -24,37 +47,209 @@ from cosy.constants import (
     HARDWARE_RESTRICTED_LENS_LIMITS,
 )
 
-from typing import TYPE_CHECKING
-
-if TYPE_CHECKING:
-    from pathlib import Path
-
-LOCK = Lock()
+from pathlib import Path
 
 FUNCTION_FILE = FOX_DIR / "DataGeneration.fox"
 OUTPUT_FILE = FOX_DIR / "output.txt"
 RESULT_FOLDER = RESULTS_DIR / "simulation_data" / "model_data"
+# rows a worker collects before writing them to its shard
+DEFAULT_BATCH_SIZE = 16
+
+# shared by the workers of parallel_data_gen, see _init_worker
+_stop = None
+_claimed = None
+_samples = None
+_failures = None
+_drawn = None
+_abort = None
+_skipped = None
+_taken = None
+
+
+def _init_worker(
+    stop, claimed, samples, failures, drawn, abort, skipped, taken
+) -> None:
+    global _stop, _claimed, _samples, _failures, _drawn, _abort, _skipped, _taken
+    _stop, _claimed, _samples, _failures = stop, claimed, samples, failures
+    _drawn, _abort, _skipped, _taken = drawn, abort, skipped, taken
+    # the parent handles Ctrl+C, and SIGTERM from e.g. SLURM only stops after this row
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+
+
+def _handle_sigterm(signum, frame) -> None:
+    # after a failure, SIGTERM comes from pool.terminate() and has to end the worker
+    if _abort.is_set():
+        raise SystemExit(1)
+    _stop.set()
+
+
+def _claim_sample(n_samples: int | None) -> bool:
+    """Reserve one of the `n_samples` rows so the workers write exactly that many."""
+    if n_samples is None:
+        return True
+    with _claimed.get_lock():
+        if _claimed.value >= n_samples:
+            return False
+        _claimed.value += 1
+    return True
+
+
+def _release_sample(n_samples: int | None) -> None:
+    """Give back a row reserved with `_claim_sample` that didn't get written."""
+    if n_samples is None:
+        return
+    with _claimed.get_lock():
+        _claimed.value -= 1
+
+
+def _claim_points(sampler: Sampler, n: int) -> tuple[int, np.ndarray]:
+    """
+    The index of the first and the lens tables of a block no other worker has: a
+    range an earlier job skipped, or else the next `n` of the design.
+    """
+    with _taken.get_lock():
+        if _taken.value < len(_skipped):
+            start, stop = _skipped[_taken.value]
+            _taken.value += 1
+            return start, sampler.points(start, stop - start)
+    with _drawn.get_lock():
+        start = _drawn.value
+        _drawn.value += n
+    return start, sampler.points(start, n)
+
+
+def _append_lines(path: Path, lines: list[str]) -> None:
+    # one write of whole lines with O_APPEND, so rows never get cut
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    try:
+        os.write(fd, "".join(lines).encode())
+    finally:
+        os.close(fd)
+
+
+class ShardWriter:
+    """Buffers rows and appends them to one shard `batch_size` at a time."""
+
+    def __init__(self, path: Path, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.rows: list[str] = []
+
+    def append(self, row: str) -> None:
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        _append_lines(self.path, self.rows)
+        self.rows = []
+
+
+def shard_folder(filename: str, result_folder: Path = RESULT_FOLDER) -> Path:
+    return result_folder / f"{filename}_model_data"
+
+
+def model_data_files(filename: str, result_folder: Path = RESULT_FOLDER) -> list[Path]:
+    """The csv files holding rows of `filename`: the shards and a pre-shard csv."""
+    files = sorted(shard_folder(filename, result_folder).glob("*.csv"))
+    single_file = result_folder / f"{filename}_model_data.csv"
+    if single_file.exists():
+        files.insert(0, single_file)
+    return files
+
+
+def _read_csv(path: Path) -> np.ndarray:
+    with open(path, "rt") as f:
+        rows = [line.rstrip("\n").split(",") for line in f if line.strip()]
+    if not rows:
+        return np.empty((0, 0))
+    # rows cut off by an interrupted run of the old single csv are skipped
+    n_columns = Counter(len(row) for row in rows).most_common(1)[0][0]
+    data = np.array([row for row in rows if len(row) == n_columns], dtype=float)
+    return data[np.isfinite(data).all(axis=1)]
+
+
+def read_model_data(filename: str, result_folder: Path = RESULT_FOLDER) -> np.ndarray:
+    """
+    All rows of `filename` as one array of shape (n_rows, n_inputs + n_outputs): the
+    merged npy file and any shards written since.
+    """
+    parts = []
+    merged_file = result_folder / f"{filename}_model_data.npy"
+    if merged_file.exists():
+        parts.append(np.load(merged_file))
+    parts += [_read_csv(path) for path in model_data_files(filename, result_folder)]
+    parts = [part for part in parts if part.size]
+    if not parts:
+        return np.empty((0, 0))
+    return np.concatenate(parts)
+
+
+def merge_model_data(
+    filename: str, result_folder: Path = RESULT_FOLDER, remove_shards: bool = True
+) -> Path:
+    """
+    Pack all rows of `filename` into `{filename}_model_data.npy`, replacing it
+    atomically, and remove the csv files that went into it. Don't merge while
+    `parallel_data_gen` is still writing to the shards.
+    """
+    files = model_data_files(filename, result_folder)
+    data = read_model_data(filename, result_folder)
+    merged_file = result_folder / f"{filename}_model_data.npy"
+    temporary_file = merged_file.with_suffix(".tmp.npy")
+    np.save(temporary_file, data)
+    os.replace(temporary_file, merged_file)
+    if remove_shards:
+        for path in files:
+            os.remove(path)
+    return merged_file
 
 
 class DataGenerator:
     lens_limits: dict[Electrode, tuple[float, float]]
     template_lines: list[str]
 
-    def __init__(self, lens_limits=None):
-        os.chdir(FOX_DIR)
+    def __init__(
+        self,
+        lens_limits=None,
+        fox_dir: Path = FOX_DIR,
+        result_folder: Path = RESULT_FOLDER,
+        sampler: Sampler = None,
+    ):
+        self.fox_dir = fox_dir
+        self.result_folder = result_folder
+        os.chdir(fox_dir)
         self.lens_limits = (
             HARDWARE_RESTRICTED_LENS_LIMITS if lens_limits is None else lens_limits
         )
+        self.sampler = UniformSampler(self.lens_limits) if sampler is None else sampler
         with open(FOX_DIR / "DataGenerationTemplate.fox", "rt") as f:
             self.template_lines = f.readlines()
 
-    def generate_datum_for_model(self, filename: str) -> None:
-        input_array = np.array(
-            [
-                random.uniform(lens_limit[0], lens_limit[1])
-                for lens_limit in self.lens_limits.values()
-            ]
+    def shard_path(self, filename: str) -> Path:
+        """The shard of this process."""
+        return (
+            shard_folder(filename, self.result_folder)
+            / f"{socket.gethostname()}_{os.getpid()}.csv"
         )
+
+    def generate_datum_for_model(
+        self,
+        filename: str,
+        writer: ShardWriter = None,
+        input_array: np.ndarray = None,
+    ) -> bool:
+        """
+        Run COSY for one lens table, `input_array` or the next one of the sampler, and
+        add the row to `writer`, or straight to this process' shard. False if COSY
+        failed.
+        """
+        if input_array is None:
+            input_array = self.sampler.sample(1)[0]
         lens_table = LensTable(
             zip(list(self.lens_limits.keys()), input_array.flatten())
         )
@@ -63,8 +258,8 @@ class DataGenerator:
             (process_id,) = current_process()._identity
         except ValueError:
             process_id = 0
-        curr_output_file = process_file(process_id, OUTPUT_FILE)
-        curr_function_file = process_file(process_id, FUNCTION_FILE)
+        curr_output_file = process_file(process_id, OUTPUT_FILE, self.fox_dir)
+        curr_function_file = process_file(process_id, FUNCTION_FILE, self.fox_dir)
 
         with open(curr_output_file, "wt") as f:
             f.write("None")
@@ -78,7 +273,10 @@ class DataGenerator:
 
         try:
             subprocess.run(
-                ["cosy", f"{curr_function_file}"], timeout=300, capture_output=True
+                ["cosy", f"{curr_function_file}"],
+                timeout=300,
+                capture_output=True,
+                cwd=self.fox_dir,
             )
         except subprocess.TimeoutExpired:
             pass
@@ -92,40 +290,325 @@ class DataGenerator:
         os.remove(curr_function_file)
 
         if result == "None":
-            return
+            return False
         output = ",".join(input_array.astype(str)) + f",{result}\n"
-        with LOCK:
-            with open(RESULT_FOLDER / f"{filename}_model_data.csv", "a") as f:
-                f.write(output)
+        if writer is None:
+            _append_lines(self.shard_path(filename), [output])
+        else:
+            writer.append(output)
+        return True
 
-    def generate_data_for_model(self, filename: str, worker_id: int) -> None:
-        """Generate model data infinitely. Send Ctrl+C to stop."""
+    def generate_data_for_model(
+        self,
+        filename: str,
+        worker_id: int,
+        n_samples: int = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> list[list[int]]:
+        """
+        Generate model data until parallel_data_gen stops the workers or `n_samples`
+        rows are written. Outside of parallel_data_gen it runs until Ctrl+C. Returns
+        the [start, stop) index ranges of the lens tables it took from the design but
+        didn't simulate.
+        """
+        if _stop is None:
+            _init_worker(
+                Event(),
+                Value("q", 0),
+                Value("q", 0),
+                Value("q", 0),
+                Value("q", self.sampler.position),
+                Event(),
+                [],
+                Value("q", 0),
+            )
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        writer = ShardWriter(self.shard_path(filename), batch_size)
+        try:
+            return self._generate_rows(filename, worker_id, n_samples, writer)
+        finally:
+            writer.flush()
+
+    def _generate_rows(
+        self,
+        filename: str,
+        worker_id: int,
+        n_samples: int | None,
+        writer: ShardWriter,
+    ) -> list[list[int]]:
+        index, block = 0, []
         for i in count():
+            # points are only claimed for rows that will run
+            if _stop.is_set() or not _claim_sample(n_samples):
+                break
+            if not len(block):
+                index, block = _claim_points(self.sampler, writer.batch_size)
+                block = list(block)
+            if not len(block):
+                _release_sample(n_samples)
+                print(f"{worker_id} : the design has no points left")
+                break
             start = time.perf_counter()
-            self.generate_datum_for_model(filename)
+            index += 1
+            if self.generate_datum_for_model(filename, writer, block.pop(0)):
+                with _samples.get_lock():
+                    _samples.value += 1
+            else:
+                _release_sample(n_samples)
+                # COSY getting killed on shutdown isn't a failure
+                if not _stop.is_set():
+                    with _failures.get_lock():
+                        _failures.value += 1
             print(
                 f"{worker_id} : {i} done in {str(timedelta(seconds=time.perf_counter()-start))[2:7]}"
             )
+        # the rest of the block when stopping
+        return [[index, index + len(block)]] if len(block) else []
+
+    def parallel_data_gen(
+        self,
+        filename: str,
+        n_processes: int = 8,
+        n_samples: int = None,
+        time_budget: float = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        state_file: Path = None,
+    ) -> dict:
+        """
+        Generate model data in parallel.
+
+        Args
+        ----
+        filename : str
+            Rows are appended to the shards in `{filename}_model_data/` in the result
+            folder, see `read_model_data`.
+        n_processes : int
+            Number of workers, each running one COSY process at a time.
+        n_samples : int
+            Stop once this many rows are written. Runs until stopped if None.
+        time_budget : float
+            Stop starting new rows after this many seconds.
+        batch_size : int
+            Rows each worker collects before writing them to its shard. At most this
+            many rows per worker are lost if the job gets killed. Workers also take
+            this many lens tables from the sampler at a time.
+        state_file : Path
+            Resume the sampler's design from this file if it exists and keep saving
+            where the design is to it, so the next job continues the same design.
+            Lens tables the workers took but didn't get to when stopping are saved
+            too, and simulated first by the next job.
+
+        Returns
+        -------
+        report : dict
+            Rows written, failed COSY runs, elapsed seconds, samples per second and the
+            failure rate.
+        """
+        if state_file is not None and (state := load_state(state_file)) is not None:
+            self.sampler.resume(state)
+            print(f"resuming the design at point {self.sampler.position}")
+
+        stop, abort = Event(), Event()
+        claimed, samples, failures = Value("q", 0), Value("q", 0), Value("q", 0)
+        drawn = Value("q", self.sampler.position)
+        skipped, taken = list(self.sampler.skipped), Value("q", 0)
+        unused = []
+
+        def save_state():
+            self.sampler.position = drawn.value
+            self.sampler.skipped = skipped[taken.value :] + unused
+            if state_file is not None:
+                self.sampler.save_state(state_file)
 
-    def parallel_data_gen(self, filename: str, n_processes: int = 8) -> None:
-        """Generate model data in parallel."""
-        with Pool(n_processes) as pool:
-            [
+        interrupted = Event()
+
+        def handle_signal(signum, frame):
+            if interrupted.is_set():
+                # a second signal doesn't wait for the rows
+                raise KeyboardInterrupt
+            print(f"got {signal.Signals(signum).name}, finishing the current rows")
+            interrupted.set()
+            stop.set()
+
+        handlers = {
+            signum: signal.signal(signum, handle_signal)
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        start = time.perf_counter()
+        pool = Pool(
+            n_processes,
+            initializer=_init_worker,
+            initargs=(stop, claimed, samples, failures, drawn, abort, skipped, taken),
+        )
+        try:
+            results = [
                 pool.apply_async(
-                    self.generate_data_for_model, args=(filename, worker_id)
+                    self.generate_data_for_model,
+                    args=(filename, worker_id, n_samples, batch_size),
                 )
                 for worker_id in range(n_processes)
             ]
+            while not all(result.ready() for result in results):
+                if (
+                    time_budget is not None
+                    and time.perf_counter() - start > time_budget
+                    and not stop.is_set()
+                ):
+                    print("time budget used up, finishing the current rows")
+                    stop.set()
+                next(result for result in results if not result.ready()).wait(1)
+                save_state()
+            for result in results:
+                # raise what went wrong in a worker
+                unused += result.get()
+            pool.close()
+        except BaseException:
+            # with abort set, the SIGTERM of terminate() makes the workers exit
+            abort.set()
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            save_state()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+        elapsed = time.perf_counter() - start
+        attempts = samples.value + failures.value
+        report = {
+            "samples": samples.value,
+            "failures": failures.value,
+            "elapsed": elapsed,
+            "samples_per_second": samples.value / elapsed,
+            "failure_rate": failures.value / attempts if attempts else 0.0,
+            "interrupted": interrupted.is_set(),
+        }
+        print(
+            f"{report['samples']} samples in {timedelta(seconds=round(elapsed))} "
+            f"({report['samples_per_second']:.2f}/s), "
+            f"{report['failures']} failed ({report['failure_rate']:.1%})"
+        )
+        return report
+
+    def active_data_gen(
+        self,
+        filename: str,
+        n_rounds: int,
+        round_size: int,
+        n_processes: int = 8,
+        objective: Callable[[np.ndarray], np.ndarray] = None,
+        exploit_fraction: float = 0.3,
+        n_candidates: int = 4096,
+        initial_size: int = None,
+        surrogate: EnsembleSurrogate = None,
+        time_budget: float = None,
+    ) -> list[dict]:
+        """
+        Generate model data in rounds, each simulating the lens tables a surrogate of
+        the data so far is least sure about or expects to be best.
+
+        Args
+        ----
+        filename : str
+            As in `parallel_data_gen`. Data already there is used from the start.
+        n_rounds : int
+            Number of rounds, each one `parallel_data_gen` over the chosen tables.
+        round_size : int
+            Lens tables simulated per round.
+        n_processes : int
+            Number of COSY workers.
+        objective : Callable
+            Maps predicted outputs (n, n_outputs) to an objective per lens table,
+            lower being better. Without it every round only explores.
+        exploit_fraction : float
+            Share of each round picked by predicted objective instead of uncertainty.
+        n_candidates : int
+            Candidates each pick is chosen from. Exploring and exploiting draw them
+            from separate Sobol sequences.
+        initial_size : int
+            Rows to collect from `sampler` before the first surrogate is fit.
+            Defaults to `round_size`.
+        surrogate : EnsembleSurrogate
+            Refit every round. Defaults to an `EnsembleSurrogate` over `lens_limits`.
+        time_budget : float
+            Seconds for all rounds together.
 
-            while True:
-                time.sleep(1)
+        Returns
+        -------
+        reports : list[dict]
+            The report of `parallel_data_gen` of every round, with the number of rows
+            the round started from.
+        """
+        n_inputs = len(self.lens_limits)
+        initial_size = round_size if initial_size is None else initial_size
+        if surrogate is None:
+            surrogate = EnsembleSurrogate(self.lens_limits)
+        candidates = SobolSampler(self.lens_limits)
+        # its own sequence, so exploiting doesn't rank the candidates explore just drew
+        exploit_candidates = SobolSampler(self.lens_limits)
+        n_exploit = round(exploit_fraction * round_size) if objective is not None else 0
+        n_explore = round_size - n_exploit
+        explore = UncertaintySampler(
+            candidates, surrogate, max(n_candidates // max(n_explore, 1), 1)
+        )
+
+        start = time.perf_counter()
+        reports = []
+        for round_i in range(n_rounds):
+            remaining = None
+            if time_budget is not None:
+                remaining = time_budget - (time.perf_counter() - start)
+                if remaining <= 0:
+                    break
+
+            data = read_model_data(filename, self.result_folder)
+            if len(data) < initial_size:
+                lens_tables = self.sampler.sample(initial_size - len(data))
+            else:
+                surrogate.fit(data[:, :n_inputs], data[:, n_inputs:])
+                lens_tables = explore.sample(n_explore)
+                if n_exploit:
+                    options = exploit_candidates.sample(n_candidates)
+                    predicted = objective(surrogate.predict(options)[0])
+                    # COSY shouldn't run a lens table twice
+                    chosen = set(map(tuple, data[:, :n_inputs]))
+                    chosen.update(map(tuple, lens_tables))
+                    best = [
+                        i
+                        for i in np.argsort(predicted)
+                        if tuple(options[i]) not in chosen
+                    ][:n_exploit]
+                    lens_tables = np.concatenate([lens_tables, options[best]])
+            print(
+                f"round {round_i}: {len(data)} rows so far, "
+                f"simulating {len(lens_tables)} lens tables"
+            )
+
+            # a copy so the sampler of this generator keeps its place in its design
+            generator = copy(self)
+            generator.sampler = TableSampler(self.lens_limits, lens_tables)
+            report = generator.parallel_data_gen(
+                filename,
+                n_processes,
+                time_budget=remaining,
+                batch_size=int(
+                    np.clip(len(lens_tables) // n_processes, 1, DEFAULT_BATCH_SIZE)
+                ),
+            )
+            report["round"] = round_i
+            report["rows_before"] = len(data)
+            reports.append(report)
+            if report["interrupted"]:
+                break
+        return reports
 
     @staticmethod
     def _prep_function_file(
         process_id: int,
         lens_table: dict,
         template_lines: list[str],
-        destination_file: "Path",
+        destination_file: Path,
     ) -> None:
         """
         Preps function file for each process using a specified process id
@@ -2,6 +2,7 @@
 Following: M.H.Rashid "Simple analytical method to design electrostatic einzel lens" Proceedings of the DAE Symp. on Nucl. Phys. 56 (2011)
 """
 
+import numpy as np
 import sympy as sp
 
 
@@ -77,6 +78,148 @@ def einzel_focal_length(
     return 1 / inverse_focal_length
 
 
+def _np_phi_gapped_apertures(z, V1, V2, S, D):
+    """NumPy version of `phi_gapped_apertures` that broadcasts over all arguments."""
+    z_plus = 2 * z + S
+    z_minus = 2 * z - S
+    return (V2 - V1) * D / (2 * np.pi * S) * (
+        z_plus / D * np.arctan2(z_plus, D) - z_minus / D * np.arctan2(z_minus, D)
+    ) + (V1 + V2) / 2
+
+
+def _np_phi_gapped_apertures_prime(z, V1, V2, S, D):
+    """Analytic z derivative of `_np_phi_gapped_apertures`."""
+
+    def term(x):
+        return np.arctan2(x, D) / D + x / (D**2 + x**2)
+
+    return (V2 - V1) * D / (np.pi * S) * (term(2 * z + S) - term(2 * z - S))
+
+
+def _np_phi_einzel(z, V1, V2, S, D, L):
+    d = (L + S) / 2
+    return (
+        -_np_phi_gapped_apertures(z - d, V1, V2, S, D)
+        + _np_phi_gapped_apertures(z + d, V1, V2, S, D)
+        + V1
+    )
+
+
+def _np_phi_einzel_prime(z, V1, V2, S, D, L):
+    d = (L + S) / 2
+    return -_np_phi_gapped_apertures_prime(
+        z - d, V1, V2, S, D
+    ) + _np_phi_gapped_apertures_prime(z + d, V1, V2, S, D)
+
+
+def inverse_focal_length_grid(
+    voltages: np.ndarray,
+    spacings: np.ndarray,
+    diameters: np.ndarray,
+    lengths: np.ndarray,
+    kinetic_energies: np.ndarray,
+    n_thin_lenses: int = 1000,
+) -> np.ndarray:
+    """
+    Calculates the inverse focal length of einzel lenses over the full grid of central
+    potentials V2 (end potential V1 = 0), spacings S, diameters D, center lengths L and
+    kinetic energies V0. This is the same thin lens sum as `einzel_focal_length` but
+    evaluated with NumPy for every grid point at once.
+
+    Returns
+    -------
+    inverse_focal_lengths : np.ndarray
+        Array with shape (len(voltages), len(spacings), len(diameters), len(lengths),
+        len(kinetic_energies)). The inverse is returned because it's smooth through
+        V2 = 0 where the focal length diverges.
+    """
+    V2, S, D, L, V0 = np.meshgrid(
+        np.atleast_1d(np.asarray(voltages, dtype=float)),
+        np.atleast_1d(np.asarray(spacings, dtype=float)),
+        np.atleast_1d(np.asarray(diameters, dtype=float)),
+        np.atleast_1d(np.asarray(lengths, dtype=float)),
+        np.atleast_1d(np.asarray(kinetic_energies, dtype=float)),
+        indexing="ij",
+    )
+
+    total_length = 2.5 * (L + 2 * S)
+    drift_length = total_length / n_thin_lenses
+
+    inverse_focal_length = np.zeros_like(V2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i in range(n_thin_lenses):
+            z_i = drift_length * (i + 1 / 2) - total_length / 2
+            phi = _np_phi_einzel(z_i, 0, V2, S, D, L)
+            phi_prime = _np_phi_einzel_prime(z_i, 0, V2, S, D, L)
+            k = np.sqrt(3) * phi_prime / 4 / (V0 - phi)
+            inverse_focal_length += k * np.sin(k * drift_length)
+    return inverse_focal_length
+
+
+def focal_length_grid(
+    voltages: np.ndarray,
+    spacings: np.ndarray,
+    diameters: np.ndarray,
+    lengths: np.ndarray,
+    kinetic_energies: np.ndarray,
+    n_thin_lenses: int = 1000,
+) -> np.ndarray:
+    """
+    Calculates einzel lens focal lengths over a full parameter grid. See
+    `inverse_focal_length_grid` for the argument and output layout.
+    """
+    with np.errstate(divide="ignore"):
+        return 1 / inverse_focal_length_grid(
+            voltages, spacings, diameters, lengths, kinetic_energies, n_thin_lenses
+        )
+
+
+def operating_voltages(
+    focal_lengths: np.ndarray,
+    voltages: np.ndarray,
+    inverse_focal_lengths: np.ndarray,
+) -> np.ndarray:
+    """
+    Inverts a precomputed grid from `inverse_focal_length_grid` to find the lowest
+    central voltage reaching each target focal length, using linear interpolation in
+    inverse focal length between neighbouring grid voltages.
+
+    Args
+    ----
+    focal_lengths : np.ndarray
+        Target focal lengths in the same units as the geometry.
+    voltages : np.ndarray
+        The sorted voltage axis the grid was computed on. Include 0 so the smallest
+        voltages are bracketed.
+    inverse_focal_lengths : np.ndarray
+        The precomputed grid with voltages along the first axis.
+
+    Returns
+    -------
+    operating_voltages : np.ndarray
+        Array with shape (len(focal_lengths), *inverse_focal_lengths.shape[1:]). Entries
+        are NaN where the target focal length isn't reached within the voltage axis.
+    """
+    voltages = np.asarray(voltages, dtype=float)
+    targets = 1 / np.atleast_1d(np.asarray(focal_lengths, dtype=float))
+    targets = targets.reshape((-1,) + (1,) * inverse_focal_lengths.ndim)
+
+    difference = inverse_focal_lengths[np.newaxis] - targets
+    crosses = np.sign(difference[:, :-1]) != np.sign(difference[:, 1:])
+    crosses &= np.isfinite(difference[:, :-1]) & np.isfinite(difference[:, 1:])
+    found = crosses.any(axis=1)
+    first = np.expand_dims(crosses.argmax(axis=1), axis=1)
+
+    lower = np.take_along_axis(difference, first, axis=1).squeeze(axis=1)
+    upper = np.take_along_axis(difference, first + 1, axis=1).squeeze(axis=1)
+    v_lower = voltages[first.squeeze(axis=1)]
+    v_upper = voltages[first.squeeze(axis=1) + 1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(upper != lower, lower / (lower - upper), 0)
+    return np.where(found, v_lower + fraction * (v_upper - v_lower), np.nan)
+
+
 def run_tests():
     def almost_equals(a, b, tol=1e-2):
         return abs(a - b) < tol
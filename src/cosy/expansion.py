@@ -0,0 +1,114 @@
+"""Second order expansions of COSY results in the parameters of the search space.
+
+`SpeemOptimizer.voltage_expansions` runs COSY once per endpoint on a stencil of
+1 + 2d + d(d-1)/2 points around a lens table, batched like
+`SpeemOptimizer.batch_objective`, and fits every map element and constant the
+objectives use with a quadratic polynomial of the d parameters. Objectives are then
+evaluated on the expansion with `ObjectiveFunction.evaluate` in microseconds, which
+`SpeemOptimizer.expansion_optimize` uses as the model of a trust region method.
+
+```
+expansion = optimizer.voltage_expansions(radius=20)["detZ"]
+elements = expansion.values(parameters)
+```
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+
+from .objective import ObjectiveFunction
+
+__all__ = ["VoltageExpansion", "stencil"]
+
+
+def stencil(
+    center: np.ndarray, step: float | np.ndarray, bounds: np.ndarray
+) -> np.ndarray:
+    """
+    Points that determine a quadratic around `center`: the center, two points along
+    every parameter and one along every pair, `step` away. Along a parameter that
+    can't go one step up and down within `bounds` (n_parameters, 2), the two points
+    are one and two steps to the side with room.
+    """
+    center = np.asarray(center, dtype=float)
+    step = np.broadcast_to(step, center.shape).astype(float)
+    room_up = center + step <= bounds[:, 1]
+    room_down = center - step >= bounds[:, 0]
+    first = np.where(room_up, step, -step)
+    second = np.where(room_up & room_down, -step, 2 * first)
+
+    n_parameters = len(center)
+    offsets = [np.zeros(n_parameters)]
+    offsets += list(np.diag(first)) + list(np.diag(second))
+    for i in range(n_parameters):
+        for j in range(i + 1, n_parameters):
+            offset = np.zeros(n_parameters)
+            offset[[i, j]] = first[[i, j]]
+            offsets.append(offset)
+    return np.clip(center + np.array(offsets), bounds[:, 0], bounds[:, 1])
+
+
+@dataclass
+class VoltageExpansion:
+    """
+    Quadratic polynomials of the outputs `keys`, map elements (i, j) and names of
+    COSY variables, in z = (parameters - center) / scale. `coefficients` has shape
+    (n_terms, n_outputs) over the monomials 1, z_i and z_i z_j for i <= j.
+    """
+
+    center: np.ndarray
+    scale: np.ndarray
+    keys: list[tuple[int, int] | str]
+    coefficients: np.ndarray
+    endpoint: str = ""
+
+    @classmethod
+    def fit(
+        cls,
+        center: np.ndarray,
+        scale: float | np.ndarray,
+        points: np.ndarray,
+        values: np.ndarray,
+        keys: list[tuple[int, int] | str],
+        endpoint: str = "",
+    ) -> "VoltageExpansion":
+        """
+        Least squares fit to `values` (n_points, n_outputs) at `points`, e.g. of
+        `stencil`. Points where COSY failed, i.e. with NaN values, are left out.
+        """
+        center = np.asarray(center, dtype=float)
+        scale = np.broadcast_to(scale, center.shape).astype(float)
+        expansion = cls(center, scale, list(keys), None, endpoint)
+        values = np.asarray(values, dtype=float)
+        valid = np.all(np.isfinite(values), axis=1)
+        if not np.any(valid):
+            raise ValueError(f"COSY failed at every point of the expansion at {center}")
+        expansion.coefficients, *_ = np.linalg.lstsq(
+            expansion._features(points[valid]), values[valid], rcond=None
+        )
+        return expansion
+
+    def _features(self, parameters: np.ndarray) -> np.ndarray:
+        z = (np.atleast_2d(parameters) - self.center) / self.scale
+        i, j = np.triu_indices(z.shape[1])
+        return np.hstack([np.ones((len(z), 1)), z, z[:, i] * z[:, j]])
+
+    def __call__(self, parameters: np.ndarray) -> np.ndarray:
+        """The outputs at parameters (n_parameters,) or (n_points, n_parameters)."""
+        outputs = self._features(parameters) @ self.coefficients
+        return outputs[0] if np.ndim(parameters) == 1 else outputs
+
+    def values(self, parameters: np.ndarray) -> dict[tuple[int, int] | str, float]:
+        return dict(zip(self.keys, self(np.ravel(parameters)).tolist()))
+
+    def evaluate(self, objective: ObjectiveFunction, parameters: np.ndarray) -> float:
+        """`objective` at `parameters` from the expanded elements and constants."""
+        values = self.values(parameters)
+        elements = {
+            key: value for key, value in values.items() if isinstance(key, tuple)
+        }
+        constants = {
+            key: value for key, value in values.items() if isinstance(key, str)
+        }
+        return objective.evaluate(elements, constants)
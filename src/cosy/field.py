@@ -0,0 +1,454 @@
+"""Python evaluation of the surface charge field model built by BuildModel.fox.
+
+The boundary of the electrodes is represented by rings of charge at the points in
+zrRing.txt. The charges are the solution of G @ charge = voltage where G(i, j) is the
+potential at electrode point i from a unit ring j,
+
+    G(i, j) = K(m) / sqrt((z_i - z_j)^2 + (r_i + r_j)^2),    m = 4 r_i r_j / (...)
+
+with K the complete elliptic integral of the first kind. BuildModel.fox stores the
+inverse of G in gMatrixI.bin. `FieldModel` loads it, or the LU factorization written by
+`build_model_out_of_core`, or solves G directly if neither exists. It computes charges
+for any set of electrode voltages and evaluates the potential and its gradient on arrays
+of points in chunks so memory stays bounded.
+
+Direct evaluation costs O(points * rings). `RingTree` groups the rings in a binary tree
+along z and replaces the sum over a group of rings by a multipole expansion about a point
+on the axis wherever the evaluation point is far enough outside (or inside) the group.
+Averaged over the azimuth the addition theorem only keeps the axisymmetric terms,
+
+    G = pi/2 sum_l rho^l P_l(cos a) P_l(cos t) / R^(l+1)    for R > rho,
+
+with (rho, a) the ring and (R, t) the evaluation point relative to the expansion
+center, and the same with rho and R swapped for R < rho. The error of both is about
+theta^(order+1) relative to the group's contribution so large grids can be evaluated in
+close to linear time with a controllable error.
+
+Everything uses the units of zrRing.txt (m) and the units the voltages are given in.
+"""
+
+from pathlib import Path
+
+import numpy as np
+from scipy.linalg import lu_factor, lu_solve
+from scipy.special import ellipk, ellipe
+
+from .constants import FOX_DIR
+
+__all__ = [
+    "FieldModel",
+    "RingTree",
+    "green_matrix",
+    "read_green_inverse",
+    "read_green_factorization",
+    "group_voltages",
+]
+
+# number of point-ring pairs evaluated at once
+DEFAULT_MAX_ELEMENTS = 2**22
+
+# below this m, dK/dm is taken from its series to avoid 0/0
+SMALL_M = 1e-6
+
+# defaults for RingTree
+TREE_ORDER = 12
+TREE_THETA = 0.4
+TREE_LEAF_SIZE = 64
+TREE_TOLERANCE = 1e-6
+
+# gMatrixI.bin is written entry by entry with WriteB, i.e. one Fortran sequential
+# record per entry
+FORTRAN_RECORD = np.dtype([("head", "<i4"), ("value", "<f8"), ("tail", "<i4")])
+
+# LU factorization of G stored by build_model_out_of_core in place of the inverse
+LU_FILE = "gMatrixLU.dat"
+PIVOT_FILE = "gMatrixPiv.npy"
+
+
+def _kernel(z, r, z_ring, r_ring) -> np.ndarray:
+    rho2 = (z - z_ring) ** 2 + (r + r_ring) ** 2
+    m = 4 * r * r_ring / rho2
+    return ellipk(m) / np.sqrt(rho2)
+
+
+def _kernel_gradient(z, r, z_ring, r_ring) -> tuple[np.ndarray, np.ndarray]:
+    dz = z - z_ring
+    rsum = r + r_ring
+    rho2 = dz**2 + rsum**2
+    m = 4 * r * r_ring / rho2
+    K = ellipk(m)
+
+    small = m < SMALL_M
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dK_dm = np.where(
+            small,
+            np.pi / 8 + 9 * np.pi * m / 64,
+            (ellipe(m) - (1 - m) * K) / (2 * m * (1 - m)),
+        )
+
+    rho3 = rho2 * np.sqrt(rho2)
+    dG_dz = -dz / rho3 * (2 * m * dK_dm + K)
+    dG_dr = (dK_dm * (4 * r_ring - 2 * m * rsum) - K * rsum) / rho3
+    return dG_dz, dG_dr
+
+
+def green_matrix(
+    z_elec: np.ndarray, r_elec: np.ndarray, z_ring: np.ndarray, r_ring: np.ndarray
+) -> np.ndarray:
+    """The matrix BuildModel.fox inverts, G(i, j) for electrode point i and ring j."""
+    return _kernel(z_elec[:, np.newaxis], r_elec[:, np.newaxis], z_ring, r_ring)
+
+
+def read_green_inverse(path: Path, n_total: int) -> np.ndarray:
+    """
+    Read gMatrixI.bin. Both plain float64 dumps and files of one Fortran record per
+    entry (what COSY's WriteB produces) are understood.
+    """
+    n_bytes = path.stat().st_size
+    n_entries = n_total**2
+    if n_bytes == n_entries * np.dtype("<f8").itemsize:
+        values = np.fromfile(path, dtype="<f8")
+    elif n_bytes == n_entries * FORTRAN_RECORD.itemsize:
+        values = np.fromfile(path, dtype=FORTRAN_RECORD)["value"]
+    else:
+        raise ValueError(
+            f"{path} has {n_bytes} bytes which doesn't match a {n_total}x{n_total} "
+            "matrix."
+        )
+    return values.reshape(n_total, n_total)
+
+
+def read_green_factorization(root: Path, n_total: int) -> tuple[np.memmap, np.ndarray]:
+    """
+    Memory map the LU factorization of G in `root` so charges can be solved for
+    without loading it.
+    """
+    lu = np.memmap(
+        root / LU_FILE, dtype="<f8", mode="r", shape=(n_total, n_total), order="F"
+    )
+    return lu, np.load(root / PIVOT_FILE)
+
+
+def group_voltages(
+    lens_table: dict[str, float], electrode_groups: dict[int, str]
+) -> dict[int, float]:
+    """
+    Convert a lens table to voltages of the voltage groups in voltage.txt.
+    `electrode_groups` maps each voltage group to the electrode it belongs to, e.g.
+    {0: Electrode.V00, 1: Electrode.V01, -1: Electrode.V01}. Unmapped groups are 0.
+    """
+    return {
+        group: lens_table[electrode]
+        for group, electrode in electrode_groups.items()
+        if electrode in lens_table
+    }
+
+
+def _regular_harmonics(dz, r, order: int):
+    """rho^l P_l(dz/rho) for l <= order and their z and r derivatives."""
+    rho2 = dz**2 + r**2
+    S = np.zeros((order + 2,) + np.shape(dz))
+    dS_dr = np.zeros_like(S)
+    S[0] = 1
+    S[1] = dz
+    for l in range(1, order):
+        S[l + 1] = ((2 * l + 1) * dz * S[l] - l * rho2 * S[l - 1]) / (l + 1)
+        dS_dr[l + 1] = (
+            (2 * l + 1) * dz * dS_dr[l] - l * (2 * r * S[l - 1] + rho2 * dS_dr[l - 1])
+        ) / (l + 1)
+    dS_dz = np.zeros_like(S)
+    dS_dz[1:] = np.arange(1, order + 2).reshape((-1,) + (1,) * np.ndim(dz)) * S[:-1]
+    return S[:-1], dS_dz[:-1], dS_dr[:-1]
+
+
+def _irregular_harmonics(dz, r, order: int):
+    """P_l(dz/R) / R^(l+1) for l <= order and their z and r derivatives."""
+    R2 = dz**2 + r**2
+    I = np.zeros((order + 2,) + np.shape(dz))
+    dI_dr = np.zeros_like(I)
+    I[0] = 1 / np.sqrt(R2)
+    dI_dr[0] = -r * I[0] / R2
+    for l in range(order + 1):
+        previous = I[l - 1] if l > 0 else 0
+        previous_dr = dI_dr[l - 1] if l > 0 else 0
+        I[l + 1] = ((2 * l + 1) * dz * I[l] - l * previous) / ((l + 1) * R2)
+        dI_dr[l + 1] = (
+            (2 * l + 1) * dz * dI_dr[l] - l * previous_dr - 2 * (l + 1) * r * I[l + 1]
+        ) / ((l + 1) * R2)
+    dI_dz = -np.arange(1, order + 2).reshape((-1,) + (1,) * np.ndim(dz)) * I[1:]
+    return I[:-1], dI_dz, dI_dr[:-1]
+
+
+class _Node:
+    def __init__(self, z_ring, r_ring, start, stop, order) -> None:
+        self.start, self.stop = start, stop
+        z, r = z_ring[start:stop], r_ring[start:stop]
+        self.center = (z.min() + z.max()) / 2
+        rho = np.hypot(z - self.center, r)
+        self.rho_min, self.rho_max = rho.min(), rho.max()
+        # multiplied with the charges these give the moments of the expansions outside
+        # and inside the rings
+        self.outer = _regular_harmonics(z - self.center, r, order)[0]
+        self.inner = (
+            _irregular_harmonics(z - self.center, r, order)[0]
+            if self.rho_min > 0
+            else None
+        )
+        self.children: list["_Node"] = []
+
+
+class RingTree:
+    """
+    Treecode for the potential of a fixed set of rings. Rings are split in half along z
+    until at most `leaf_size` are left. A group of rings is replaced by its expansion
+    about the center of its z range whenever the evaluation point is more than
+    rho_max/theta or less than theta*rho_min away from it and the truncation error
+    estimated from the group's total absolute charge is below `tolerance` (in units of
+    the potential). The estimate matters when neighbouring charges alternate in sign,
+    where the expansions lose the cancellation a direct sum keeps. Leaves that are too
+    close are evaluated exactly.
+    """
+
+    def __init__(
+        self,
+        z_ring: np.ndarray,
+        r_ring: np.ndarray,
+        order: int = TREE_ORDER,
+        theta: float = TREE_THETA,
+        leaf_size: int = TREE_LEAF_SIZE,
+        tolerance: float = TREE_TOLERANCE,
+    ) -> None:
+        self.order = order
+        self.theta = theta
+        self.leaf_size = leaf_size
+        self.tolerance = tolerance
+        self.sort = np.argsort(z_ring, kind="stable")
+        self.z_ring = z_ring[self.sort]
+        self.r_ring = r_ring[self.sort]
+        self.nodes: list[_Node] = []
+        self.root = self._build(0, len(self.z_ring))
+
+    def _build(self, start: int, stop: int) -> _Node:
+        node = _Node(self.z_ring, self.r_ring, start, stop, self.order)
+        self.nodes.append(node)
+        if stop - start > self.leaf_size:
+            middle = (start + stop) // 2
+            node.children = [self._build(start, middle), self._build(middle, stop)]
+        return node
+
+    def _evaluate(self, z, r, charges, gradient: bool):
+        z, r = np.broadcast_arrays(np.asarray(z, float), np.asarray(r, float))
+        shape = z.shape
+        z, r = z.ravel(), r.ravel()
+        charges = charges[self.sort]
+        results = [np.zeros(len(z)) for _ in range(2 if gradient else 1)]
+
+        stack = [(self.root, np.arange(len(z)))]
+        while stack:
+            node, targets = stack.pop()
+            q = charges[node.start : node.stop]
+            dz = z[targets] - node.center
+            R2 = dz**2 + r[targets] ** 2
+
+            R = np.sqrt(R2)
+            scale = np.pi / 2 * np.abs(q).sum()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                outside = (R * self.theta > node.rho_max) & (
+                    scale * (node.rho_max / R) ** (self.order + 1) / (R - node.rho_max)
+                    <= self.tolerance
+                )
+            inside = np.zeros_like(outside)
+            expansions = [(outside, node.outer, _irregular_harmonics)]
+            if node.inner is not None:
+                inside = (R < self.theta * node.rho_min) & (
+                    scale * (R / node.rho_min) ** (self.order + 1) / (node.rho_min - R)
+                    <= self.tolerance
+                )
+                expansions.append((inside, node.inner, _regular_harmonics))
+
+            for accepted, ring_harmonics, harmonics in expansions:
+                if not accepted.any():
+                    continue
+                moments = ring_harmonics @ q
+                values, d_dz, d_dr = harmonics(
+                    dz[accepted], r[targets[accepted]], self.order
+                )
+                if gradient:
+                    results[0][targets[accepted]] += np.pi / 2 * (moments @ d_dz)
+                    results[1][targets[accepted]] += np.pi / 2 * (moments @ d_dr)
+                else:
+                    results[0][targets[accepted]] += np.pi / 2 * (moments @ values)
+
+            targets = targets[~(outside | inside)]
+            if not len(targets):
+                continue
+            if node.children:
+                stack += [(child, targets) for child in node.children]
+                continue
+
+            z_ring = self.z_ring[node.start : node.stop]
+            r_ring = self.r_ring[node.start : node.stop]
+            z_target = z[targets, np.newaxis]
+            r_target = r[targets, np.newaxis]
+            if gradient:
+                dG_dz, dG_dr = _kernel_gradient(z_target, r_target, z_ring, r_ring)
+                results[0][targets] += dG_dz @ q
+                results[1][targets] += dG_dr @ q
+            else:
+                results[0][targets] += _kernel(z_target, r_target, z_ring, r_ring) @ q
+
+        return tuple(result.reshape(shape) for result in results)
+
+    def potential(
+        self, z: np.ndarray, r: np.ndarray, charges: np.ndarray
+    ) -> np.ndarray:
+        return self._evaluate(z, r, charges, gradient=False)[0]
+
+    def gradient(
+        self, z: np.ndarray, r: np.ndarray, charges: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        return self._evaluate(z, r, charges, gradient=True)
+
+
+class FieldModel:
+    def __init__(
+        self,
+        z_ring: np.ndarray,
+        r_ring: np.ndarray,
+        z_elec: np.ndarray,
+        r_elec: np.ndarray,
+        groups: np.ndarray,
+        green_inverse: np.ndarray = None,
+        factorization: tuple[np.ndarray, np.ndarray] = None,
+    ) -> None:
+        self.z_ring = z_ring
+        self.r_ring = r_ring
+        self.z_elec = z_elec
+        self.r_elec = r_elec
+        self.groups = groups.astype(int)
+        self.green_inverse = green_inverse
+        self._lu = factorization
+        self._unit_charges: dict[int, np.ndarray] = {}
+        self.tree: RingTree = None
+
+    @classmethod
+    def from_directory(cls, root: Path = FOX_DIR, use_inverse: bool = True):
+        """
+        Load a model built by BuildModel.fox or `build_model_out_of_core`. If
+        gMatrixI.bin is missing or `use_inverse` is False, a stored LU factorization is
+        used and failing that G is assembled and factorized in Python.
+        """
+        z_ring, r_ring = np.loadtxt(root / "zrRing.txt", unpack=True)
+        z_elec, r_elec = np.loadtxt(root / "zrElec.txt", unpack=True)
+        _, groups = np.loadtxt(root / "voltage.txt", unpack=True)
+
+        green_inverse, factorization = None, None
+        inverse_file = root / "gMatrixI.bin"
+        if use_inverse and inverse_file.exists():
+            green_inverse = read_green_inverse(inverse_file, len(z_ring))
+        elif (root / LU_FILE).exists():
+            factorization = read_green_factorization(root, len(z_ring))
+
+        return cls(z_ring, r_ring, z_elec, r_elec, groups, green_inverse, factorization)
+
+    @property
+    def n_total(self) -> int:
+        return len(self.z_ring)
+
+    def solve(self, point_voltages: np.ndarray) -> np.ndarray:
+        """Ring charges for the voltages at every electrode point."""
+        if self.green_inverse is not None:
+            return self.green_inverse @ point_voltages
+        if self._lu is None:
+            self._lu = lu_factor(
+                green_matrix(self.z_elec, self.r_elec, self.z_ring, self.r_ring)
+            )
+        return lu_solve(self._lu, point_voltages, check_finite=False)
+
+    def unit_charges(self, group: int) -> np.ndarray:
+        """Ring charges with 1 on voltage `group` and 0 everywhere else."""
+        if group not in self._unit_charges:
+            self._unit_charges[group] = self.solve((self.groups == group).astype(float))
+        return self._unit_charges[group]
+
+    def charges(self, voltages: dict[int, float]) -> np.ndarray:
+        """
+        Ring charges for the voltages of each voltage group, found by superposing the
+        cached unit solutions of each group.
+        """
+        charges = np.zeros(self.n_total)
+        for group, voltage in voltages.items():
+            if voltage != 0:
+                charges += voltage * self.unit_charges(group)
+        return charges
+
+    def use_tree(
+        self,
+        order: int = TREE_ORDER,
+        theta: float = TREE_THETA,
+        leaf_size: int = TREE_LEAF_SIZE,
+        tolerance: float = TREE_TOLERANCE,
+    ) -> "FieldModel":
+        """
+        Evaluate the potential and gradient with a `RingTree` from now on. Lower
+        `theta` or `tolerance`, or higher `order` for a smaller error.
+        """
+        self.tree = RingTree(
+            self.z_ring, self.r_ring, order, theta, leaf_size, tolerance
+        )
+        return self
+
+    def _chunks(self, z, r, max_elements: int):
+        z, r = np.broadcast_arrays(np.asarray(z, float), np.asarray(r, float))
+        z, r = z.ravel(), r.ravel()
+        chunk_size = max(max_elements // self.n_total, 1)
+        for start in range(0, len(z), chunk_size):
+            stop = start + chunk_size
+            yield slice(start, stop), z[start:stop, None], r[start:stop, None]
+
+    def potential(
+        self,
+        z: np.ndarray,
+        r: np.ndarray,
+        charges: np.ndarray,
+        max_elements: int = DEFAULT_MAX_ELEMENTS,
+    ) -> np.ndarray:
+        """The potential at (z, r), broadcasting z and r against each other."""
+        if self.tree is not None:
+            return self.tree.potential(z, r, charges)
+        shape = np.broadcast_shapes(np.shape(z), np.shape(r))
+        potential = np.empty(int(np.prod(shape)))
+        for chunk, z_chunk, r_chunk in self._chunks(z, r, max_elements):
+            potential[chunk] = (
+                _kernel(z_chunk, r_chunk, self.z_ring, self.r_ring) @ charges
+            )
+        return potential.reshape(shape)
+
+    def gradient(
+        self,
+        z: np.ndarray,
+        r: np.ndarray,
+        charges: np.ndarray,
+        max_elements: int = DEFAULT_MAX_ELEMENTS,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The z and r derivatives of the potential at (z, r)."""
+        if self.tree is not None:
+            return self.tree.gradient(z, r, charges)
+        shape = np.broadcast_shapes(np.shape(z), np.shape(r))
+        dphi_dz = np.empty(int(np.prod(shape)))
+        dphi_dr = np.empty(int(np.prod(shape)))
+        for chunk, z_chunk, r_chunk in self._chunks(z, r, max_elements):
+            dG_dz, dG_dr = _kernel_gradient(z_chunk, r_chunk, self.z_ring, self.r_ring)
+            dphi_dz[chunk] = dG_dz @ charges
+            dphi_dr[chunk] = dG_dr @ charges
+        return dphi_dz.reshape(shape), dphi_dr.reshape(shape)
+
+    def axial_potential(self, z: np.ndarray, charges: np.ndarray) -> np.ndarray:
+        return self.potential(z, 0, charges)
+
+    def boundary_residuals(self, charges: np.ndarray, voltages: dict[int, float]):
+        """The same check as test-volt.txt, computed in Python."""
+        point_voltages = np.zeros(self.n_total)
+        for group, voltage in voltages.items():
+            point_voltages[self.groups == group] = voltage
+        return self.potential(self.z_elec, self.r_elec, charges) - point_voltages
@@ -6,23 +6,270 @@ Lanzara Group - UC Berkeley
 low level info -
 coefE:       information about each piece of elecrtrodes
 coefE(i,1):  number of points
-coefE(i,2):  type, 1 for line, 2 for arc
+coefE(i,2):  type, 1 for line, 2 for arc, 3 for line with graded point spacing
 coefE(i,3):  voltage
 coefE(i,4):  starting point in z if type is 1, starting angle (degree) if type is 2
 coefE(i,5):  starting point in r if type is 1, 0 if type is 2
 coefE(i,6):  ending point in z if type is 1, ending angle (degree) if type is 2
 coefE(i,7):  ending point in r if type is 1, 0 if type is 2
 coefE(i,8):  0 if type is 1, R if type is 2 ( (r-r0)^2+(z-z0)^2=R^2 )
-coefE(i,9):  0 if type is 1, z0 if type is 2
+             starting point spacing if type is 3
+coefE(i,9):  0 if type is 1, z0 if type is 2, ending point spacing if type is 3
 coefE(i,10): 0 if type is 1, r0 if type is 2
 
 coefR is the same except coefR(i,3) = 0
+
+`PieceTable` holds the same information as NumPy structured arrays so whole geometries
+can be transformed and written without looping over pieces in Python.
+
+Type 3 lines are columns 4-7 of a type 1 line with point spacings that change linearly
+from coef(i,8) to coef(i,9). BuildModel.fox places the points by accumulating the
+spacings so they're rescaled to add up to the piece length when written.
 """
 
 from dataclasses import dataclass, field
+from io import StringIO
 from math import sqrt, ceil, atan2, degrees, radians, sin, cos, tan
 from pathlib import Path
-from copy import deepcopy
+from typing import Callable
+
+import numpy as np
+
+LINE = 1
+ARC = 2
+GRADED_LINE = 3
+LINE_TYPES = [LINE, GRADED_LINE]
+
+# graded lines are only emitted when the end spacings differ by more than this fraction
+GRADING_TOLERANCE = 0.05
+
+# coef holds columns 4-10 of coefE/coefR
+PIECE_DTYPE = np.dtype(
+    [("n_points", "i8"), ("type", "i8"), ("voltage", "i8"), ("coef", "f8", (7,))]
+)
+
+# fixed-width columns read by BuildModel.fox with R(str,a,b)
+COEF_R_FORMAT = "%3d %1d %1d" + " %+1.15e" * 7
+COEF_E_FORMAT = "%3d %1d  %6d" + "  %+1.14e" * 7
+
+
+def _pieces_from_rows(rows: list[list]) -> np.ndarray:
+    pieces = np.zeros(len(rows), dtype=PIECE_DTYPE)
+    if rows:
+        rows = np.asarray(rows, dtype=float)
+        pieces["n_points"] = rows[:, 0]
+        pieces["type"] = rows[:, 1]
+        pieces["voltage"] = rows[:, 2]
+        pieces["coef"] = rows[:, 3:]
+    return pieces
+
+
+def _rows_from_pieces(pieces: np.ndarray) -> list[list]:
+    return [
+        [int(piece["n_points"]), int(piece["type"]), int(piece["voltage"])]
+        + piece["coef"].tolist()
+        for piece in pieces
+    ]
+
+
+def _check_types(pieces: np.ndarray) -> None:
+    bad = ~np.isin(pieces["type"], LINE_TYPES + [ARC])
+    if bad.any():
+        raise ValueError(
+            f"{pieces[bad][0]} in your piece table has a nonsense type. This should "
+            "never happen so something is very broken."
+        )
+
+
+def _mirror_pieces(pieces: np.ndarray, mirror_z: float) -> np.ndarray:
+    """Mirror lines and arcs about the plane at `mirror_z`."""
+    pieces = pieces.copy()
+    coef = pieces["coef"]
+    lines = np.isin(pieces["type"], LINE_TYPES)
+    arcs = pieces["type"] == ARC
+
+    # z start and z end of lines
+    coef[lines, 0] = 2 * mirror_z - coef[lines, 0]
+    coef[lines, 2] = 2 * mirror_z - coef[lines, 2]
+
+    # start angle, end angle and center z of arcs
+    angles = coef[arcs][:, [0, 2]]
+    angles = np.where(angles < 0, -180 - angles, 180 - angles)
+    start, end = angles[:, 0], angles[:, 1]
+    start_fix = (start == 180) & (end < 0)
+    end_fix = ~start_fix & (end == 180) & (start < 0)
+    start[start_fix] = -180
+    end[end_fix] = -180
+    coef[arcs, 0] = start
+    coef[arcs, 2] = end
+    coef[arcs, 5] = 2 * mirror_z - coef[arcs, 5]
+
+    return pieces
+
+
+def _fit_graded_spacing(pieces: np.ndarray) -> np.ndarray:
+    """Rescale the spacings of graded lines so they add up to the line length."""
+    pieces = pieces.copy()
+    graded = pieces["type"] == GRADED_LINE
+    coef = pieces["coef"][graded]
+    length = np.hypot(coef[:, 2] - coef[:, 0], coef[:, 3] - coef[:, 1])
+    total = pieces["n_points"][graded] * (coef[:, 4] + coef[:, 5]) / 2
+    coef[:, 4:6] *= (length / total)[:, np.newaxis]
+    pieces["coef"][graded] = coef
+    return pieces
+
+
+def _format_pieces(pieces: np.ndarray, fmt: str) -> str:
+    pieces = _fit_graded_spacing(pieces)
+    lines = StringIO()
+    np.savetxt(
+        lines,
+        np.column_stack(
+            [pieces["n_points"], pieces["type"], pieces["voltage"], pieces["coef"]]
+        ),
+        fmt=fmt,
+    )
+    return lines.getvalue()
+
+
+@dataclass
+class PieceTable:
+    """
+    Array-backed version of the coefE/coefR lists of a `Lens`. Each row of
+    `electrodes` and `rings` is a `PIECE_DTYPE` record. All transforms return a new
+    table so variants of a geometry can be generated from a shared base.
+    """
+
+    electrodes: np.ndarray
+    rings: np.ndarray
+
+    def __post_init__(self):
+        if len(self.electrodes) != len(self.rings):
+            raise ValueError("Every electrode piece needs a matching ring piece.")
+
+    @classmethod
+    def from_coefficients(cls, coefE: list[list], coefR: list[list]) -> "PieceTable":
+        return cls(_pieces_from_rows(coefE), _pieces_from_rows(coefR))
+
+    def __len__(self) -> int:
+        return len(self.electrodes)
+
+    @property
+    def n_total(self) -> int:
+        return int(self.rings["n_points"].sum())
+
+    def check(self) -> None:
+        if self.electrodes["n_points"].sum() != self.n_total:
+            raise Exception(
+                "Something is broken. The number of electrodes doesn't match the "
+                "number of rings."
+            )
+
+    def copy(self) -> "PieceTable":
+        return PieceTable(self.electrodes.copy(), self.rings.copy())
+
+    def select(self, pieces_i: list[int] | np.ndarray) -> "PieceTable":
+        return PieceTable(self.electrodes[pieces_i], self.rings[pieces_i])
+
+    def append(self, *others: "PieceTable") -> "PieceTable":
+        return PieceTable(
+            np.concatenate([self.electrodes] + [other.electrodes for other in others]),
+            np.concatenate([self.rings] + [other.rings for other in others]),
+        )
+
+    def offset(self, dz: float = 0, dr: float = 0) -> "PieceTable":
+        table = self.copy()
+        for pieces in (table.electrodes, table.rings):
+            coef = pieces["coef"]
+            lines = np.isin(pieces["type"], LINE_TYPES)
+            arcs = pieces["type"] == ARC
+            coef[lines, 0] += dz
+            coef[lines, 2] += dz
+            coef[lines, 1] += dr
+            coef[lines, 3] += dr
+            coef[arcs, 5] += dz
+            coef[arcs, 6] += dr
+        return table
+
+    def scale(self, factor: float, resample: bool = True) -> "PieceTable":
+        """
+        Scale the geometry about z = r = 0. With `resample` the number of points per
+        piece is scaled as well so the point spacing stays roughly the same.
+        """
+        table = self.copy()
+        for pieces in (table.electrodes, table.rings):
+            coef = pieces["coef"]
+            lines = np.isin(pieces["type"], LINE_TYPES)
+            arcs = pieces["type"] == ARC
+            coef[lines, :4] *= factor
+            coef[pieces["type"] == GRADED_LINE, 4:6] *= factor
+            coef[arcs, 4:] *= factor
+            if resample:
+                pieces["n_points"] = np.maximum(
+                    np.ceil(pieces["n_points"] * factor - 1e-9), 1
+                )
+        return table
+
+    def remap_voltages(self, mapping: dict[int, int]) -> "PieceTable":
+        """Move electrode pieces between voltage groups, e.g. {3: 5, -3: 6}."""
+        table = self.copy()
+        voltages = self.electrodes["voltage"]
+        for old, new in mapping.items():
+            table.electrodes["voltage"][voltages == old] = new
+        return table
+
+    def mirrored(
+        self,
+        pieces_i: list[int] | np.ndarray | None = None,
+        mirror_z: float = 0,
+        voltage_group: int = None,
+    ) -> "PieceTable":
+        """
+        Only the mirrored pieces. They're put in the negated voltage group unless
+        `voltage_group` is specified.
+        """
+        table = self if pieces_i is None else self.select(pieces_i)
+        _check_types(table.electrodes)
+
+        electrodes = _mirror_pieces(table.electrodes, mirror_z)
+        rings = _mirror_pieces(table.rings, mirror_z)
+        electrodes["voltage"] = (
+            -electrodes["voltage"] if voltage_group is None else voltage_group
+        )
+        return PieceTable(electrodes, rings)
+
+    def mirror(
+        self,
+        pieces_i: list[int] | np.ndarray | None = None,
+        mirror_z: float = 0,
+        voltage_group: int = None,
+    ) -> "PieceTable":
+        """The table with mirrored copies of `pieces_i` appended."""
+        return self.append(self.mirrored(pieces_i, mirror_z, voltage_group))
+
+    def format(self) -> tuple[str, str]:
+        """The contents of coefR.txt and coefE.txt."""
+        self.check()
+
+        rings = f"{len(self)}\n{self.n_total}\n" + _format_pieces(
+            self.rings, COEF_R_FORMAT
+        )
+        electrodes = f"{len(self)}\n" + _format_pieces(self.electrodes, COEF_E_FORMAT)
+        return rings, electrodes
+
+    def write(self, root: Path, printR: bool = False, printE: bool = False) -> None:
+        """Write coefR.txt and coefE.txt in the layout BuildModel.fox reads."""
+        rings, electrodes = self.format()
+
+        with open(root / Path("coefR.txt"), "w") as f:
+            f.write(rings)
+        with open(root / Path("coefE.txt"), "w") as f:
+            f.write(electrodes)
+
+        if printR:
+            print(rings)
+        if printE:
+            print(electrodes)
 
 
 @dataclass
@@ -47,10 +294,18 @@ class Lens:
 
         arcs > 180deg aren't supported, 180 degree arcs are always counterclockwise i.e. inside
         arcs > 180deg could probably be made by chaining arcs together (haven't tested this)
+
+        the point spacing of a single piece can be set with the spacing keyword, and
+        lines can be graded towards a different end_spacing. Setting spacing_function
+        to a function of (z, r) varies the spacing with position e.g. fine near the
+        axis and coarse far from it (see proximity_spacing). Arcs also get at least
+        one point per max_arc_angle degrees if it's set.
         """
 
     point_spacing: float = 0.1
     er_spacing: float = None  # spacing between electrodes and rings
+    spacing_function: Callable[[float, float], float] = None
+    max_arc_angle: float = None
 
     z_start: float = 0
     z_offset: float = 0
@@ -82,11 +337,41 @@ class Lens:
 
         return self
 
-    def line(self, z_end: float, r_end: float):
+    def _local_spacing(self, z: float, r: float) -> float:
+        if self.spacing_function is None:
+            return self.point_spacing
+        return self.spacing_function(z + self.z_offset, r)
+
+    def line(
+        self,
+        z_end: float,
+        r_end: float,
+        *,
+        spacing: float = None,
+        end_spacing: float = None,
+    ):
         if z_end == self.z_start and r_end == self.r_start:
             raise ValueError("Your lines have to go somewhere.")
         length = sqrt((z_end - self.z_start) ** 2 + (r_end - self.r_start) ** 2)
-        n_points = ceil(length / self.point_spacing)
+
+        start_spacing = (
+            spacing
+            if spacing is not None
+            else self._local_spacing(self.z_start, self.r_start)
+        )
+        if end_spacing is None:
+            end_spacing = (
+                spacing if spacing is not None else self._local_spacing(z_end, r_end)
+            )
+        mean_spacing = (start_spacing + end_spacing) / 2
+
+        n_points = ceil(length / mean_spacing)
+        if abs(end_spacing - start_spacing) <= GRADING_TOLERANCE * mean_spacing:
+            piece_type = LINE
+            spacings = [0, 0]
+        else:
+            piece_type = GRADED_LINE
+            spacings = [start_spacing, end_spacing]
 
         coefR_z_start, coefR_z_end = self._calc_z_shift(z_end, r_end, length)
         coefR_r_start, coefR_r_end = self._calc_r_shift(z_end, r_end, length)
@@ -94,28 +379,26 @@ class Lens:
         self.coefE.append(
             [
                 n_points,
-                1,
+                piece_type,
                 self.voltage,
                 self.z_start + self.z_offset,
                 self.r_start,
                 z_end + self.z_offset,
                 r_end,
-                0,
-                0,
+                *spacings,
                 0,
             ]
         )
         self.coefR.append(
             [
                 n_points,
-                1,
+                piece_type,
                 0,
                 coefR_z_start + self.z_offset,
                 coefR_r_start,
                 coefR_z_end + self.z_offset,
                 coefR_r_end,
-                0,
-                0,
+                *spacings,
                 0,
             ]
         )
@@ -134,17 +417,17 @@ class Lens:
 
         return self
 
-    def vertical(self, end_r: float):
+    def vertical(self, end_r: float, **spacing_kwargs):
         if end_r == self.r_start:
             raise ValueError("Verticals can't end at the starting r.")
-        self.line(self.z_start, end_r)
+        self.line(self.z_start, end_r, **spacing_kwargs)
 
         return self
 
-    def horizontal(self, end_z: float):
+    def horizontal(self, end_z: float, **spacing_kwargs):
         if end_z == self.z_start:
             raise ValueError("Horizontals can't end at the starting z.")
-        self.line(end_z, self.r_start)
+        self.line(end_z, self.r_start, **spacing_kwargs)
 
         return self
 
@@ -181,7 +464,7 @@ class Lens:
 
         self.start_direction = curr_direction
 
-    def arc(self, end_direction: float, radius: float):
+    def arc(self, end_direction: float, radius: float, *, spacing: float = None):
         if self.start_direction == None:
             raise ValueError(
                 "There's no starting direction stored, likely because the electrode "
@@ -207,7 +490,6 @@ class Lens:
         is_clockwise = cw_dist < ccw_dist
 
         length = radius * radians(min(cw_dist, ccw_dist))
-        n_points: int = ceil(length / self.point_spacing)
 
         if is_clockwise:
             center_z = self.z_start + radius * sin(radians(self.start_direction))
@@ -223,6 +505,21 @@ class Lens:
         end_z = round(center_z + radius * cos(radians(end_angle)), 8)
         end_r = round(center_r + radius * sin(radians(end_angle)), 8)
 
+        if spacing is None:
+            # arcs aren't graded, so use the finest spacing along them
+            mid_angle = radians((start_angle + end_angle) / 2)
+            spacing = min(
+                self._local_spacing(self.z_start, self.r_start),
+                self._local_spacing(end_z, end_r),
+                self._local_spacing(
+                    center_z + radius * cos(mid_angle),
+                    center_r + radius * sin(mid_angle),
+                ),
+            )
+        if self.max_arc_angle is not None:
+            spacing = min(spacing, radius * radians(self.max_arc_angle))
+        n_points: int = ceil(length / spacing)
+
         self.coefE.append(
             [
                 n_points,
@@ -279,29 +576,11 @@ class Lens:
     def mirror(
         self, pieces_i: list[int], mirror_z: float = 0, voltage_group: int = None
     ):
-        pieces_E = deepcopy([self.coefE[i] for i in pieces_i])
-        pieces_R = deepcopy([self.coefR[i] for i in pieces_i])
-
-        for piece_E, piece_R in zip(pieces_E, pieces_R):
-            piece_E[2] = -piece_E[2] if voltage_group is None else voltage_group
-            if piece_E[1] == 1:
-                piece_type = "line"
-            elif piece_E[1] == 2:
-                piece_type = "arc"
-            else:
-                raise ValueError(
-                    f"{piece_E} in your coefE list has a nonsense type. This should never happen so something is very broken."
-                )
-
-            if piece_type == "line":
-                piece_E = self._mirror_line(piece_E, mirror_z)
-                piece_R = self._mirror_line(piece_R, mirror_z)
-            else:
-                piece_E = self._mirror_arc(piece_E, mirror_z)
-                piece_R = self._mirror_arc(piece_R, mirror_z)
-
-            self.coefE.append(piece_E)
-            self.coefR.append(piece_R)
+        mirrored = self.table.mirrored(
+            pieces_i, mirror_z=mirror_z, voltage_group=voltage_group
+        )
+        self.coefE += _rows_from_pieces(mirrored.electrodes)
+        self.coefR += _rows_from_pieces(mirrored.rings)
 
         return self
 
@@ -311,41 +590,9 @@ class Lens:
 
         return self
 
-    @staticmethod
-    def _mirror_coord(coord: float, mirror_point: float) -> float:
-        return 2 * mirror_point - coord
-
-    @staticmethod
-    def _mirror_angle(angle: float) -> float:
-        if angle < 0:
-            return -180 - angle
-        return 180 - angle
-
-    @staticmethod
-    def _mirror_line(piece: list, mirror_z: float) -> list:
-        z_start_i = 3
-        z_end_i = 5
-        for i in [z_start_i, z_end_i]:
-            piece[i] = Lens._mirror_coord(piece[i], mirror_z)
-        return piece
-
-    @staticmethod
-    def _mirror_arc(piece: list, mirror_z: float) -> list:
-        center_z_i = 8
-        angle_start_i = 3
-        angle_end_i = 5
-
-        mirrored_start = Lens._mirror_angle(piece[angle_start_i])
-        mirrored_end = Lens._mirror_angle(piece[angle_end_i])
-        if (mirrored_start == 180) and (mirrored_end < 0):
-            mirrored_start = -180
-        elif (mirrored_end == 180) and (mirrored_start < 0):
-            mirrored_end = -180
-
-        piece[center_z_i] = Lens._mirror_coord(piece[center_z_i], mirror_z)
-        piece[angle_start_i] = mirrored_start
-        piece[angle_end_i] = mirrored_end
-        return piece
+    @property
+    def table(self) -> PieceTable:
+        return PieceTable.from_coefficients(self.coefE, self.coefR)
 
     def check(self):
         for piece in self.coefR:
@@ -363,24 +610,29 @@ class Lens:
     def print(self, root, printR=False, printE=False):
         self.check()
 
-        with open(root / Path("coefR.txt"), "w") as f:
-            f.write(f"{len(self.coefR)}\n")
-            f.write(f"{self.nTotal}\n")
-
-            for piece in self.coefR:
-                string = f"{piece[0]:3d} {piece[1]:1d} {piece[2]:1d} {piece[3]:+1.15e} {piece[4]:+1.15e} {piece[5]:+1.15e} {piece[6]:+1.15e} {piece[7]:+1.15e} {piece[8]:+1.15e} {piece[9]:+1.15e}\n"
-                f.write(string)
-                if printR:
-                    print(string)
-
-        with open(root / Path("coefE.txt"), "w") as f:
-            f.write(f"{len(self.coefE)}\n")
-
-            for piece in self.coefE:
-                string = f"{piece[0]:3d} {piece[1]:1d}  {piece[2]:6d}  {piece[3]:+1.14e}  {piece[4]:+1.14e}  {piece[5]:+1.14e}  {piece[6]:+1.14e}  {piece[7]:+1.14e}  {piece[8]:+1.14e}  {piece[9]:+1.14e}\n"
-                f.write(string)
-                if printE:
-                    print(string)
+        self.table.write(root, printR=printR, printE=printE)
 
         print(f"nTotal = {self.nTotal}")
         print(self.n_pieces)
+
+
+def proximity_spacing(
+    min_spacing: float,
+    max_spacing: float,
+    r_near: float,
+    r_far: float,
+    z_range: tuple[float, float] = None,
+) -> Callable[[float, float], float]:
+    """
+    A `Lens.spacing_function` that's `min_spacing` within `r_near` of the axis and
+    grows linearly to `max_spacing` at `r_far`. Outside of `z_range` the spacing is
+    always `max_spacing`.
+    """
+
+    def spacing(z: float, r: float) -> float:
+        if z_range is not None and not (z_range[0] <= z <= z_range[1]):
+            return max_spacing
+        fraction = min(max((r - r_near) / (r_far - r_near), 0), 1)
+        return min_spacing + fraction * (max_spacing - min_spacing)
+
+    return spacing
@@ -0,0 +1,246 @@
+"""Field models are built by running BuildModel.fox on the coefR.txt/coefE.txt written by
+a `Lens`. These helpers build a model in any directory so several geometries can exist
+side by side instead of all sharing `FOX_DIR`.
+"""
+
+import os, shutil, subprocess, hashlib
+from pathlib import Path
+
+import numpy as np
+
+from .constants import FOX_DIR
+from .field import LU_FILE, PIVOT_FILE
+from .lens import Lens
+
+__all__ = [
+    "MODEL_FILES",
+    "GEOMETRY_FILES",
+    "prepare_model_dir",
+    "build_model",
+    "ModelCache",
+    "boundary_residuals",
+]
+
+BUILD_FILE = FOX_DIR / "BuildModel.fox"
+MODEL_CACHE_DIR = FOX_DIR / "model_cache"
+
+# the files downstream COSY procedures read to load a field model
+MODEL_FILES = ("gMatrixI.bin", "zrRing.txt", "zrElec.txt", "zrTest.txt", "voltage.txt")
+GEOMETRY_FILES = ("coefR.txt", "coefE.txt")
+# everything else BuildModel.fox writes
+BUILD_OUTPUTS = (
+    "gMatrixI.txt",
+    "test-volt.txt",
+    "test-volt_Alt.txt",
+    "zrvolt.txt",
+    "matrix.txt",
+    "invmatrix.txt",
+    LU_FILE,
+    PIVOT_FILE,
+)
+SHARED_SUFFIXES = (".fox", ".bin", ".exe")
+
+
+def _link_or_copy(source: Path, destination: Path) -> None:
+    try:
+        os.symlink(source, destination)
+    except OSError:
+        # symlinks need extra privileges on Windows
+        shutil.copy2(source, destination)
+
+
+def _hard_link_or_copy(source: Path, destination: Path) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        # hard links can't cross file systems
+        shutil.copy2(source, destination)
+
+
+def _remove(file: Path) -> None:
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        pass
+
+
+def prepare_model_dir(root: Path, source: Path = FOX_DIR) -> Path:
+    """
+    Create `root` and link the COSY sources and compiled includes from `source` into
+    it. Model and geometry files are never linked so building in `root` can't
+    overwrite the ones in `source`.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    excluded = set(MODEL_FILES + GEOMETRY_FILES + BUILD_OUTPUTS)
+    for file in source.iterdir():
+        if (
+            not file.is_file()
+            or file.name in excluded
+            or file.suffix not in SHARED_SUFFIXES
+        ):
+            continue
+        destination = root / file.name
+        if not destination.exists():
+            _link_or_copy(file.absolute(), destination)
+    return root
+
+
+def build_model(lens: Lens, root: Path = FOX_DIR, timeout: float = None) -> None:
+    """Write the geometry of `lens` to `root` and run BuildModel.fox there."""
+    # these may be links into a ModelCache so they have to go before COSY writes
+    for file in MODEL_FILES + GEOMETRY_FILES + (LU_FILE, PIVOT_FILE):
+        _remove(root / file)
+
+    lens.print(root)
+    subprocess.run(
+        ["cosy", BUILD_FILE.name], cwd=root, capture_output=True, timeout=timeout
+    )
+
+    missing = [file for file in MODEL_FILES if not (root / file).exists()]
+    if missing:
+        raise RuntimeError(f"BuildModel.fox didn't produce {missing} in {root}.")
+
+
+def boundary_residuals(
+    root: Path = FOX_DIR, between_points: bool = True
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The error estimate BuildModel.fox writes for a built model. The potential of the
+    solved charges minus the boundary voltage, either at the points the charges were
+    solved for (test-volt.txt) or halfway between them within rMax/zMax
+    (test-volt_Alt.txt). The latter shows the discretization error, so it's the one to
+    compare when coarsening the point spacing.
+
+    Returns
+    -------
+    indices : np.ndarray
+        The 1-based indices of the boundary points.
+    residuals : np.ndarray
+        The residual potential at each point.
+    """
+    file = "test-volt_Alt.txt" if between_points else "test-volt.txt"
+    indices, residuals = np.loadtxt(root / file, unpack=True, ndmin=2)
+    return indices.astype(int), residuals
+
+
+class ModelCache:
+    """
+    Built field models stored by a hash of the geometry that produced them. Fetching a
+    known geometry hard links (or copies) its model files into the working directory
+    instead of rerunning BuildModel.fox. The least recently used models are evicted
+    once the cache grows beyond `max_bytes`. Hard links keep the files of an evicted
+    model alive in every directory it was fetched into, e.g. for variants of a
+    parallel `GeometrySweep` that are still running COSY on it.
+    """
+
+    def __init__(
+        self,
+        root: Path = MODEL_CACHE_DIR,
+        max_bytes: int = 20 * 2**30,
+        link: bool = True,
+    ) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.link = link
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(lens: Lens) -> str:
+        rings, electrodes = lens.table.format()
+        digest = hashlib.sha256()
+        for part in (
+            rings,
+            electrodes,
+            repr(lens.point_spacing),
+            repr(lens.er_spacing),
+        ):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def entry(self, key: str) -> Path:
+        return self.root / key
+
+    def __contains__(self, lens: Lens) -> bool:
+        return self.entry(self.key(lens)).exists()
+
+    def fetch(self, lens: Lens, destination: Path = FOX_DIR) -> bool:
+        """Put the cached model for `lens` in `destination`. False if it isn't cached."""
+        entry = self.entry(self.key(lens))
+        if not entry.exists():
+            return False
+
+        for file in MODEL_FILES + GEOMETRY_FILES:
+            _remove(destination / file)
+            if self.link:
+                _hard_link_or_copy(entry / file, destination / file)
+            else:
+                shutil.copy2(entry / file, destination / file)
+        # the modification time of an entry marks when it was last used
+        os.utime(entry)
+        return True
+
+    def store(self, lens: Lens, source: Path = FOX_DIR) -> Path:
+        """Copy the model built from `lens` in `source` into the cache."""
+        entry = self.entry(self.key(lens))
+        if entry.exists():
+            os.utime(entry)
+            return entry
+
+        # copying to a temporary folder first keeps concurrent readers from seeing a
+        # partially written entry
+        temp = self.root / f".{entry.name}_{os.getpid()}"
+        temp.mkdir(exist_ok=True)
+        for file in MODEL_FILES + GEOMETRY_FILES:
+            shutil.copy2(source / file, temp / file)
+        try:
+            os.replace(temp, entry)
+        except OSError:
+            # another process stored the same geometry first
+            shutil.rmtree(temp, ignore_errors=True)
+
+        self.evict()
+        return entry
+
+    def build(self, lens: Lens, root: Path = FOX_DIR, timeout: float = None) -> bool:
+        """
+        Fetch the model for `lens` into `root`, building and storing it first if it
+        isn't cached. Returns whether the model came from the cache.
+        """
+        if self.fetch(lens, root):
+            return True
+        build_model(lens, root, timeout=timeout)
+        self.store(lens, root)
+        return False
+
+    def entries(self) -> list[Path]:
+        """Cached models from least to most recently used."""
+        entries = [
+            entry
+            for entry in self.root.iterdir()
+            if entry.is_dir() and not entry.name.startswith(".")
+        ]
+        return sorted(entries, key=lambda entry: entry.stat().st_mtime)
+
+    @staticmethod
+    def _entry_size(entry: Path) -> int:
+        return sum(file.stat().st_size for file in entry.iterdir() if file.is_file())
+
+    def size(self) -> int:
+        return sum(self._entry_size(entry) for entry in self.entries())
+
+    def evict(self) -> None:
+        """Remove least recently used models until the cache fits in `max_bytes`."""
+        entries = self.entries()
+        sizes = [self._entry_size(entry) for entry in entries]
+        total = sum(sizes)
+        # never evict the most recently used model
+        for entry, size in zip(entries[:-1], sizes[:-1]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self) -> None:
+        for entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
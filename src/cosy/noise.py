@@ -0,0 +1,100 @@
+"""Voltage noise of the power supplies, for objectives that tolerate it.
+
+With `SpeemOptimizer(..., voltage_noise=VoltageNoise(sigma=0.5, n_samples=8))` every
+objective evaluation simulates the lens table under `n_samples` random perturbations of
+its voltages in a single batched COSY run and returns their mean, worst case or a
+quantile. The perturbations are drawn once from `seed`, so the robust objective stays a
+deterministic function of the lens table, which the optimizers and finite differences
+rely on.
+
+```
+noise = VoltageNoise({Electrode.V00: 1.0, Electrode.V11: 0.2}, n_samples=16, aggregate=0.9)
+```
+"""
+
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .constants import Electrode
+
+__all__ = ["VoltageNoise"]
+
+
+@dataclass
+class VoltageNoise:
+    """
+    Args
+    ----
+    sigma : float | dict[Electrode, float]
+        Standard deviation of the Gaussian noise in volts, for every electrode or per
+        electrode. Electrodes missing from the dict are exact.
+    n_samples : int
+        Perturbed lens tables per evaluation.
+    aggregate : str | float
+        "mean", "max" for the worst case, or a quantile in (0, 1).
+    seed : int
+        Of the perturbations.
+    n_processes : int
+        Parallel COSY runs the perturbations of an evaluation are split into.
+        Evaluations in the workers of a process pool, e.g. in `global_optimize`, use
+        a single run.
+    """
+
+    sigma: float | dict[Electrode, float] = 0.1
+    n_samples: int = 8
+    aggregate: str | float = "mean"
+    seed: int = 0
+    n_processes: int = 1
+    _draws: np.ndarray = field(default=None, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        if not (
+            self.aggregate in ("mean", "max")
+            or isinstance(self.aggregate, float)
+            and 0 < self.aggregate < 1
+        ):
+            raise ValueError(
+                f"aggregate must be 'mean', 'max' or a quantile, not {self.aggregate}"
+            )
+
+    def _sigma(self, electrode: Electrode) -> float:
+        if isinstance(self.sigma, dict):
+            return self.sigma.get(electrode, 0.0)
+        return self.sigma
+
+    def perturb(self, lens_table: dict) -> list[dict]:
+        """`n_samples` copies of `lens_table` with noise on the voltages."""
+        if self._draws is None:
+            # standard normal draws per sample and electrode, reused for every table
+            self._draws = np.random.default_rng(self.seed).standard_normal(
+                (self.n_samples, len(Electrode))
+            )
+        columns = {name: i for i, name in enumerate(Electrode)}
+        return [
+            type(lens_table)(
+                (name, voltage + self._sigma(name) * draws[columns[name]])
+                for name, voltage in lens_table.items()
+            )
+            for draws in self._draws
+        ]
+
+    def combine(self, objectives: np.ndarray) -> float:
+        """Aggregate the objectives of the perturbed lens tables."""
+        if self.aggregate == "mean":
+            return float(np.mean(objectives))
+        if self.aggregate == "max":
+            return float(np.max(objectives))
+        return float(np.quantile(objectives, self.aggregate))
+
+    def to_dict(self) -> dict:
+        return {
+            "sigma": (
+                {str(name): value for name, value in self.sigma.items()}
+                if isinstance(self.sigma, dict)
+                else self.sigma
+            ),
+            "n_samples": self.n_samples,
+            "aggregate": self.aggregate,
+            "seed": self.seed,
+        }
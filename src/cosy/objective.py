@@ -2,7 +2,29 @@
 optics optimizations with COSY
 """
 
+import re, math
 from dataclasses import dataclass
+from functools import lru_cache
+
+# a number, a map element, a logical constant, a name or an operator in a FOX expression
+FOX_TOKEN_PATTERN = re.compile(
+    r"\d+\.?\d*(?:[ED][+-]?\d+)?|MA\((\d+),(\d+)\)|LO\(([01])\)|[A-Z_]\w*|<=|>=|[\^=#]",
+    re.IGNORECASE,
+)
+# FOX intrinsics and their Python counterparts
+FOX_INTRINSICS = {
+    "ABS": "abs",
+    "SQRT": "sqrt",
+    "EXP": "exp",
+    "LOG": "log",
+    "SIN": "sin",
+    "COS": "cos",
+    "TAN": "tan",
+    "TRUE": "True",
+    "FALSE": "False",
+    "NONE": "None",
+}
+FOX_OPERATORS = {"^": "**", "=": "==", "#": "!="}
 
 
 @dataclass
@@ -11,6 +33,34 @@ class ObjectiveFunction:
     endpoint: str
     function: list[str]
 
+    @property
+    def elements(self) -> tuple[tuple[int, int], ...]:
+        """The map elements MA(i,j) the objective uses, as (i, j)."""
+        return _compile(self.call, tuple(self.function))[1]
+
+    @property
+    def constants(self) -> tuple[str, ...]:
+        """The other COSY variables the objective uses, e.g. aperture diameters."""
+        return _compile(self.call, tuple(self.function))[2]
+
+    def evaluate(
+        self, elements: dict[tuple[int, int], float], constants: dict[str, float] = None
+    ) -> float:
+        """
+        The objective in Python from the values of its `elements` and `constants`, for
+        objective functions made of assignments and If blocks. Others, e.g. ones that
+        trace rays with Polval, raise a ValueError.
+        """
+        code, _, _ = _compile(self.call, tuple(self.function))
+        namespace = {"_MA": elements, "_C": {} if constants is None else constants}
+        namespace.update((name, getattr(math, name)) for name in ("sqrt", "exp", "log"))
+        namespace.update((name, getattr(math, name)) for name in ("sin", "cos", "tan"))
+        try:
+            exec(code, namespace)
+        except KeyError as error:
+            raise ValueError(f"no value for {error.args[0]} of {self.call}") from error
+        return float(namespace["_result"])
+
     def as_json(self) -> list[str]:
         return [
             f"name = {self.call}",
@@ -41,6 +91,104 @@ class ObjectiveFunction:
         return ObjectiveFunction(f"{self.call}/{value}", self.endpoint, self.function)
 
 
+def _translate(
+    expression: str, functions: set[str], variables: set[str], constants: set[str]
+) -> str:
+    """A FOX expression as a Python one. Names that aren't `functions` or `variables`
+    are looked up in _C and added to `constants`."""
+
+    def replace(match: re.Match) -> str:
+        token = match.group(0)
+        if match.group(1) is not None:
+            return f"_MA[({match.group(1)}, {match.group(2)})]"
+        if match.group(3) is not None:
+            return str(match.group(3) == "1")
+        if token[0].isdigit():
+            return token.upper().replace("D", "E")
+        if token in FOX_OPERATORS:
+            return FOX_OPERATORS[token]
+        if token.upper() in FOX_INTRINSICS:
+            return FOX_INTRINSICS[token.upper()]
+        if token in variables:
+            return f"v_{token}"
+        if token in functions:
+            return f"f_{token}"
+        if token in ("<=", ">="):
+            return token
+        constants.add(token)
+        return f"_C[{token!r}]"
+
+    return FOX_TOKEN_PATTERN.sub(replace, expression)
+
+
+@lru_cache
+def _compile(
+    call: str, function: tuple[str, ...]
+) -> tuple[object, tuple[tuple[int, int], ...], tuple[str, ...]]:
+    """
+    Python code setting _result to the objective `call` of the FOX `function` lines,
+    the map elements it reads from _MA and the constants it reads from _C.
+    """
+    statements = [
+        statement.strip()
+        for line in function
+        for statement in line.split(";")
+        if statement.strip()
+    ]
+    functions = {
+        match.group(1)
+        for statement in statements
+        if (match := re.match(r"Function\s+(\w+)", statement, re.IGNORECASE))
+    }
+
+    constants = set()
+    lines = []
+    indent = ""
+    name = None
+    variables = set()
+    for statement in statements:
+        keyword = statement.split()[0].upper()
+        if keyword == "FUNCTION":
+            name = statement.split()[1]
+            variables = {name}
+            lines += [f"def f_{name}(*_):", f"    v_{name} = 0.0"]
+            indent = "    "
+        elif keyword == "ENDFUNCTION":
+            lines.append(f"    return v_{name}")
+            indent = ""
+        elif keyword in ("IF", "ELSEIF"):
+            condition = _translate(
+                statement.split(maxsplit=1)[1], functions, variables, constants
+            )
+            if keyword == "ELSEIF":
+                indent = indent[:-4]
+            lines += [
+                f"{indent}{'if' if keyword == 'IF' else 'elif'} {condition}:",
+                f"{indent}    pass",
+            ]
+            indent += "    "
+        elif keyword == "ENDIF":
+            indent = indent[:-4]
+        elif (match := re.fullmatch(r"(\w+)\s*:=(.*)", statement)) is not None:
+            expression = _translate(match.group(2), functions, variables, constants)
+            variables.add(match.group(1))
+            lines.append(f"{indent}v_{match.group(1)} = {expression}")
+        else:
+            raise ValueError(f"can't evaluate {statement!r} outside of COSY")
+    lines.append(f"_result = {_translate(call, functions, set(), constants)}")
+
+    elements = {
+        (int(i), int(j))
+        for text in (call, *function)
+        for i, j in re.findall(r"MA\((\d+),(\d+)\)", text, re.IGNORECASE)
+    }
+    return (
+        compile("\n".join(lines), "<objective>", "exec"),
+        tuple(sorted(elements)),
+        tuple(sorted(constants)),
+    )
+
+
 def add_to_function(function_name: str, remainder: str) -> str:
     return f"{function_name}:={function_name}+{remainder}"
 
@@ -230,33 +378,62 @@ def spatial_filter_objective_function(
     )
 
 
+def _ray_vectors(n_spots: int, n_angs: int) -> list[str]:
+    """
+    FOX lines filling the VE variables ri(1) and ri(2) with a spot x angle grid of rays,
+    from the axis to spotSize/2 and from 0 to intAng/2, so a single Polval evaluates the
+    map for all of them.
+    """
+    return [
+        f"Loop iSpot 0 {n_spots - 1}",
+        f"Loop iAng 1 {n_angs}",
+        f"rSpot:=iSpot/{max(n_spots - 1, 1)}*spotSize/2",
+        f"aRay:=Sin(iAng/{n_angs}*intAng/2)",
+        "If (iSpot=0)*(iAng=1)",
+        "ri(1):=rSpot",
+        "ri(2):=aRay",
+        "ElseIf TRUE",
+        "ri(1):=ri(1)&rSpot",
+        "ri(2):=ri(2)&aRay",
+        "EndIf",
+        "EndLoop",
+        "EndLoop",
+    ] + [f"ri({i}):=0*ri(1)" for i in range(3, 7)]
+
+
 def clear_aperture_objective_function(
-    endpoint: str, aper_d: str | int | float, function_name: str = "ClearApertureObj"
+    endpoint: str,
+    aper_d: str | int | float,
+    function_name: str = "ClearApertureObj",
+    n_spots: int = 2,
+    n_angs: int = 10,
 ):
+    """
+    Sum of how far rays land outside the aperture. The map is evaluated once for all
+    n_spots x n_angs rays, so finer sampling costs little.
+    """
+    n_rays = n_spots * n_angs
     return ObjectiveFunction(
         f"{function_name}(none)",
         endpoint,
         create_function(
             function_name,
             [
-                "Variable iter 1; Variable startingR 1; Variable ii 1; Variable nAngs 1",
-                "Variable ri 12 6; Variable ro 12 6",
-                f"nAngs:=10; startingR:=0; {function_name}:=0",
-                "Loop iter 1 2",
-                "Loop ii 1 10",
-                "ri(1):=startingR",
-                "ri(2):=Sin(ii/nAngs*intAng/2)",
-                "ri(3):=0",
-                "ri(4):=0",
-                "ri(5):=0",
-                "ri(6):=0",
+                "Variable iSpot 1; Variable iAng 1; Variable iRay 1",
+                "Variable rSpot 1; Variable aRay 1; Variable xOut 1",
+                # VE variables need room for every ray
+                f"Variable ri {n_rays + 2} 6; Variable ro {n_rays + 2} 6",
+                f"{function_name}:=0",
+            ]
+            + _ray_vectors(n_spots, n_angs)
+            + [
                 "Polval 1 MAP 6 ri 6 ro 6",
-                f"If ABS(ro(1))>({aper_d}/2)",
-                add_to_function(function_name, f"(ABS(ro(1))-{aper_d}/2)"),
+                f"Loop iRay 1 {n_rays}",
+                "VELGET ro(1) iRay xOut",
+                f"If ABS(xOut)>({aper_d}/2)",
+                add_to_function(function_name, f"(ABS(xOut)-{aper_d}/2)"),
                 "EndIf",
                 "EndLoop",
-                "startingR:=spotSize/2",
-                "EndLoop",
             ],
         ),
     )
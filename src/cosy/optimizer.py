@@ -8,6 +8,7 @@ import numpy as np
 from colorama import Fore, Style
 from multiprocessing import current_process
 from pathos.multiprocessing import ProcessingPool
+from pathos.helpers import mp as pathos_mp
 
 from .constants import HARDWARE_RESTRICTED_LENS_LIMITS, FOX_DIR, RESULTS_DIR, Electrode
 from .utils import (
@@ -18,6 +19,21 @@ from .utils import (
     LensTable,
 )
 from .objective import ObjectiveFunction
+from .parameterization import Parameterization
+from .expansion import VoltageExpansion, stencil
+from .noise import VoltageNoise
+from .pareto import nsga2, select_tradeoff
+from .prescreen import Prescreen
+from .progress import EarlyStopping, ProgressBoard, RunStopped
+from .sampling import Sampler, UniformSampler
+from .profiling import (
+    EvaluationProfiler,
+    TRACE_DIR,
+    read_trace,
+    summarize,
+    format_summary,
+)
+from .transfer_map import TransferMap
 
 from pybads import BADS
 
@@ -40,12 +56,36 @@ OBJECTIVE_FILE = FOX_DIR / "objective.txt"
 RAYTRACING_FILE = FOX_DIR / "RaytracingTemplate.fox"
 RECORD_FILE = FOX_DIR / "optimization_record.json"
 
+# displacement of the finite differences, in units of the search space (volts)
+FD_STEP = 1.0
+# tolerance of the gradient free methods of `local_optimize`
+LOCAL_TOL = 1.0
+# methods of `minimize` that take bounds and use the batched gradient, and their option
+# for the gradient tolerance
+GRADIENT_METHODS = {
+    "L-BFGS-B": "gtol",
+    "TNC": "gtol",
+    "SLSQP": None,
+    "trust-constr": "gtol",
+}
+# map elements written by DataGenerationTemplate.fox
+MAP_ELEMENTS = ((1, 1), (1, 2), (1, 111), (1, 112), (1, 122), (1, 222))
+# initial trust region of `expansion_optimize`, in units of the search space (volts)
+EXPANSION_RADIUS = 20.0
+# global optima closer than this in volts count as the same basin in `refine_top_k`
+CANDIDATE_DISTANCE = 10.0
+
 
 class SpeemOptimizer:
     template_file: Path = TEMPLATE_FILE
     objective_file: Path = OBJECTIVE_FILE
     function_file: Path = FUNCTION_FILE
     record_file: Path = RECORD_FILE
+    fox_dir: Path = FOX_DIR
+    profiler: EvaluationProfiler = None
+    parameterization: Parameterization = None
+    voltage_noise: VoltageNoise = None
+    prescreen: Prescreen = None
     raw_template_lines: list[str] = None
     template_lines: list[str] = None
     map_procedure: str = None
@@ -58,8 +98,21 @@ class SpeemOptimizer:
         default_lens_table: LensTable = LensTable(),
         beam_parameters: list[str] = None,
         messenger: "SlackMessenger" = None,
+        fox_dir: Path = FOX_DIR,
+        trace_file: Path | None = TRACE_DIR,
+        parameterization: Parameterization = None,
+        voltage_noise: VoltageNoise = None,
+        prescreen: Prescreen = None,
     ) -> None:
-        os.chdir(FOX_DIR)
+        self.fox_dir = fox_dir
+        os.chdir(fox_dir)
+        self.profiler = EvaluationProfiler(trace_file)
+        self.parameterization = parameterization
+        self.voltage_noise = voltage_noise
+        self.prescreen = prescreen
+        if prescreen is not None:
+            # before any pool copies it, so workers don't each load or build the grid
+            prescreen.load()
         self._default_lens_table = default_lens_table
         self._beam_parameters = beam_parameters
         self.lens_limits = (
@@ -77,7 +130,12 @@ class SpeemOptimizer:
 
     def _update_template(
         self,
+        vector: bool = False,
     ) -> list[str]:
+        """
+        The objective template with the objectives filled in. Its script writes their
+        sum, or with `vector` each objective's value on one line.
+        """
         replacements = []
 
         replacements.append(
@@ -96,10 +154,20 @@ class SpeemOptimizer:
 
         objective_calls = []
         objective_functions = []
-        for objective in self.objectives:
+        for i, objective in enumerate(self.objectives, start=1):
             objective_functions += objective.function
             objective_calls.append(f"GenerateMap voltages sampleZ {objective.endpoint}")
-            objective_calls.append(f"obj:=obj+{objective.call}")
+            if vector:
+                objective_calls.append(f"objVector({i}):={objective.call}")
+            else:
+                objective_calls.append(f"obj:=obj+{objective.call}")
+        if vector:
+            n_objectives = len(self.objectives)
+            objective_functions.insert(0, f"Variable objVector 1 {n_objectives}")
+            write = "&' '&".join(
+                f"S(objVector({i}))" for i in range(1, n_objectives + 1)
+            )
+            replacements.append(("Write 11 S(obj);", f"Write 11 {write}"))
         replacements.append(("OBJECTIVE_FUNCTIONS;", objective_functions))
         replacements.append(("OBJECTIVE;", objective_calls))
 
@@ -153,94 +221,563 @@ class SpeemOptimizer:
         self._beam_parameters = beam_parameters
         self.template_lines = self._update_template()
 
+    @property
+    def search_space(self) -> Parameterization:
+        """
+        What the optimizers search over: `parameterization`, or every electrode of
+        `lens_limits` on its own.
+        """
+        if self.parameterization is None:
+            return Parameterization.identity(self.lens_limits)
+        return self.parameterization
+
     def objective(
         self, table_values: np.ndarray | list, process_id: int = None
     ) -> float:
         if isinstance(table_values, list):
             table_values = np.array(table_values)
+        if self.voltage_noise is not None:
+            return float(
+                self.batch_objective(table_values, self.voltage_noise.n_processes)[0]
+            )
 
-        start = time.perf_counter()
+        if self.prescreen is not None:
+            full_lens_table = self._full_lens_table(table_values)
+            if not self._passes_prescreen(full_lens_table):
+                return self.prescreen.penalty
 
-        lens_table = LensTable(
-            zip(list(self.lens_limits.keys()), table_values.flatten())
-        )
+        self.profiler.begin()
+
+        lens_table = self.search_space.lens_table(table_values)
         # print(f"{Fore.RED}{lens_table}{Style.RESET_ALL}")
 
+        process_id = self._free_process_id(process_id)
+        curr_objective_file = process_file(
+            process_id, self.objective_file, self.fox_dir
+        )
+        curr_function_file = process_file(process_id, self.function_file, self.fox_dir)
+
+        with self.profiler.stage("render"):
+            function_lines = self._render_function_lines(
+                process_id, lens_table, self.template_lines
+            )
+        with self.profiler.stage("write"):
+            # prepping objective output file in case cosy crashes and outputs nothing
+            with open(curr_objective_file, "wt") as f:
+                f.write("1e9")
+            with open(curr_function_file, "wt") as f:
+                f.writelines(function_lines)
+
+        with self.profiler.stage("spawn"):
+            process = subprocess.Popen(
+                ["cosy", curr_function_file.name],
+                stdout=subprocess.DEVNULL,
+                cwd=self.fox_dir,
+            )
+        with self.profiler.stage("compute"):
+            try:
+                process.wait(timeout=900)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        with self.profiler.stage("parse"):
+            with open(curr_objective_file, "rt") as f:
+                obj = float(f.readline())
+
+        with self.profiler.stage("cleanup"):
+            try:
+                os.remove(curr_objective_file)
+            except FileNotFoundError:
+                pass
+            try:
+                os.remove(curr_function_file)
+            except FileNotFoundError:
+                pass
+
+        self.profiler.end(process_id=process_id, objective=obj)
+        if self.prescreen is not None:
+            self.prescreen.observe(full_lens_table, obj)
+        return obj
+
+    def EGO_objective(self, table_values: np.ndarray):
+        return [self.objective(table_values)]
+
+    def _free_process_id(self, process_id: int = None) -> int:
+        """`process_id`, or a random id, whose objective and function files are free."""
         # this should prevent race conditions regardless of the number of processes
         if process_id is None:
             process_id = random.randrange(0, int(1e4))
-        curr_objective_file = process_file(process_id, self.objective_file)
-        curr_function_file = process_file(process_id, self.function_file)
         for _ in range(3):
-            if curr_objective_file.exists() or curr_function_file.exists():
+            if (
+                process_file(process_id, self.objective_file, self.fox_dir).exists()
+                or process_file(process_id, self.function_file, self.fox_dir).exists()
+            ):
                 process_id = random.randrange(0, int(1e4))
-                curr_objective_file = process_file(process_id, self.objective_file)
-                curr_function_file = process_file(process_id, self.function_file)
             else:
                 break
+        return process_id
+
+    def batch_objective(
+        self, table_values: np.ndarray, n_processes: int = 1, screen: bool = True
+    ) -> np.ndarray:
+        """
+        The objectives of many points (n_points, n_parameters) of the search space.
+        Instead of a COSY run per point, the points are split into `n_processes`
+        batches which each take a single run, so Init and ReadFiles happen once per
+        batch. Points that make COSY fail get 1e9 like in `objective`.
+
+        With `voltage_noise`, every point is evaluated under its perturbations and
+        gets their aggregate. Points `prescreen` rejects get its penalty without COSY,
+        unless `screen` is False.
+        """
+        points = np.atleast_2d(table_values)
+        passed, full_lens_tables = self._prescreen_points(points, screen)
+        objectives = np.full(len(points), np.nan)
+        if not passed.all():
+            objectives[~passed] = self.prescreen.penalty
+        if not passed.any():
+            return objectives
+
+        if self.voltage_noise is None:
+            objectives[passed] = self._evaluate_batches(
+                points[passed], self.template_lines, 1, 1e9, n_processes
+            )[:, 0]
+        else:
+            lens_tables = [
+                lens_table
+                for point in points[passed]
+                for lens_table in self.voltage_noise.perturb(
+                    self._full_lens_table(point)
+                )
+            ]
+            noisy_objectives = self._evaluate_lens_tables(
+                lens_tables, self.template_lines, 1, 1e9, n_processes
+            )
+            objectives[passed] = [
+                self.voltage_noise.combine(point_objectives)
+                for point_objectives in noisy_objectives.reshape(passed.sum(), -1)
+            ]
+
+        if self.prescreen is not None:
+            if self.voltage_noise is None:
+                evaluated = [
+                    (full_lens_tables[i], objectives[i]) for i in np.flatnonzero(passed)
+                ]
+            else:
+                # the aggregate hides or smears failures, so each perturbation is
+                # learned with its own outcome
+                evaluated = zip(lens_tables, noisy_objectives.ravel())
+            for lens_table, objective in evaluated:
+                self.prescreen.observe(lens_table, objective)
+        return objectives
+
+    def _prescreen_points(
+        self, points: np.ndarray, screen: bool = True
+    ) -> tuple[np.ndarray, list[LensTable] | None]:
+        """
+        Which `points` pass `prescreen`, all of them without one or `screen`, and
+        their full lens tables for `Prescreen.observe`.
+        """
+        if self.prescreen is None:
+            return np.ones(len(points), dtype=bool), None
+        full_lens_tables = [self._full_lens_table(point) for point in points]
+        if not screen:
+            return np.ones(len(points), dtype=bool), full_lens_tables
+        passed = np.array(
+            [self._passes_prescreen(lens_table) for lens_table in full_lens_tables]
+        )
+        return passed, full_lens_tables
+
+    def _n_observed(self) -> int:
+        return 0 if self.prescreen is None else self.prescreen.n_observed
+
+    def _observed_since(self, start: int) -> tuple | None:
+        """What this copy's prescreen learned, for the main process to merge."""
+        return None if self.prescreen is None else self.prescreen.observed(start)
+
+    def _merge_observed(self, observed: list) -> None:
+        if self.prescreen is not None:
+            for worker_observed in observed:
+                self.prescreen.learn(worker_observed)
+
+    def _passes_prescreen(self, lens_table: LensTable) -> bool:
+        """Whether COSY should run `lens_table`, tracing the reason if it shouldn't."""
+        reason = self.prescreen.reject(lens_table)
+        if reason is not None:
+            self.profiler.record("prescreen", reason=reason)
+        return reason is None
+
+    def objective_vectors(
+        self, table_values: np.ndarray, n_processes: int = 1
+    ) -> np.ndarray:
+        """
+        Every objective's value, without summing them, at points (n_points,
+        n_parameters) of the search space as (n_points, n_objectives). Evaluated in
+        batches like `batch_objective`, without `voltage_noise`. Points `prescreen`
+        rejects get its penalty for every objective.
+        """
+        points = np.atleast_2d(table_values)
+        passed, full_lens_tables = self._prescreen_points(points)
+        vectors = np.full((len(points), len(self.objectives)), np.nan)
+        if not passed.all():
+            vectors[~passed] = self.prescreen.penalty
+        if not passed.any():
+            return vectors
+
+        vectors[passed] = self._evaluate_batches(
+            points[passed],
+            self._update_template(vector=True),
+            len(self.objectives),
+            1e9,
+            n_processes,
+        )
+        if self.prescreen is not None:
+            for i in np.flatnonzero(passed):
+                self.prescreen.observe(full_lens_tables[i], vectors[i].max())
+        return vectors
+
+    def objective_and_gradient(
+        self,
+        table_values: np.ndarray,
+        step: float | np.ndarray = FD_STEP,
+        n_processes: int = 1,
+    ) -> tuple[float, np.ndarray]:
+        """
+        The objective at a point of the search space and its gradient from central
+        differences. The point and its 2 * n_parameters displacements by `step` are
+        evaluated together with `batch_objective`. Displacements stop at the bounds,
+        which makes the differences there one-sided. Only the point itself is
+        pre-screened: a rejected point gets the penalty and no gradient, and the
+        displacements always run so the penalty can't swamp the differences.
+        """
+        if self.prescreen is not None and not self._passes_prescreen(
+            self._full_lens_table(table_values)
+        ):
+            return self.prescreen.penalty, np.zeros(np.size(table_values))
+        points, widths = self._difference_points(table_values, step)
+        objectives = self.batch_objective(points, n_processes, screen=False)
+        return float(objectives[0]), self._differences(objectives, widths)
+
+    def gradient(
+        self,
+        table_values: np.ndarray,
+        step: float | np.ndarray = FD_STEP,
+        n_processes: int = 1,
+    ) -> np.ndarray:
+        return self.objective_and_gradient(table_values, step, n_processes)[1]
+
+    def map_jacobian(
+        self,
+        table_values: np.ndarray = None,
+        endpoint: str = "detZ",
+        elements: tuple[tuple[int, int], ...] = MAP_ELEMENTS,
+        step: float | np.ndarray = FD_STEP,
+        n_processes: int = 1,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Sensitivities of map elements to the parameters of the search space, from
+        central differences evaluated in batches like `objective_and_gradient`.
 
-        # prepping objective output file in case cosy crashes and outputs nothing
-        with open(curr_objective_file, "wt") as f:
-            f.write("1e9")
+        Args
+        ----
+        table_values : np.ndarray
+            Point of the search space. Defaults to `default_lens_table`.
+        endpoint : str
+            The map from sampleZ to this position is used.
+        elements : tuple[tuple[int, int], ...]
+            (i, j) of the elements MA(i,j), e.g. (1, 122) for (x|aa).
+
+        Returns
+        -------
+        values : np.ndarray
+            The elements at the point, (n_elements,).
+        jacobian : np.ndarray
+            Their derivatives, (n_elements, n_parameters). Elements COSY fails to
+            compute are NaN.
+        """
+        if table_values is None:
+            table_values = self.search_space.parameters(self.default_lens_table)
+        template_lines = self._map_template_lines(
+            endpoint, [f"MA({i},{j})" for i, j in elements]
+        )
 
-        self._prep_function_file(
-            process_id,
-            lens_table,
-            template_lines=self.template_lines,
-            destination_file=curr_function_file,
+        points, widths = self._difference_points(table_values, step)
+        values = self._evaluate_batches(
+            points, template_lines, len(elements), np.nan, n_processes
         )
-        try:
-            subprocess.call(
-                ["cosy", curr_function_file.name],
-                stdout=open(os.devnull, "wb"),
-                timeout=900,
+        return values[0], self._differences(values, widths).T
+
+    def voltage_expansions(
+        self,
+        table_values: np.ndarray = None,
+        radius: float | np.ndarray = EXPANSION_RADIUS,
+        n_processes: int = 1,
+    ) -> dict[str, VoltageExpansion]:
+        """
+        Quadratic expansions in the parameters of the search space of the map
+        elements and constants the objectives use, one per endpoint. Each is fit to
+        the points of a `stencil` `radius` wide around `table_values` (default
+        `default_lens_table`), evaluated in a batch like `batch_objective`.
+        """
+        if table_values is None:
+            table_values = self.search_space.parameters(self.default_lens_table)
+        outputs = {}
+        for objective in self.objectives:
+            keys = outputs.setdefault(objective.endpoint, [])
+            keys += [
+                key
+                for key in objective.elements + objective.constants
+                if key not in keys
+            ]
+
+        points = stencil(table_values, radius, self.search_space.bounds)
+        expansions = {}
+        for endpoint, keys in outputs.items():
+            template_lines = self._map_template_lines(
+                endpoint,
+                [
+                    f"MA({key[0]},{key[1]})" if isinstance(key, tuple) else key
+                    for key in keys
+                ],
+            )
+            values = self._evaluate_batches(
+                points, template_lines, len(keys), np.nan, n_processes
             )
-        except subprocess.TimeoutExpired:
-            pass
-        with open(curr_objective_file, "rt") as f:
-            obj = float(f.readline())
+            expansions[endpoint] = VoltageExpansion.fit(
+                table_values, radius, points, values, keys, endpoint
+            )
+        return expansions
 
-        try:
-            os.remove(curr_objective_file)
-        except FileNotFoundError:
-            pass
-        try:
-            os.remove(curr_function_file)
-        except FileNotFoundError:
-            pass
+    def _expansion_objective(
+        self, expansions: dict[str, VoltageExpansion], table_values: np.ndarray
+    ) -> float:
+        """The objective like COSY computes it, from `voltage_expansions`."""
+        return sum(
+            expansions[objective.endpoint].evaluate(objective, table_values)
+            for objective in self.objectives
+        )
 
-        end = time.perf_counter()
-        # print(
-        #  f"{Fore.GREEN}{process_id} obj: {obj:.2e} with {lens_table} in "
-        #  f"{str(timedelta(seconds=end-start))[2:7]}{Style.RESET_ALL}"
-        # )
-        return obj
+    def _map_template_lines(self, endpoint: str, outputs: list[str]) -> list[str]:
+        """Template lines that write the FOX expressions `outputs` at `endpoint`."""
+        write = "&' '&".join(f"S({output})" for output in outputs)
+        return edit_lines(
+            [
+                (f"{lens_name}:=", f"{lens_name}:={voltage}")
+                for lens_name, voltage in self.default_lens_table.items()
+            ]
+            + [
+                ("OBJECTIVE_FUNCTIONS;", None),
+                (
+                    "BEAMREDEFINITIONS",
+                    (
+                        self.beam_parameters + ["RedefineBeam"]
+                        if self.beam_parameters is not None
+                        else None
+                    ),
+                ),
+                ("OBJECTIVE;", f"GenerateMap voltages sampleZ {endpoint}"),
+                ("Write 11 S(obj);", f"Write 11 {write}"),
+            ],
+            self.raw_template_lines,
+        )
 
-    def EGO_objective(self, table_values: np.ndarray):
-        return [self.objective(table_values)]
+    def _difference_points(
+        self, table_values: np.ndarray, step: float | np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The point followed by its displacements up and down along every parameter,
+        within the bounds, and the distance between each pair of displacements.
+        """
+        x = np.asarray(table_values, dtype=float)
+        bounds = self.search_space.bounds
+        displacements = np.diag(np.broadcast_to(step, x.shape).astype(float))
+        upper = np.minimum(x + displacements, bounds[:, 1])
+        lower = np.maximum(x - displacements, bounds[:, 0])
+        return np.vstack([x, upper, lower]), np.diag(upper - lower)
+
+    @staticmethod
+    def _differences(values: np.ndarray, widths: np.ndarray) -> np.ndarray:
+        """Central differences of the values at the points of `_difference_points`."""
+        n_parameters = len(widths)
+        upper = values[1 : n_parameters + 1]
+        lower = values[n_parameters + 1 :]
+        widths = widths.reshape((-1,) + (1,) * (np.ndim(values) - 1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(widths > 0, (upper - lower) / widths, 0.0)
+
+    def _evaluate_batches(
+        self,
+        table_values: np.ndarray,
+        template_lines: list[str],
+        n_values: int,
+        fill_value: float,
+        n_processes: int,
+    ) -> np.ndarray:
+        """The values written for points of the search space."""
+        search_space = self.search_space
+        lens_tables = [
+            search_space.lens_table(point) for point in np.atleast_2d(table_values)
+        ]
+        return self._evaluate_lens_tables(
+            lens_tables, template_lines, n_values, fill_value, n_processes
+        )
+
+    def _evaluate_lens_tables(
+        self,
+        lens_tables: list[dict],
+        template_lines: list[str],
+        n_values: int,
+        fill_value: float,
+        n_processes: int,
+    ) -> np.ndarray:
+        """The values written for `lens_tables`, from `n_processes` parallel batches."""
+        n_batches = max(1, min(n_processes, len(lens_tables)))
+        if pathos_mp.current_process().daemon:
+            # workers of a pool, e.g. in `global_optimize`, can't start one of their own
+            n_batches = 1
+        if n_batches == 1:
+            return self._run_batch(lens_tables, template_lines, n_values, fill_value)
+
+        edges = np.linspace(0, len(lens_tables), n_batches + 1).astype(int)
+        batches = [lens_tables[start:end] for start, end in zip(edges, edges[1:])]
+        with ProcessingPool(processes=n_batches) as pool:
+            results = pool.map(
+                lambda batch: self._run_batch(
+                    batch, template_lines, n_values, fill_value
+                ),
+                batches,
+            )
+        return np.concatenate(results)
+
+    def _run_batch(
+        self,
+        lens_tables: list[dict],
+        template_lines: list[str],
+        n_values: int,
+        fill_value: float,
+    ) -> np.ndarray:
+        """
+        Evaluate `lens_tables` in as few COSY runs as possible and return the
+        `n_values` numbers written for each as an (n_tables, n_values) array. When a
+        run crashes or times out, the table it stopped at gets `fill_value` and the
+        tables after it go into another run.
+        """
+        values = np.full((len(lens_tables), n_values), fill_value, dtype=float)
+        start = 0
+        while start < len(lens_tables):
+            batch = lens_tables[start:]
+            self.profiler.begin()
+            process_id = self._free_process_id()
+            output_file = process_file(process_id, self.objective_file, self.fox_dir)
+            function_file = process_file(process_id, self.function_file, self.fox_dir)
+
+            with self.profiler.stage("render"):
+                function_lines = self._render_batch_lines(
+                    process_id, batch, template_lines
+                )
+            with self.profiler.stage("write"):
+                with open(function_file, "wt") as f:
+                    f.writelines(function_lines)
+            with self.profiler.stage("spawn"):
+                process = subprocess.Popen(
+                    ["cosy", function_file.name],
+                    stdout=subprocess.DEVNULL,
+                    cwd=self.fox_dir,
+                )
+            with self.profiler.stage("compute"):
+                try:
+                    process.wait(timeout=900 * len(batch))
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+            with self.profiler.stage("parse"):
+                rows = self._read_batch_output(output_file, n_values)
+            with self.profiler.stage("cleanup"):
+                for file in (output_file, function_file):
+                    try:
+                        os.remove(file)
+                    except FileNotFoundError:
+                        pass
+
+            if rows:
+                values[start : start + len(rows)] = rows
+            self.profiler.end(
+                process_id=process_id, tables=len(batch), completed=len(rows)
+            )
+            # skip the table the run stopped at
+            start += len(rows) + 1
+        return values
 
     @staticmethod
-    def _prep_function_file(
+    def _render_batch_lines(
         process_id: int,
-        lens_table: dict,
-        template_lines: list[str] = None,
-        destination_file: Path = FUNCTION_FILE,
-    ) -> None:
+        lens_tables: list[dict],
+        template_lines: list[str],
+    ) -> list[str]:
         """
-        Preps function file for each process using a specified process id
+        A script that repeats the part of `template_lines` from setting the voltages
+        to writing the result for every lens table, all into objective_<id>.txt.
         """
+        stripped = [line.strip() for line in template_lines]
+
+        def find(prefix: str) -> int:
+            return next(i for i, line in enumerate(stripped) if line.startswith(prefix))
+
+        start, open_index, close_index = (
+            find("baseline:="),
+            find("OpenF 11"),
+            find("CloseF 11"),
+        )
+        block = (
+            template_lines[start:open_index]
+            + template_lines[open_index + 1 : close_index]
+        )
+
+        lines = template_lines[:start] + [
+            f"OpenF 11 'objective_{process_id}.txt' 'UNKNOWN';\n"
+        ]
+        for lens_table in lens_tables:
+            lines += edit_lines(
+                [
+                    (f"{lens_name}:=", f"{lens_name}:={voltage}")
+                    for lens_name, voltage in lens_table.items()
+                ],
+                block,
+            )
+        return lines + template_lines[close_index:]
+
+    @staticmethod
+    def _read_batch_output(output_file: Path, n_values: int) -> list[list[float]]:
+        """The complete lines of a batch's output, up to the first incomplete one."""
+        rows = []
+        try:
+            with open(output_file, "rt") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return rows
+        for line in lines:
+            try:
+                row = [float(value) for value in line.replace(",", " ").split()]
+            except ValueError:
+                break
+            if len(row) != n_values:
+                break
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def _render_function_lines(
+        process_id: int,
+        lens_table: dict,
+        template_lines: list[str],
+    ) -> list[str]:
         identifiers = ["OpenF 11 'OBJECTIVE.txt'"] + [
             f"{lens_name}:=" for lens_name in lens_table.keys()
         ]
         replacements = [f"OpenF 11 'objective_{process_id}.txt' 'UNKNOWN'"] + [
             f"{lens_name}:={voltage}" for lens_name, voltage in lens_table.items()
         ]
-
-        create_file_from_template(
-            list(zip(identifiers, replacements)),
-            template_lines=template_lines,
-            filepath=destination_file,
-        )
+        return edit_lines(list(zip(identifiers, replacements)), template_lines)
 
     def _get_aberrations(self, lens_table: LensTable) -> list[str]:
         process_id = random.randrange(0, int(1e4))
@@ -268,12 +805,13 @@ class SpeemOptimizer:
         for objective in self.objectives:
             # avoid reading old files if call fails
             try:
-                os.remove(aberrations_file)
+                os.remove(self.fox_dir / aberrations_file)
             except OSError:
                 pass
 
             filepath = (
-                FOX_DIR / f"Aberrations_Temp_{objective.endpoint}_{process_id}.fox"
+                self.fox_dir
+                / f"Aberrations_Temp_{objective.endpoint}_{process_id}.fox"
             )
             print(f"Getting aberrations at {objective.endpoint}.")
             identifiers = common_identifiers + [f"OBJECTIVE;"]
@@ -285,9 +823,13 @@ class SpeemOptimizer:
                 template_lines=self.raw_template_lines,
                 filepath=filepath,
             )
-            subprocess.call(["cosy", filepath.name], stdout=open(os.devnull, "wb"))
+            subprocess.call(
+                ["cosy", filepath.name],
+                stdout=open(os.devnull, "wb"),
+                cwd=self.fox_dir,
+            )
             os.remove(filepath)
-            with open(aberrations_file, "rt") as f:
+            with open(self.fox_dir / aberrations_file, "rt") as f:
                 aberrations[objective.endpoint] = self._format_aberrations(f)
 
         return aberrations
@@ -307,13 +849,39 @@ class SpeemOptimizer:
 
         return all_aberrations
 
+    def transfer_maps(
+        self, lens_table: LensTable = None, directory: Path = None
+    ) -> dict[str, TransferMap]:
+        """
+        The transfer maps to the endpoint of each objective for `lens_table`, from a
+        single COSY run per endpoint. With `directory` they're also saved there as
+        map_<endpoint>.npz.
+        """
+        lens_table = self.default_lens_table if lens_table is None else lens_table
+        maps = {
+            endpoint: TransferMap.from_aberrations(aberrations, endpoint, lens_table)
+            for endpoint, aberrations in self._get_aberrations(lens_table).items()
+        }
+        if directory is not None:
+            directory.mkdir(parents=True, exist_ok=True)
+            for endpoint, transfer_map in maps.items():
+                transfer_map.save(directory / f"map_{endpoint}.npz")
+        return maps
+
     def _objective_parameters(self) -> dict:
-        return {
+        parameters = {
             "default_lens_table": self.default_lens_table,
             "lens_limits": self.lens_limits,
             "beam_parameters": self.beam_parameters,
             "objectives": [asdict(objective) for objective in self.objectives],
         }
+        if self.parameterization is not None:
+            parameters["parameterization"] = self.parameterization.to_dict()
+        if self.voltage_noise is not None:
+            parameters["voltage_noise"] = self.voltage_noise.to_dict()
+        if self.prescreen is not None:
+            parameters["prescreen"] = self.prescreen.to_dict()
+        return parameters
 
     def _update_record(
         self,
@@ -321,6 +889,7 @@ class SpeemOptimizer:
         optimal_lens_table: LensTable,
         optimization_type: str,
         all_optimal_objectives: list[float] | None = None,
+        all_optimal_lens_tables: list[LensTable] | None = None,
     ) -> None:
         optimization_record = self._objective_parameters()
         optimization_record["optimal_objective"] = optimal_objective
@@ -329,8 +898,20 @@ class SpeemOptimizer:
         optimization_record["optimization_type"] = optimization_type
         if all_optimal_objectives is not None:
             optimization_record["all_optimal_objectives"] = all_optimal_objectives
+        if all_optimal_lens_tables is not None:
+            optimization_record["all_optimal_lens_tables"] = all_optimal_lens_tables
         self.record.append(optimization_record)
 
+    def _report_timing(self, since: float) -> dict:
+        """Summarize the evaluations traced since `since` into the last record."""
+        summary = summarize(
+            read_trace(self.profiler.trace_file, since=since, run=self.profiler.run_id)
+        )
+        print(format_summary(summary))
+        if self.record:
+            self.record[-1]["timing"] = summary
+        return summary
+
     def save_record(self, id: int = None) -> None:
         output = json.dumps(self.record, indent=4)
 
@@ -391,12 +972,21 @@ class SpeemOptimizer:
             full optimization time by running more processes up to the limit of your
             cpu. Running too many processes can slow each one down enough to cause
             timeouts and ruin the optimization.
+        plausible_limits: dict
+            Plausible range of each parameter of the search space. Defaults to all but
+            5% at either end of its bounds.
+        bads_options: dict
+            Extra options for BADS, e.g. {"max_fun_evals": 200} for shorter runs.
+        early_stopping: EarlyStopping
+            Stop runs that lag far behind the best one and start fresh runs instead.
         """
-        voltage_limits = np.array(list(self.lens_limits.values()))
+        search_space = self.search_space
+        voltage_limits = search_space.bounds
 
         hard_lower_bounds = voltage_limits[:, 0]
         hard_upper_bounds = voltage_limits[:, 1]
 
+        bads_options: dict = kwargs.get("bads_options", {})
         plausible_bounds: dict = kwargs.get("plausible_limits", None)
         if plausible_bounds is None:
             bound_widths = hard_upper_bounds - hard_lower_bounds
@@ -407,11 +997,33 @@ class SpeemOptimizer:
             plausible_lower_bounds = plausible_bounds[:, 0]
             plausible_upper_bounds = plausible_bounds[:, 1]
 
-        def worker(process_id: int | None = None):
-            start = time.perf_counter()
-            print(f"starting worker {process_id}")
+        early_stopping: EarlyStopping = kwargs.get("early_stopping", None)
+        board = None
+        if early_stopping is not None:
+            board = ProgressBoard(
+                self.fox_dir / f"progress_{os.getpid()}_{random.randrange(int(1e6))}"
+            )
+
+        def run(run_id: int) -> tuple[float, np.ndarray, bool]:
+            """One BADS run: its best objective and point and whether it was stopped."""
+            evaluations = 0
+            best, best_table_values = np.inf, None
+
+            def fun(table_values: np.ndarray) -> float:
+                nonlocal evaluations, best, best_table_values
+                objective = self.objective(table_values)
+                evaluations += 1
+                if objective < best:
+                    best, best_table_values = objective, np.array(table_values)
+                if board is not None and evaluations % early_stopping.check_every == 0:
+                    board.post(run_id, evaluations, best)
+                    leader = board.leader(exclude=run_id)
+                    if early_stopping.lagging(evaluations, best, leader):
+                        raise RunStopped
+                return objective
+
             bads = BADS(
-                fun=lambda x: self.objective(x),
+                fun=fun,
                 lower_bounds=voltage_limits[:, 0],
                 upper_bounds=voltage_limits[:, 1],
                 plausible_lower_bounds=plausible_lower_bounds,
@@ -420,22 +1032,54 @@ class SpeemOptimizer:
                     "display": "off",
                     "uncertainty_handling": False,
                     "random_seed": random.randint(0, int(1e9)),
+                    **bads_options,
                 },
             )
-            result: "OptimizeResult" = bads.optimize()
-            optimal_objective = result.fval
-            optimal_lens_table = result.x
-            print(
-                f"run {process_id} done with obj={optimal_objective} in "
-                f"{str(timedelta(seconds=(time.perf_counter()-start)))}"
-            )
-            return optimal_objective, optimal_lens_table
-
-        with ProcessingPool(processes=n_processes) as pool:
-            async_result = pool.amap(worker, range(n_runs))
-            results = async_result.get()
-
-        optimal_objectives, optimal_lens_tables = zip(*results)
+            try:
+                result: "OptimizeResult" = bads.optimize()
+            except RunStopped:
+                print(f"run {run_id} stopped after {evaluations} evaluations")
+                return best, best_table_values, True
+            if board is not None:
+                board.post(run_id, evaluations, result.fval)
+            return result.fval, result.x, False
+
+        def worker(process_id: int | None = None, submitted: float = None):
+            if submitted is not None:
+                self.profiler.record(
+                    "queue", run=process_id, delay=time.time() - submitted
+                )
+            print(f"starting worker {process_id}")
+            run_id = process_id
+            results = []
+            while run_id is not None:
+                start = time.perf_counter()
+                optimal_objective, optimal_lens_table, stopped = run(run_id)
+                results.append((run_id, optimal_objective, optimal_lens_table, stopped))
+                print(
+                    f"run {run_id} done with obj={optimal_objective} in "
+                    f"{str(timedelta(seconds=(time.perf_counter()-start)))}"
+                )
+                # a stopped run's process starts a fresh one while restarts are left
+                run_id = None
+                if stopped:
+                    restart = board.claim_restart(early_stopping.max_restarts)
+                    run_id = None if restart is None else n_runs + restart
+            return results, self._observed_since(n_observed)
+
+        n_observed = self._n_observed()
+        run_start = time.time()
+        try:
+            with ProcessingPool(processes=n_processes) as pool:
+                async_result = pool.amap(worker, range(n_runs), [run_start] * n_runs)
+                worker_results = async_result.get()
+        finally:
+            if board is not None:
+                board.clear()
+        self._merge_observed([observed for _, observed in worker_results])
+        results = [result for results, _ in worker_results for result in results]
+
+        run_ids, optimal_objectives, optimal_lens_tables, stopped = zip(*results)
         optimal_objectives = list(optimal_objectives)
         optimal_lens_tables = list(optimal_lens_tables)
         print("optimal_objectives:")
@@ -445,9 +1089,7 @@ class SpeemOptimizer:
 
         optimal_objective = optimal_objectives[min_index]
         optimal_lens_table = optimal_lens_tables[min_index]
-        optimal_lens_table = LensTable(
-            zip(list(self.lens_limits.keys()), optimal_lens_table)
-        )
+        optimal_lens_table = search_space.lens_table(optimal_lens_table)
 
         full_optimal_lens_table = deepcopy(self.default_lens_table)
         full_optimal_lens_table.update(optimal_lens_table)
@@ -457,7 +1099,17 @@ class SpeemOptimizer:
             full_optimal_lens_table,
             "global",
             all_optimal_objectives=optimal_objectives,
+            all_optimal_lens_tables=[
+                self._full_lens_table(table_values)
+                for table_values in optimal_lens_tables
+            ],
         )
+        if early_stopping is not None:
+            self.record[-1]["early_stopping"] = early_stopping.to_dict()
+            self.record[-1]["stopped_runs"] = [
+                run_id for run_id, run_stopped in zip(run_ids, stopped) if run_stopped
+            ]
+        self._report_timing(run_start)
         self.default_lens_table = full_optimal_lens_table
         print(f"best objective: {optimal_objective} achieved with {optimal_lens_table}")
 
@@ -472,28 +1124,45 @@ class SpeemOptimizer:
     def local_optimize(
         self,
         method: str = "Nelder-Mead",
-        tol: float = 1.0,
+        tol: float = None,
         max_iter: int = None,
+        gradient_step: float | np.ndarray = FD_STEP,
+        n_processes: int = 1,
     ) -> None:
-        starting_point = []
-        for lens_name in self.lens_limits.keys():
-            starting_point.append(self.default_lens_table[lens_name])
+        """
+        Refine `default_lens_table` with `scipy.optimize.minimize`.
 
-        result = minimize(
-            self.objective,
-            starting_point,
-            method=method,
-            tol=tol,
-            bounds=list(self.lens_limits.values()),
-            options={"maxiter": max_iter},
+        Args
+        ----
+        method: str
+            Any method of `minimize` that takes bounds. Those in GRADIENT_METHODS,
+            e.g. "L-BFGS-B", get the gradient from `objective_and_gradient`.
+        tol: float
+            Tolerance passed to `minimize`, LOCAL_TOL if None. Gradient methods
+            instead stop once the projected gradient is below it, and keep the
+            defaults of `minimize` if it's None. SLSQP always keeps them.
+        max_iter: int
+            Maximum number of iterations.
+        gradient_step: float | np.ndarray
+            Finite difference step of the gradient methods, per parameter if an array.
+        n_processes: int
+            Parallel COSY runs the points of each gradient are split into.
+        """
+        search_space = self.search_space
+        starting_point = search_space.parameters(self.default_lens_table)
+
+        run_start = time.time()
+        result = self._minimize(
+            starting_point, method, tol, max_iter, gradient_step, n_processes
         )
         optimal_objective = result["fun"]
-        optimal_lens_table = LensTable(zip(list(self.lens_limits.keys()), result["x"]))
+        optimal_lens_table = search_space.lens_table(result["x"])
         full_optimal_lens_table = deepcopy(self.default_lens_table)
         full_optimal_lens_table.update(optimal_lens_table)
         self._update_record(
             optimal_objective, full_optimal_lens_table, f"local-{method}"
         )
+        self._report_timing(run_start)
         self.default_lens_table = full_optimal_lens_table
         print(
             f"{optimal_objective:.3e} achieved with final lens table: "
@@ -506,21 +1175,389 @@ class SpeemOptimizer:
                 f"achieved with {optimal_lens_table}"
             )
 
-    def generate_data_for_metric(self, n: int, filename: str) -> None:
+    def _minimize(
+        self,
+        starting_point: np.ndarray,
+        method: str,
+        tol: float | None,
+        max_iter: int | None,
+        gradient_step: float | np.ndarray,
+        n_processes: int,
+    ) -> "OptimizeResult":
+        """`minimize` the objective over the search space, see `local_optimize`."""
+        fun, jac = self.objective, None
+        # not every method accepts maxiter=None
+        options = {} if max_iter is None else {"maxiter": max_iter}
+        if method in GRADIENT_METHODS:
+            jac = True
+            fun = lambda x: self.objective_and_gradient(x, gradient_step, n_processes)
+            # `tol` would set their ftol, where LOCAL_TOL stops them right away
+            if tol is not None and GRADIENT_METHODS[method] is not None:
+                options[GRADIENT_METHODS[method]] = tol
+            tol = None
+        elif tol is None:
+            tol = LOCAL_TOL
+        return minimize(
+            fun,
+            starting_point,
+            method=method,
+            jac=jac,
+            tol=tol,
+            bounds=self.search_space.bounds.tolist(),
+            options=options,
+        )
+
+    def _full_lens_table(self, table_values: np.ndarray) -> LensTable:
+        """`default_lens_table` with the voltages of a point of the search space."""
+        lens_table = deepcopy(self.default_lens_table)
+        lens_table.update(self.search_space.lens_table(table_values))
+        return lens_table
+
+    def top_candidates(
+        self,
+        k: int = 3,
+        min_distance: float = CANDIDATE_DISTANCE,
+        record: dict = None,
+    ) -> list[tuple[float, LensTable]]:
+        """
+        The `k` best optima of a global optimization record (default the last one in
+        `record`) that are at least `min_distance` volts apart over the electrodes of
+        the search space, as (objective, lens table) from best to worst.
+        """
+        if record is None:
+            record = next(
+                (
+                    record
+                    for record in reversed(self.record)
+                    if "all_optimal_lens_tables" in record
+                ),
+                None,
+            )
+        if record is None:
+            raise ValueError("no global optimization with all its optima recorded")
+
+        electrodes = self.search_space.electrodes
+        candidates = sorted(
+            zip(record["all_optimal_objectives"], record["all_optimal_lens_tables"]),
+            key=lambda candidate: candidate[0],
+        )
+        selected = []
+        for objective, lens_table in candidates:
+            voltages = np.array([lens_table[name] for name in electrodes])
+            if all(
+                np.linalg.norm(voltages - other) >= min_distance
+                for *_, other in selected
+            ):
+                selected.append((objective, LensTable(lens_table), voltages))
+            if len(selected) == k:
+                break
+        return [(objective, lens_table) for objective, lens_table, _ in selected]
+
+    def refine_top_k(
+        self,
+        k: int = 3,
+        min_distance: float = CANDIDATE_DISTANCE,
+        method: str = "Nelder-Mead",
+        tol: float = None,
+        max_iter: int = None,
+        gradient_step: float | np.ndarray = FD_STEP,
+        n_processes: int = None,
+        record: dict = None,
+    ) -> None:
+        """
+        Refine the `k` best distinct optima of a global optimization at the same time
+        and keep the best result. Lower ranked basins often refine better than the
+        best one.
+
+        Args
+        ----
+        k: int
+            Number of optima to refine, see `top_candidates`.
+        min_distance: float
+            Optima closer than this in volts count as one.
+        method, tol, max_iter, gradient_step:
+            As in `local_optimize`.
+        n_processes: int
+            Refinements running in parallel. Defaults to one per optimum.
+        record: dict
+            Global optimization record with "all_optimal_lens_tables". Defaults to the
+            last one in `record`.
+        """
+        candidates = self.top_candidates(k, min_distance, record)
+        search_space = self.search_space
+        n_processes = len(candidates) if n_processes is None else n_processes
+
+        def worker(process_id: int, lens_table: LensTable, submitted: float):
+            self.profiler.record(
+                "queue", run=process_id, delay=time.time() - submitted
+            )
+            start = time.perf_counter()
+            result = self._minimize(
+                search_space.parameters(lens_table),
+                method,
+                tol,
+                max_iter,
+                gradient_step,
+                1,
+            )
+            print(
+                f"candidate {process_id} refined to obj={result['fun']} in "
+                f"{str(timedelta(seconds=(time.perf_counter()-start)))}"
+            )
+            return float(result["fun"]), result["x"], self._observed_since(n_observed)
+
+        n_observed = self._n_observed()
+        run_start = time.time()
+        with ProcessingPool(processes=n_processes) as pool:
+            results = pool.amap(
+                worker,
+                range(len(candidates)),
+                [lens_table for _, lens_table in candidates],
+                [run_start] * len(candidates),
+            ).get()
+        self._merge_observed([observed for _, _, observed in results])
+
+        optimal_objectives = [objective for objective, _, _ in results]
+        optimal_lens_tables = [
+            self._full_lens_table(table_values) for _, table_values, _ in results
+        ]
+        best = int(np.argmin(optimal_objectives))
+        self._update_record(
+            optimal_objectives[best],
+            optimal_lens_tables[best],
+            f"local-top{len(candidates)}-{method}",
+            all_optimal_objectives=optimal_objectives,
+            all_optimal_lens_tables=optimal_lens_tables,
+        )
+        self.record[-1]["starting_objectives"] = [
+            objective for objective, _ in candidates
+        ]
+        self._report_timing(run_start)
+        self.default_lens_table = optimal_lens_tables[best]
+        print(
+            f"refined objectives {optimal_objectives} from "
+            f"{[objective for objective, _ in candidates]}; best "
+            f"{optimal_objectives[best]:.3e} from candidate {best}"
+        )
+
+        lis_purge()
+
+        if self.messenger is not None:
+            self.messenger.send_message(
+                f"top {len(candidates)} refinement complete. best objective: "
+                f"{optimal_objectives[best]} achieved with "
+                f"{optimal_lens_tables[best]}"
+            )
+
+    def pareto_optimize(
+        self,
+        population_size: int = 40,
+        n_generations: int = 25,
+        n_processes: int = 12,
+        seed: int = None,
+    ) -> None:
+        """
+        Optimize the objectives separately with NSGA-II and record the Pareto front,
+        from which `tradeoff` picks the best lens table for any weights afterwards.
+        Every generation is evaluated with `objective_vectors` in `n_processes`
+        parallel batches. `default_lens_table` becomes the point of the front with the
+        smallest sum of the objectives, what `global_optimize` minimizes. Lens tables
+        `prescreen` rejects get its penalty for every objective and never run, while
+        `voltage_noise` doesn't apply.
+
+        Args
+        ----
+        population_size: int
+            Lens tables per generation.
+        n_generations: int
+            Generations after the initial Latin hypercube.
+        n_processes: int
+            Parallel COSY runs per generation.
+        seed: int
+            Of the initial design and the variation.
+        """
+        search_space = self.search_space
+
+        def progress(generation: int, _, objectives: np.ndarray) -> None:
+            print(
+                f"generation {generation}: best objectives "
+                f"{objectives.min(axis=0).tolist()}"
+            )
+
+        run_start = time.time()
+        front, front_objectives = nsga2(
+            lambda points: self.objective_vectors(points, n_processes),
+            search_space.bounds,
+            population_size,
+            n_generations,
+            seed=seed,
+            callback=progress,
+        )
+        lens_tables = [self._full_lens_table(point) for point in front]
+        best = select_tradeoff(front_objectives)
+
+        self._update_record(
+            float(front_objectives[best].sum()), lens_tables[best], "pareto"
+        )
+        self.record[-1]["objective_calls"] = [
+            objective.call for objective in self.objectives
+        ]
+        self.record[-1]["pareto_front"] = {
+            "objectives": front_objectives.tolist(),
+            "lens_tables": lens_tables,
+        }
+        self._report_timing(run_start)
+        self.default_lens_table = lens_tables[best]
+        print(
+            f"{len(front)} lens tables on the Pareto front, smallest sum "
+            f"{front_objectives[best].sum():.3e} with {lens_tables[best]}"
+        )
+
+        lis_purge()
+
+        if self.messenger is not None:
+            self.messenger.send_message(
+                f"pareto optimization complete with {len(front)} lens tables on the "
+                f"front. smallest sum: {front_objectives[best].sum()}"
+            )
+
+    def tradeoff(
+        self,
+        weights: list[float] = None,
+        normalize: bool = False,
+        record: dict = None,
+    ) -> tuple[np.ndarray, LensTable]:
+        """
+        The objectives and lens table of the point of a recorded Pareto front (default
+        the last one) with the smallest weighted sum of the objectives, see
+        `select_tradeoff`. Set it as `default_lens_table` to refine it further.
+        """
+        if record is None:
+            record = next(
+                (
+                    record
+                    for record in reversed(self.record)
+                    if "pareto_front" in record
+                ),
+                None,
+            )
+        if record is None:
+            raise ValueError("no Pareto optimization recorded")
+        objectives = np.array(record["pareto_front"]["objectives"])
+        best = select_tradeoff(objectives, weights, normalize)
+        return objectives[best], LensTable(record["pareto_front"]["lens_tables"][best])
+
+    def expansion_optimize(
+        self,
+        radius: float = EXPANSION_RADIUS,
+        min_radius: float = FD_STEP,
+        max_expansions: int = 20,
+        tol: float = 1e-6,
+        n_processes: int = 1,
+    ) -> None:
+        """
+        Refine `default_lens_table` with a trust region method on `voltage_expansions`.
+        The objective is minimized on the expansions with NumPy within `radius` of the
+        current point, and only the minimum is simulated. If it improves the objective
+        enough, COSY expands around it next. Otherwise the trust region shrinks and the
+        expansion is reused. Objectives that trace rays inside COSY, like
+        ClearApertureObj, can't be evaluated on expansions.
+
+        Args
+        ----
+        radius: float
+            Initial half width of the trust region in units of the search space, and
+            the step of the expansion stencil.
+        min_radius: float
+            Stop once the trust region is smaller.
+        max_expansions: int
+            Maximum number of expansions, each a batched COSY run per endpoint.
+        tol: float
+            Stop once the expansions predict a smaller improvement.
+        n_processes: int
+            Parallel COSY runs the stencil of each expansion is split into.
+        """
+        search_space = self.search_space
+        bounds = search_space.bounds
+        x = search_space.parameters(self.default_lens_table)
+
+        run_start = time.time()
+        objective = self.objective(x)
+        expansions = None
+        n_expansions = 0
+        while radius >= min_radius:
+            if expansions is None:
+                if n_expansions == max_expansions:
+                    break
+                expansions = self.voltage_expansions(x, radius, n_processes)
+                n_expansions += 1
+
+            region = np.stack(
+                [
+                    np.maximum(x - radius, bounds[:, 0]),
+                    np.minimum(x + radius, bounds[:, 1]),
+                ],
+                axis=1,
+            )
+            model = lambda p: self._expansion_objective(expansions, p)
+            result = minimize(model, x, method="L-BFGS-B", bounds=region)
+            predicted = model(x) - result.fun
+            if predicted <= tol:
+                break
+
+            candidate = self.objective(result.x)
+            ratio = (objective - candidate) / predicted
+            print(
+                f"expansion {n_expansions}: radius {radius:.3g}, predicted "
+                f"{predicted:.3e}, actual {objective - candidate:.3e}"
+            )
+            if ratio > 0.1:
+                at_edge = np.any(np.abs(result.x - x) > 0.9 * radius)
+                x, objective = result.x, candidate
+                expansions = None
+                if ratio > 0.75 and at_edge:
+                    radius *= 2
+            else:
+                radius /= 4
+
+        optimal_lens_table = search_space.lens_table(x)
+        full_optimal_lens_table = deepcopy(self.default_lens_table)
+        full_optimal_lens_table.update(optimal_lens_table)
+        self._update_record(objective, full_optimal_lens_table, "local-expansion")
+        self.record[-1]["expansions"] = n_expansions
+        self._report_timing(run_start)
+        self.default_lens_table = full_optimal_lens_table
+        print(
+            f"{objective:.3e} achieved with final lens table: {optimal_lens_table} "
+            f"after {n_expansions} expansions"
+        )
+
+        if self.messenger is not None:
+            self.messenger.send_message(
+                f"expansion optimization complete. best objective: {objective} "
+                f"achieved with {optimal_lens_table}"
+            )
+
+    def generate_data_for_metric(
+        self, n: int, filename: str, sampler: Sampler = None
+    ) -> None:
+        """
+        Evaluate the objective for `n` points of `sampler` (default uniform) in the
+        search space and write the full lens tables with their objectives.
+        """
+        search_space = self.search_space
+        if sampler is None:
+            sampler = UniformSampler(search_space.parameter_limits)
+        parameters = sampler.sample(n)
         result_folder = RESULTS_DIR / "simulation_data"
 
         self.record.append(self._objective_parameters())
         self.save_record(result_folder / f"{filename}_metric_metadata.json")
         with open(result_folder / f"{filename}_metric_data.csv", "x") as f:
-            for _ in range(n):
-                lens_table = np.array(
-                    [
-                        random.uniform(lens_limit[0], lens_limit[1])
-                        for lens_limit in self.lens_limits.values()
-                    ]
-                )
-                objective = self.objective(lens_table)
+            for point in parameters:
+                objective = self.objective(point)
 
+                lens_table = search_space.voltages(point)
                 output = ",".join(lens_table.astype(str)) + f",{objective}\n"
                 f.write(output)
 
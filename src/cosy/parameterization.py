@@ -0,0 +1,221 @@
+"""Linear parameterizations of lens tables for the optimizer.
+
+Instead of optimizing every electrode in `lens_limits` independently, a
+`Parameterization` maps a shorter parameter vector p to the voltages of the electrodes,
+
+    voltages = offset + matrix @ p,
+
+so BADS searches a smaller space. `tied` builds the usual cases: groups of electrodes
+that share one voltage (what "V02:=V00" beam parameters did) and electrodes fixed at a
+voltage. `pca` spans the directions in which past optimal lens tables differ.
+
+```
+parameterization = Parameterization.tied(
+    lens_limits,
+    groups=[[Electrode.V00, Electrode.V02, Electrode.V03, Electrode.V10]],
+    fixed={Electrode.V33: 0},
+)
+optimizer = SpeemOptimizer(objectives, lens_limits, parameterization=parameterization)
+```
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+
+from .constants import Electrode
+from .utils import LensTable
+
+__all__ = ["Parameterization", "optimal_lens_tables"]
+
+
+@dataclass
+class Parameterization:
+    """
+    `electrodes` get `offset + matrix @ p` for parameters p named `parameter_names`
+    within `bounds` (n_parameters, 2). Voltages are clipped to `limits`
+    (n_electrodes, 2) if given.
+    """
+
+    electrodes: list[Electrode]
+    parameter_names: list[str]
+    matrix: np.ndarray
+    offset: np.ndarray
+    bounds: np.ndarray
+    limits: np.ndarray = None
+
+    def __post_init__(self) -> None:
+        self.matrix = np.asarray(self.matrix, dtype=float)
+        self.offset = np.asarray(self.offset, dtype=float)
+        self.bounds = np.asarray(self.bounds, dtype=float)
+        if self.matrix.shape != (len(self.electrodes), len(self.parameter_names)):
+            raise ValueError(
+                f"matrix has shape {self.matrix.shape} for {len(self.electrodes)} "
+                f"electrodes and {len(self.parameter_names)} parameters"
+            )
+        if self.limits is not None:
+            self.limits = np.asarray(self.limits, dtype=float)
+
+    @classmethod
+    def identity(
+        cls, lens_limits: dict[Electrode, tuple[float, float]]
+    ) -> "Parameterization":
+        """Every electrode of `lens_limits` is its own parameter."""
+        n_electrodes = len(lens_limits)
+        return cls(
+            list(lens_limits),
+            [str(name) for name in lens_limits],
+            np.eye(n_electrodes),
+            np.zeros(n_electrodes),
+            np.array(list(lens_limits.values())),
+        )
+
+    @classmethod
+    def tied(
+        cls,
+        lens_limits: dict[Electrode, tuple[float, float]],
+        groups: list[list[Electrode]] = (),
+        fixed: dict[Electrode, float] = None,
+    ) -> "Parameterization":
+        """
+        One parameter per group of electrodes sharing a voltage, named after the first
+        electrode of the group, and one per remaining electrode of `lens_limits`.
+
+        Args
+        ----
+        lens_limits : dict
+            Limits of the electrodes. A group's parameter is limited to what all of its
+            electrodes in `lens_limits` allow.
+        groups : list[list[Electrode]]
+            Electrodes that get the same voltage. Members don't need to be in
+            `lens_limits`, e.g. V02 always at V00.
+        fixed : dict[Electrode, float]
+            Electrodes kept at a voltage.
+        """
+        fixed = {} if fixed is None else fixed
+        grouped = {name for group in groups for name in group}
+        groups = [list(group) for group in groups] + [
+            [name] for name in lens_limits if name not in grouped and name not in fixed
+        ]
+
+        electrodes = [name for group in groups for name in group] + list(fixed)
+        matrix = np.zeros((len(electrodes), len(groups)))
+        offset = np.zeros(len(electrodes))
+        bounds = []
+        row = 0
+        for column, group in enumerate(groups):
+            limits = [lens_limits[name] for name in group if name in lens_limits]
+            if not limits:
+                raise ValueError(f"no electrode of {group} has limits")
+            bounds.append(
+                [max(limit[0] for limit in limits), min(limit[1] for limit in limits)]
+            )
+            if bounds[-1][0] > bounds[-1][1]:
+                raise ValueError(f"the limits of {group} don't overlap")
+            matrix[row : row + len(group), column] = 1
+            row += len(group)
+        offset[row:] = list(fixed.values())
+
+        return cls(
+            electrodes, [str(group[0]) for group in groups], matrix, offset, bounds
+        )
+
+    @classmethod
+    def pca(
+        cls,
+        lens_tables: np.ndarray,
+        electrodes: list[Electrode],
+        n_components: int,
+        lens_limits: dict[Electrode, tuple[float, float]] = None,
+        margin: float = 0.5,
+    ) -> "Parameterization":
+        """
+        The mean of past optimal `lens_tables` (n_tables, n_electrodes) plus the
+        `n_components` directions along which they vary most. Each parameter may go
+        `margin` times the spread of the tables along its direction beyond the
+        tables. With `lens_limits` the voltages are clipped to them.
+        """
+        lens_tables = np.atleast_2d(lens_tables)
+        mean = lens_tables.mean(axis=0)
+        *_, directions = np.linalg.svd(lens_tables - mean, full_matrices=False)
+        directions = directions[:n_components].T
+        projections = (lens_tables - mean) @ directions
+        spread = projections.max(axis=0) - projections.min(axis=0)
+        bounds = np.stack(
+            [
+                projections.min(axis=0) - margin * spread,
+                projections.max(axis=0) + margin * spread,
+            ],
+            axis=1,
+        )
+        limits = None
+        if lens_limits is not None:
+            limits = np.array([lens_limits[name] for name in electrodes])
+        return cls(
+            list(electrodes),
+            [f"pc{i}" for i in range(directions.shape[1])],
+            directions,
+            mean,
+            bounds,
+            limits,
+        )
+
+    @property
+    def n_parameters(self) -> int:
+        return len(self.parameter_names)
+
+    @property
+    def parameter_limits(self) -> dict[str, list[float]]:
+        return dict(zip(self.parameter_names, self.bounds.tolist()))
+
+    def voltages(self, parameters: np.ndarray) -> np.ndarray:
+        """Voltages of `electrodes` for parameters (..., n_parameters)."""
+        voltages = self.offset + np.asarray(parameters, dtype=float) @ self.matrix.T
+        if self.limits is not None:
+            voltages = np.clip(voltages, self.limits[:, 0], self.limits[:, 1])
+        return voltages
+
+    def lens_table(self, parameters: np.ndarray) -> LensTable:
+        return LensTable(
+            zip(self.electrodes, self.voltages(np.ravel(parameters)).tolist())
+        )
+
+    def parameters(self, lens_table: dict) -> np.ndarray:
+        """The parameters closest to the voltages of `lens_table`, within the bounds."""
+        voltages = np.array([lens_table[name] for name in self.electrodes])
+        parameters, *_ = np.linalg.lstsq(
+            self.matrix, voltages - self.offset, rcond=None
+        )
+        return np.clip(parameters, self.bounds[:, 0], self.bounds[:, 1])
+
+    def to_dict(self) -> dict:
+        return {
+            "electrodes": [str(name) for name in self.electrodes],
+            "parameter_names": self.parameter_names,
+            "matrix": self.matrix.tolist(),
+            "offset": self.offset.tolist(),
+            "bounds": self.bounds.tolist(),
+            "limits": None if self.limits is None else self.limits.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Parameterization":
+        return cls(
+            [Electrode(name) for name in data["electrodes"]],
+            data["parameter_names"],
+            data["matrix"],
+            data["offset"],
+            data["bounds"],
+            data.get("limits"),
+        )
+
+
+def optimal_lens_tables(records: list[dict], electrodes: list[Electrode]) -> np.ndarray:
+    """The optimal lens tables of optimization records as rows over `electrodes`."""
+    return np.array(
+        [
+            [record["optimal_lens_table"][name] for name in electrodes]
+            for record in records
+            if "optimal_lens_table" in record
+        ]
+    )
@@ -0,0 +1,219 @@
+"""Multi-objective optimization of the objectives separately instead of their sum.
+
+`nsga2` is a NumPy implementation of NSGA-II (Deb et al. 2002): a population evolves
+by simulated binary crossover and polynomial mutation and survives by non-dominated
+rank and crowding distance. It takes a function evaluating a whole generation at once,
+so `SpeemOptimizer.pareto_optimize` can batch every generation into a few parallel
+COSY runs. The returned Pareto front is stored in the optimization record, and
+`select_tradeoff` picks the point of any weighting of the objectives from it without
+running COSY again.
+
+```
+optimizer.pareto_optimize(population_size=48, n_generations=30)
+objectives, lens_table = optimizer.tradeoff(weights=[10, 10000])
+```
+"""
+
+from typing import Callable
+
+import numpy as np
+from scipy.stats import qmc
+
+__all__ = [
+    "nsga2",
+    "non_dominated_ranks",
+    "crowding_distance",
+    "pareto_front",
+    "select_tradeoff",
+]
+
+# distribution indices of the crossover and the mutation, larger keeps children closer
+CROSSOVER_ETA = 15
+MUTATION_ETA = 20
+CROSSOVER_PROBABILITY = 0.9
+
+
+def non_dominated_ranks(objectives: np.ndarray) -> np.ndarray:
+    """
+    The front of every point (n_points, n_objectives): 0 for points no other point
+    dominates, 1 for those only dominated by front 0 and so on.
+    """
+    objectives = np.asarray(objectives, dtype=float)
+    # dominates[i, j]: point i is nowhere worse than point j and somewhere better
+    dominates = np.all(objectives[:, None] <= objectives[None], axis=2) & np.any(
+        objectives[:, None] < objectives[None], axis=2
+    )
+    ranks = np.full(len(objectives), -1)
+    n_dominating = dominates.sum(axis=0)
+    front = np.flatnonzero(n_dominating == 0)
+    rank = 0
+    while len(front):
+        ranks[front] = rank
+        n_dominating[front] = -1
+        n_dominating -= dominates[front].sum(axis=0)
+        front = np.flatnonzero(n_dominating == 0)
+        rank += 1
+    return ranks
+
+
+def crowding_distance(objectives: np.ndarray) -> np.ndarray:
+    """How isolated every point of one front is, infinite at the ends of the front."""
+    objectives = np.asarray(objectives, dtype=float)
+    n_points, n_objectives = objectives.shape
+    distance = np.zeros(n_points)
+    for m in range(n_objectives):
+        order = np.argsort(objectives[:, m])
+        values = objectives[order, m]
+        distance[order[[0, -1]]] = np.inf
+        spread = values[-1] - values[0]
+        if n_points > 2 and spread > 0:
+            distance[order[1:-1]] += (values[2:] - values[:-2]) / spread
+    return distance
+
+
+def pareto_front(
+    points: np.ndarray, objectives: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """The distinct non-dominated `points` and their `objectives`, by the first one."""
+    front = non_dominated_ranks(objectives) == 0
+    points, index = np.unique(points[front], axis=0, return_index=True)
+    objectives = objectives[front][index]
+    order = np.argsort(objectives[:, 0])
+    return points[order], objectives[order]
+
+
+def select_tradeoff(
+    objectives: np.ndarray, weights: np.ndarray = None, normalize: bool = False
+) -> int:
+    """
+    The index of the point of a front with the smallest weighted sum of `objectives`,
+    i.e. what optimizing that sum would have found among them. With `normalize`, each
+    objective is first scaled to [0, 1] over the front.
+    """
+    objectives = np.asarray(objectives, dtype=float)
+    if normalize:
+        lowest = objectives.min(axis=0)
+        spread = objectives.max(axis=0) - lowest
+        objectives = (objectives - lowest) / np.where(spread > 0, spread, 1)
+    weights = np.ones(objectives.shape[1]) if weights is None else weights
+    return int(np.argmin(objectives @ np.asarray(weights, dtype=float)))
+
+
+def _survivors(objectives: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+    """The indices of the `n` best points by rank and crowding, and their keys."""
+    ranks = non_dominated_ranks(objectives)
+    crowding = np.empty(len(objectives))
+    for rank in np.unique(ranks):
+        front = ranks == rank
+        crowding[front] = crowding_distance(objectives[front])
+    order = np.lexsort((-crowding, ranks))[:n]
+    return order, np.stack([ranks[order], -crowding[order]], axis=1)
+
+
+def _tournament(keys: np.ndarray, n: int, rng: np.random.Generator) -> np.ndarray:
+    """Winners of `n` binary tournaments, by rank and then crowding."""
+    pairs = rng.integers(len(keys), size=(n, 2))
+    first, second = keys[pairs[:, 0]], keys[pairs[:, 1]]
+    first_wins = (first[:, 0] < second[:, 0]) | (
+        (first[:, 0] == second[:, 0]) & (first[:, 1] <= second[:, 1])
+    )
+    return np.where(first_wins, pairs[:, 0], pairs[:, 1])
+
+
+def _offspring(parents: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Children of consecutive pairs of `parents` in the unit cube."""
+    first, second = parents[0::2], parents[1::2]
+    u = rng.random(first.shape)
+    beta = np.where(
+        u <= 0.5,
+        (2 * u) ** (1 / (CROSSOVER_ETA + 1)),
+        (1 / (2 * (1 - u))) ** (1 / (CROSSOVER_ETA + 1)),
+    )
+    # every variable of a crossing pair crosses with probability 0.5
+    crosses = (rng.random((len(first), 1)) < CROSSOVER_PROBABILITY) & (
+        rng.random(first.shape) < 0.5
+    )
+    beta = np.where(crosses, beta, 1.0)
+    children = np.vstack(
+        [
+            0.5 * ((1 + beta) * first + (1 - beta) * second),
+            0.5 * ((1 - beta) * first + (1 + beta) * second),
+        ]
+    )
+
+    u = rng.random(children.shape)
+    delta = np.where(
+        u < 0.5,
+        (2 * u) ** (1 / (MUTATION_ETA + 1)) - 1,
+        1 - (2 * (1 - u)) ** (1 / (MUTATION_ETA + 1)),
+    )
+    mutates = rng.random(children.shape) < 1 / children.shape[1]
+    return np.clip(children + mutates * delta, 0, 1)
+
+
+def nsga2(
+    evaluate: Callable[[np.ndarray], np.ndarray],
+    bounds: np.ndarray,
+    population_size: int = 40,
+    n_generations: int = 25,
+    seed: int = None,
+    callback: Callable[[int, np.ndarray, np.ndarray], None] = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Minimize several objectives within `bounds` (n_parameters, 2) with NSGA-II.
+
+    Args
+    ----
+    evaluate : Callable
+        Takes points (n_points, n_parameters) and returns their objectives
+        (n_points, n_objectives).
+    population_size : int
+        Points per generation, rounded up to an even number. The first generation is
+        a Latin hypercube.
+    n_generations : int
+        Generations after the first.
+    seed : int
+        Of the initial design and the variation.
+    callback : Callable
+        Called with the generation and the points and objectives of the population
+        after every generation.
+
+    Returns
+    -------
+    points : np.ndarray
+        The Pareto front among all evaluated points.
+    objectives : np.ndarray
+        Their objectives.
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    lower, width = bounds[:, 0], bounds[:, 1] - bounds[:, 0]
+    population_size += population_size % 2
+    rng = np.random.default_rng(seed)
+
+    population = qmc.LatinHypercube(len(bounds), seed=rng).random(population_size)
+    objectives = np.asarray(evaluate(lower + width * population), dtype=float)
+    all_points, all_objectives = [population], [objectives]
+    order, keys = _survivors(objectives, population_size)
+    population, objectives = population[order], objectives[order]
+    if callback is not None:
+        callback(0, lower + width * population, objectives)
+
+    for generation in range(1, n_generations + 1):
+        parents = population[_tournament(keys, population_size, rng)]
+        children = _offspring(parents, rng)
+        child_objectives = np.asarray(evaluate(lower + width * children), dtype=float)
+        all_points.append(children)
+        all_objectives.append(child_objectives)
+
+        combined = np.vstack([population, children])
+        combined_objectives = np.vstack([objectives, child_objectives])
+        survivors, keys = _survivors(combined_objectives, population_size)
+        population = combined[survivors]
+        objectives = combined_objectives[survivors]
+        if callback is not None:
+            callback(generation, lower + width * population, objectives)
+
+    points, front_objectives = pareto_front(
+        np.vstack(all_points), np.vstack(all_objectives)
+    )
+    return lower + width * points, front_objectives
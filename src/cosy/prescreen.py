@@ -0,0 +1,216 @@
+"""Cheap rejection of lens tables before COSY runs them.
+
+Many proposals of the optimizers send the electrons back before they reach the
+detector, and COSY then spends a full evaluation to produce the 1e9 of a failure. A
+`Prescreen` catches the obvious cases first. From the ring charge model's potential
+on the axis, cached with the `FieldGrid` of `raytrace`, an electron leaving the
+sample with `kinetic_energy` has
+
+    T(z) = KE + phi(z) - phi(sample)
+
+left at z, and a lens table where T drops to `margin` or below anywhere before the
+detector reflects it. The axial potential of a lens table is a sum of one row per
+voltage group, so the check takes microseconds.
+
+Failures that the axis doesn't show are left to an optional `FailureClassifier`. It
+learns which lens tables made COSY fail from the evaluations that did run and rejects
+lens tables whose nearest neighbours mostly failed. Rejected lens tables get
+`penalty` without COSY. Pool workers of the optimizer learn in their own copy and
+don't see what the others learn until the pool is done and the copies are merged.
+
+```
+prescreen = Prescreen({0: Electrode.V00, 1: Electrode.V01}, kinetic_energy=5)
+optimizer = SpeemOptimizer(objectives, lens_limits, prescreen=prescreen)
+```
+"""
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from .constants import FOX_DIR, Electrode
+from .field import group_voltages
+from .raytrace import FieldGrid
+
+__all__ = ["Prescreen", "FailureClassifier"]
+
+
+class FailureClassifier:
+    """
+    k nearest neighbours vote on whether COSY fails for a lens table. Lens tables are
+    scaled to the unit cube with `lens_limits`.
+
+    Args
+    ----
+    lens_limits : dict
+        The electrodes the classifier looks at and their limits.
+    k : int
+        Neighbours that vote.
+    threshold : float
+        Share of failed neighbours above which a lens table is predicted to fail.
+    min_samples : int
+        Evaluations to learn from before predicting anything.
+    """
+
+    def __init__(
+        self,
+        lens_limits: dict[Electrode, tuple[float, float]],
+        k: int = 5,
+        threshold: float = 0.8,
+        min_samples: int = 50,
+    ) -> None:
+        self.electrodes = list(lens_limits)
+        limits = np.array(list(lens_limits.values()), dtype=float)
+        self._lower = limits[:, 0]
+        self._width = limits[:, 1] - limits[:, 0]
+        self.k = k
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self._x = np.empty((0, len(self.electrodes)))
+        self._failed = np.empty(0, dtype=bool)
+
+    @property
+    def n_samples(self) -> int:
+        return len(self._failed)
+
+    def _scale(self, lens_tables: np.ndarray) -> np.ndarray:
+        return (np.atleast_2d(lens_tables) - self._lower) / self._width
+
+    def row(self, lens_table: dict) -> np.ndarray:
+        return np.array([lens_table[name] for name in self.electrodes], dtype=float)
+
+    def fit(self, lens_tables: np.ndarray, failed: np.ndarray) -> "FailureClassifier":
+        """Learn from lens tables (n, n_electrodes) and whether COSY failed (n,)."""
+        self._x = self._scale(lens_tables)
+        self._failed = np.asarray(failed, dtype=bool)
+        return self
+
+    def add(self, lens_table: dict, failed: bool) -> None:
+        self._x = np.vstack([self._x, self._scale(self.row(lens_table))])
+        self._failed = np.append(self._failed, failed)
+
+    def extend(self, lens_tables: np.ndarray, failed: np.ndarray) -> None:
+        """Learn from more lens tables (n, n_electrodes) and whether COSY failed."""
+        self._x = np.vstack([self._x, self._scale(lens_tables)])
+        self._failed = np.append(self._failed, np.asarray(failed, dtype=bool))
+
+    def samples(self, start: int = 0) -> tuple[np.ndarray, np.ndarray]:
+        """The lens tables learned from since the `start`th and whether they failed."""
+        return self._x[start:] * self._width + self._lower, self._failed[start:]
+
+    def failure_probability(self, lens_tables: np.ndarray) -> np.ndarray:
+        """The share of failed neighbours of lens tables (n, n_electrodes)."""
+        x = self._scale(lens_tables)
+        k = min(self.k, self.n_samples)
+        if not k:
+            return np.zeros(len(x))
+        distances = np.linalg.norm(x[:, np.newaxis] - self._x, axis=2)
+        neighbours = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        return self._failed[neighbours].mean(axis=1)
+
+    def fails(self, lens_table: dict) -> bool:
+        if self.n_samples < self.min_samples:
+            return False
+        return bool(self.failure_probability(self.row(lens_table))[0] > self.threshold)
+
+
+@dataclass
+class Prescreen:
+    """
+    Args
+    ----
+    electrode_groups : dict[int, Electrode]
+        The electrode each voltage group of the model belongs to, see
+        `group_voltages`.
+    kinetic_energy : float
+        Of the slowest electrons that have to reach the detector (eV).
+    margin : float
+        Kinetic energy (eV) below which an electron counts as reflected, to also
+        reject lens tables that only just let it pass.
+    penalty : float
+        Objective of rejected lens tables. 1e9 like a COSY failure.
+    root : Path
+        Directory with the field model. Its `FieldGrid` is built if it isn't cached.
+    classifier : FailureClassifier
+        Rejects lens tables like past failures. It learns from every lens table COSY
+        evaluates, with `voltage_noise` every perturbed one. Pool workers, e.g. of `global_optimize`, learn in their own copy,
+        which the optimizer merges back once the pool is done.
+    """
+
+    electrode_groups: dict[int, Electrode]
+    kinetic_energy: float
+    margin: float = 0.0
+    penalty: float = 1e9
+    root: Path = FOX_DIR
+    classifier: FailureClassifier = None
+    _axis: np.ndarray = field(default=None, init=False, repr=False)
+    _groups: np.ndarray = field(default=None, init=False, repr=False)
+
+    def load(self) -> "Prescreen":
+        """The axial potential of every voltage group at 1V, from the cached grid."""
+        grid = FieldGrid.cached(self.root)
+        self._groups = grid.groups
+        # r = 0 is the first column of the grid
+        self._axis = grid.unit[:, 0, :, 0]
+        return self
+
+    def kinetic_energies(self, lens_table: dict) -> np.ndarray:
+        """T(z) on the axis from the sample to the detector for `lens_table`."""
+        if self._axis is None:
+            self.load()
+        voltages = group_voltages(lens_table, self.electrode_groups)
+        weights = np.array([voltages.get(group, 0) for group in self._groups])
+        phi = weights @ self._axis
+        return self.kinetic_energy + phi - phi[0]
+
+    def reflects(self, lens_table: dict) -> bool:
+        return bool(np.nanmin(self.kinetic_energies(lens_table)) <= self.margin)
+
+    def reject(self, lens_table: dict) -> str | None:
+        """Why `lens_table` isn't worth running, or None if it is."""
+        if self.reflects(lens_table):
+            return "reflection"
+        if self.classifier is not None and self.classifier.fails(lens_table):
+            return "classifier"
+        return None
+
+    def observe(self, lens_table: dict, objective: float) -> None:
+        """Teach the classifier the outcome of a lens table COSY evaluated."""
+        if self.classifier is not None:
+            # COSY failures leave the 1e9 written before the run
+            self.classifier.add(lens_table, objective >= 1e9)
+
+    @property
+    def n_observed(self) -> int:
+        return 0 if self.classifier is None else self.classifier.n_samples
+
+    def observed(self, start: int = 0) -> tuple[np.ndarray, np.ndarray] | None:
+        """What the classifier learned since its `start`th observation, see `learn`."""
+        if self.classifier is None:
+            return None
+        return self.classifier.samples(start)
+
+    def learn(self, observed: tuple[np.ndarray, np.ndarray] | None) -> None:
+        """Merge what a copy of this prescreen, e.g. in a pool worker, observed."""
+        if self.classifier is not None and observed is not None:
+            self.classifier.extend(*observed)
+
+    def to_dict(self) -> dict:
+        return {
+            "electrode_groups": {
+                str(group): str(name) for group, name in self.electrode_groups.items()
+            },
+            "kinetic_energy": self.kinetic_energy,
+            "margin": self.margin,
+            "penalty": self.penalty,
+            "classifier": (
+                None
+                if self.classifier is None
+                else {
+                    "k": self.classifier.k,
+                    "threshold": self.classifier.threshold,
+                    "min_samples": self.classifier.min_samples,
+                }
+            ),
+        }
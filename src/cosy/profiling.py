@@ -0,0 +1,212 @@
+"""Timing of objective evaluations. Every evaluation appends one JSON line to a trace file
+with the time spent in each stage,
+
+    render   editing the template lines for the lens table
+    write    writing the objective placeholder and the COSY script
+    spawn    starting the COSY process
+    compute  waiting for COSY to finish
+    parse    reading the objective
+    cleanup  removing the per process files
+
+and pool workers add a "queue" line with how long their task waited for a free process.
+Lens tables a `Prescreen` rejects without running COSY add a "prescreen" line with the
+reason.
+Appending whole lines with O_APPEND keeps the trace usable when many processes write to
+it at once. By default every profiler writes its own `{run_id}.jsonl` in `TRACE_DIR`,
+which pool workers share through their copies, so reading one optimizer's trace never
+parses those of past or concurrent jobs. Every entry also carries the `run_id`, for
+`read_trace` to pick one optimizer's evaluations out of a trace file that several
+write to. `summarize` aggregates a trace per stage and per worker.
+"""
+
+import os, json, time, uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from .constants import RESULTS_DIR
+
+__all__ = [
+    "TRACE_DIR",
+    "EvaluationProfiler",
+    "read_trace",
+    "summarize",
+    "format_summary",
+]
+
+TRACE_DIR = RESULTS_DIR / "evaluation_traces"
+STAGES = ("render", "write", "spawn", "compute", "parse", "cleanup")
+
+
+class EvaluationProfiler:
+    """
+    Times the stages of one evaluation at a time and appends them to `trace_file`.
+    A `trace_file` without a suffix is a directory that gets a trace file for every
+    profiler, named after its `run_id`. None doesn't trace.
+    """
+
+    def __init__(self, trace_file: Path | None = TRACE_DIR) -> None:
+        self.run_id = uuid.uuid4().hex
+        if trace_file is not None and not trace_file.suffix:
+            trace_file = trace_file / f"{self.run_id}.jsonl"
+        self.trace_file = trace_file
+        self._stages: dict[str, float] = {}
+        self._start = None
+        self._wall_start = None
+
+    def begin(self) -> None:
+        self._stages = {}
+        self._start = time.perf_counter()
+        self._wall_start = time.time()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stages[name] = self._stages.get(name, 0) + time.perf_counter() - start
+
+    def end(self, **fields) -> dict:
+        """Finish the evaluation started with `begin` and write it to the trace."""
+        entry = {
+            "event": "evaluation",
+            "run": self.run_id,
+            "pid": os.getpid(),
+            "time": self._wall_start,
+            "total": time.perf_counter() - self._start,
+            "stages": self._stages,
+            **fields,
+        }
+        self._write(entry)
+        return entry
+
+    def record(self, event: str, **fields) -> None:
+        """Write any other event, e.g. the queueing delay of a pool task."""
+        self._write(
+            {
+                "event": event,
+                "run": self.run_id,
+                "pid": os.getpid(),
+                "time": time.time(),
+                **fields,
+            }
+        )
+
+    def _write(self, entry: dict) -> None:
+        if self.trace_file is None:
+            return
+        self.trace_file.parent.mkdir(parents=True, exist_ok=True)
+        line = (json.dumps(entry) + "\n").encode()
+        # a single write of a whole line so lines from different processes don't mix
+        fd = os.open(self.trace_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+def read_trace(
+    trace_file: Path | None, since: float = None, run: str = None
+) -> list[dict]:
+    """
+    The entries of a trace, optionally only those after the wall time `since` and of
+    the profiler with the `run_id` `run`.
+    """
+    if trace_file is None or not trace_file.exists():
+        return []
+    entries = []
+    with open(trace_file, "rt") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a trace that's still being written
+                continue
+            if (since is None or entry["time"] >= since) and (
+                run is None or entry.get("run") == run
+            ):
+                entries.append(entry)
+    return entries
+
+
+def _statistics(values: list[float]) -> dict:
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return {"n": 0, "total": 0.0}
+    return {
+        "n": len(values),
+        "total": float(values.sum()),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(values.max()),
+    }
+
+
+def summarize(entries: list[dict]) -> dict:
+    """Per stage and per worker statistics of the evaluations in a trace."""
+    evaluations = [entry for entry in entries if entry["event"] == "evaluation"]
+    totals = [entry["total"] for entry in evaluations]
+    total_time = sum(totals)
+
+    stage_names = list(STAGES) + sorted(
+        {name for entry in evaluations for name in entry["stages"]} - set(STAGES)
+    )
+    stages = {}
+    for name in stage_names:
+        values = [entry["stages"].get(name, 0.0) for entry in evaluations]
+        stages[name] = _statistics(values)
+        stages[name]["fraction"] = sum(values) / total_time if total_time else 0.0
+
+    workers = {}
+    for pid in sorted({entry["pid"] for entry in evaluations}):
+        worker_totals = [entry["total"] for entry in evaluations if entry["pid"] == pid]
+        workers[str(pid)] = _statistics(worker_totals)
+
+    return {
+        "evaluations": _statistics(totals),
+        "stages": stages,
+        "queue": _statistics(
+            [entry["delay"] for entry in entries if entry["event"] == "queue"]
+        ),
+        "workers": workers,
+        "prescreened": {
+            reason: sum(
+                entry["event"] == "prescreen" and entry["reason"] == reason
+                for entry in entries
+            )
+            for reason in sorted(
+                {entry["reason"] for entry in entries if entry["event"] == "prescreen"}
+            )
+        },
+    }
+
+
+def format_summary(summary: dict) -> str:
+    """A table of where the evaluation time went."""
+    evaluations = summary["evaluations"]
+    if not evaluations["n"]:
+        return "no evaluations traced"
+
+    lines = [
+        f"{evaluations['n']} evaluations in {evaluations['total']:.1f}s of worker time "
+        f"({evaluations['mean']:.3f}s mean, {evaluations['p95']:.3f}s p95) on "
+        f"{len(summary['workers'])} workers",
+        f"{'stage':<10}{'total [s]':>12}{'mean [s]':>12}{'p95 [s]':>12}{'share':>8}",
+    ]
+    for name, stage in summary["stages"].items():
+        lines.append(
+            f"{name:<10}{stage['total']:>12.2f}{stage['mean']:>12.4f}"
+            f"{stage['p95']:>12.4f}{stage['fraction']:>8.1%}"
+        )
+    queue = summary["queue"]
+    if queue["n"]:
+        lines.append(
+            f"{'queue':<10}{queue['total']:>12.2f}{queue['mean']:>12.4f}"
+            f"{queue['p95']:>12.4f}"
+        )
+    for reason, n in summary.get("prescreened", {}).items():
+        lines.append(f"{n} lens tables rejected before COSY by {reason}")
+    return "\n".join(lines)
@@ -0,0 +1,111 @@
+"""Early stopping of hopeless runs of a global optimization.
+
+Most of the independent BADS runs of `SpeemOptimizer.global_optimize` end orders of
+magnitude worse than the best one. With an `EarlyStopping`, every run posts its best
+objective so far on a `ProgressBoard` shared by the pool's processes, and a run whose
+best lags the leader by more than `margin` after `min_evaluations` evaluations is
+stopped. Its process then starts a fresh run, up to `max_restarts` for the whole
+optimization, like the early elimination of successive halving.
+
+```
+optimizer.global_optimize(
+    n_runs=30, early_stopping=EarlyStopping(min_evaluations=150, margin=10)
+)
+```
+"""
+
+import os, json, shutil
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+__all__ = ["EarlyStopping", "ProgressBoard", "RunStopped"]
+
+
+class RunStopped(Exception):
+    """Raised from the objective of a run that lags too far behind the leader."""
+
+
+@dataclass
+class EarlyStopping:
+    """
+    Args
+    ----
+    min_evaluations : int
+        Evaluations every run gets before it can be stopped.
+    margin : float
+        A run is stopped if its best objective is more than `margin` times the best
+        objective of any other run. Objectives are sums of squares, so never negative.
+    check_every : int
+        Evaluations between posting on the board and comparing with the leader.
+    max_restarts : int
+        Fresh runs started in place of stopped ones, over all processes.
+    """
+
+    min_evaluations: int = 100
+    margin: float = 10.0
+    check_every: int = 10
+    max_restarts: int = 10
+
+    def lagging(self, evaluations: int, best: float, leader: float | None) -> bool:
+        return (
+            leader is not None
+            and evaluations >= self.min_evaluations
+            and best > self.margin * leader
+        )
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class ProgressBoard:
+    """
+    The best objective so far of every run, shared between processes through a
+    folder with a small JSON file per run.
+    """
+
+    def __init__(self, folder: Path) -> None:
+        self.folder = folder
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def post(self, run: int, evaluations: int, best: float) -> None:
+        path = self.folder / f"run_{run}.json"
+        temporary_path = path.with_suffix(".tmp")
+        with open(temporary_path, "w") as f:
+            json.dump({"run": run, "evaluations": evaluations, "best": best}, f)
+        temporary_path.replace(path)
+
+    def runs(self) -> list[dict]:
+        runs = []
+        for path in self.folder.glob("run_*.json"):
+            try:
+                with open(path, "r") as f:
+                    runs.append(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                # replaced while reading
+                continue
+        return runs
+
+    def leader(self, exclude: int = None) -> float | None:
+        """The best objective of all runs but `exclude`, None before any posted."""
+        bests = [run["best"] for run in self.runs() if run["run"] != exclude]
+        return min(bests, default=None)
+
+    def claim_restart(self, max_restarts: int) -> int | None:
+        """
+        The number of a restart no other process has claimed, or None once all
+        `max_restarts` are taken.
+        """
+        for restart in range(max_restarts):
+            try:
+                fd = os.open(
+                    self.folder / f"restart_{restart}",
+                    os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                )
+            except FileExistsError:
+                continue
+            os.close(fd)
+            return restart
+        return None
+
+    def clear(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,330 @@
+"""Raytracing in Python through the ring charge model, for quick looks at a lens table
+without running COSY.
+
+The potential and gradient of every voltage group at 1V are computed once on a regular
+(z, r) grid and cached in the model directory. A lens table then only takes a weighted
+sum of the grids, and all rays are integrated together with RK4 in z,
+
+    r'' = (1 + r'^2) / (2 T) (dphi/dr - r' dphi/dz),    T = KE + phi - phi_start,
+
+for electrons leaving the sample with kinetic energy KE (eV). Rays that turn around or
+leave the grid become NaN. The output is written in the layout `plot_rays` reads.
+
+```
+raytrace(lens_table, {0: Electrode.V00, 1: Electrode.V01}, kinetic_energy=5)
+plot_rays()
+```
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .constants import FOX_DIR, SAMPLE_Z, DET_Z
+from .field import FieldModel, group_voltages
+from .utils import LensTable
+
+__all__ = ["FieldGrid", "ray_bundle", "trace_rays", "write_rays", "raytrace"]
+
+FIELD_GRID_FILE = "fieldGrid.npz"
+MM_TO_M = 1e-3
+
+# default grid in mm
+GRID_Z_STEP = 0.2
+GRID_R_MAX = 10
+GRID_R_STEP = 0.1
+
+# default integration step in mm and how often a step is written to rays.txt
+RAY_STEP = 0.05
+OUTPUT_EVERY = 20
+
+
+class FieldGrid:
+    """
+    Potential, dphi/dz and dphi/dr of each voltage group at 1V on a regular (z, r) grid.
+    `unit` has shape (n_groups, 3, len(z), len(r)). Everything is in m and V.
+    """
+
+    def __init__(
+        self,
+        z: np.ndarray,
+        r: np.ndarray,
+        groups: np.ndarray,
+        unit: np.ndarray,
+        key: str = "",
+    ) -> None:
+        self.z = z
+        self.r = r
+        self.groups = groups
+        self.unit = unit
+        self.key = key
+
+    @classmethod
+    def from_model(
+        cls,
+        model: FieldModel,
+        z: np.ndarray,
+        r: np.ndarray,
+        groups: np.ndarray = None,
+        key: str = "",
+    ) -> "FieldGrid":
+        groups = np.unique(model.groups) if groups is None else groups
+        Z, R = np.meshgrid(z, r, indexing="ij")
+        unit = np.empty((len(groups), 3, len(z), len(r)))
+        for i, group in enumerate(groups):
+            charges = model.unit_charges(group)
+            unit[i, 0] = model.potential(Z, R, charges)
+            unit[i, 1], unit[i, 2] = model.gradient(Z, R, charges)
+        # grid points on top of a ring
+        unit[~np.isfinite(unit)] = np.nan
+        return cls(z, r, groups, unit, key)
+
+    @staticmethod
+    def model_key(root: Path, z: np.ndarray, r: np.ndarray) -> str:
+        """Identifies the model files in `root` and the grid axes."""
+        digest = hashlib.sha256()
+        for file in ("zrRing.txt", "zrElec.txt", "voltage.txt"):
+            digest.update((root / file).read_bytes())
+        digest.update(z.tobytes())
+        digest.update(r.tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def cached(
+        cls,
+        root: Path = FOX_DIR,
+        z: np.ndarray = None,
+        r: np.ndarray = None,
+        use_tree: bool = True,
+    ) -> "FieldGrid":
+        """
+        Load the grid cached in `root`, or build it from the model there if the model
+        or the axes changed. The default axes run from the sample to the detector.
+        """
+        if z is None:
+            z = np.arange(SAMPLE_Z, DET_Z + GRID_Z_STEP, GRID_Z_STEP) * MM_TO_M
+        if r is None:
+            r = np.arange(0, GRID_R_MAX + GRID_R_STEP, GRID_R_STEP) * MM_TO_M
+
+        path = root / FIELD_GRID_FILE
+        key = cls.model_key(root, z, r)
+        if path.exists():
+            grid = cls.load(path)
+            if grid.key == key:
+                return grid
+
+        model = FieldModel.from_directory(root)
+        if use_tree:
+            model.use_tree()
+        grid = cls.from_model(model, z, r, key=key)
+        grid.save(path)
+        return grid
+
+    def save(self, path: Path) -> None:
+        # other processes may be loading the cache, so they only ever see whole files
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez(
+                f, z=self.z, r=self.r, groups=self.groups, unit=self.unit, key=self.key
+            )
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "FieldGrid":
+        with np.load(path) as data:
+            return cls(
+                data["z"], data["r"], data["groups"], data["unit"], str(data["key"])
+            )
+
+    def combine(self, voltages: dict[int, float]) -> np.ndarray:
+        """Superpose the unit grids for the voltage of each group."""
+        weights = np.array([voltages.get(group, 0) for group in self.groups])
+        return np.tensordot(weights, self.unit, axes=1)
+
+    def interpolate(
+        self, field: np.ndarray, z: np.ndarray, r: np.ndarray
+    ) -> np.ndarray:
+        """
+        Bilinear interpolation of a combined `field` at (z, r). r may be negative.
+        Points outside the grid are NaN.
+        """
+        dz = self.z[1] - self.z[0]
+        dr = self.r[1] - self.r[0]
+        r_abs = np.abs(r)
+        u = (z - self.z[0]) / dz
+        v = (r_abs - self.r[0]) / dr
+        outside = (u < 0) | (u > len(self.z) - 1) | (v < 0) | (v > len(self.r) - 1)
+
+        i = np.clip(np.floor(np.nan_to_num(u)).astype(int), 0, len(self.z) - 2)
+        j = np.clip(np.floor(np.nan_to_num(v)).astype(int), 0, len(self.r) - 2)
+        u -= i
+        v -= j
+        values = (
+            field[:, i, j] * (1 - u) * (1 - v)
+            + field[:, i + 1, j] * u * (1 - v)
+            + field[:, i, j + 1] * (1 - u) * v
+            + field[:, i + 1, j + 1] * u * v
+        )
+        # the potential is symmetric in r
+        values[2] *= np.where(r < 0, -1, 1)
+        values[:, outside] = np.nan
+        return values
+
+
+def ray_bundle(
+    spot_size: float, acceptance_angle: float, n_spots: int = 3, n_angs: int = 10
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The spot x angle grid of diagnostics.fox. Spots are spread across `spot_size` (mm)
+    and angles go from 0 to half of `acceptance_angle` (degrees).
+
+    Returns
+    -------
+    r : np.ndarray
+        Starting radius of each ray (m), spot major.
+    slope : np.ndarray
+        Starting dr/dz of each ray.
+    """
+    spots = np.linspace(-spot_size / 2, spot_size / 2, n_spots) * MM_TO_M
+    angles = np.radians(np.linspace(0, acceptance_angle / 2, n_angs))
+    r, angle = np.meshgrid(spots, angles, indexing="ij")
+    return r.ravel(), np.tan(angle.ravel())
+
+
+def trace_rays(
+    grid: FieldGrid,
+    voltages: dict[int, float],
+    r: np.ndarray,
+    slope: np.ndarray,
+    kinetic_energy: float,
+    z_start: float = SAMPLE_Z * MM_TO_M,
+    z_end: float = DET_Z * MM_TO_M,
+    step: float = RAY_STEP * MM_TO_M,
+    output_every: int = OUTPUT_EVERY,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Integrate all rays from `z_start` to `z_end` (m).
+
+    Returns
+    -------
+    z : np.ndarray
+        The z of every output step.
+    r : np.ndarray
+        Radius of each ray at each output step, (n_rays, n_outputs).
+    slope : np.ndarray
+        dr/dz of each ray at each output step.
+    """
+    field = grid.combine(voltages)
+    phi_start = grid.interpolate(field, np.full_like(r, z_start), r)[0]
+
+    def derivative(z, r, slope):
+        phi, dphi_dz, dphi_dr = grid.interpolate(field, np.full_like(r, z), r)
+        energy = kinetic_energy + phi - phi_start
+        # turned around
+        energy[energy <= 0] = np.nan
+        return slope, (1 + slope**2) / (2 * energy) * (dphi_dr - slope * dphi_dz)
+
+    n_steps = int(np.ceil((z_end - z_start) / step))
+    h = (z_end - z_start) / n_steps
+    z = z_start
+    r, slope = r.astype(float), slope.astype(float)
+    zs, rs, slopes = [z], [r], [slope]
+    with np.errstate(invalid="ignore"):
+        for i in range(1, n_steps + 1):
+            k1 = derivative(z, r, slope)
+            k2 = derivative(z + h / 2, r + h / 2 * k1[0], slope + h / 2 * k1[1])
+            k3 = derivative(z + h / 2, r + h / 2 * k2[0], slope + h / 2 * k2[1])
+            k4 = derivative(z + h, r + h * k3[0], slope + h * k3[1])
+            r = r + h / 6 * (k1[0] + 2 * k2[0] + 2 * k3[0] + k4[0])
+            slope = slope + h / 6 * (k1[1] + 2 * k2[1] + 2 * k3[1] + k4[1])
+            z = z_start + i * h
+            if i % output_every == 0 or i == n_steps:
+                zs.append(z)
+                rs.append(r)
+                slopes.append(slope)
+
+    return np.array(zs), np.array(rs).T, np.array(slopes).T
+
+
+def write_rays(path: Path, z: np.ndarray, r: np.ndarray, slope: np.ndarray) -> None:
+    """Write rays in mm in the layout of the rays.txt COSY writes."""
+    n_rays = r.shape[0]
+    with open(path, "w") as f:
+        for step_i, z_i in enumerate(z):
+            f.write(f"{z_i / MM_TO_M:.8f}\n")
+            # COSY counts the reference ray too
+            f.write(f"{'number of rays':<17}{n_rays + 1:10d}\n")
+            f.write(f"{'r [mm]':>15}{'dr/dz':>15}\n")
+            f.write("-" * 30 + "\n")
+            for r_i, slope_i in zip(r[:, step_i], slope[:, step_i]):
+                f.write(f"{r_i / MM_TO_M:15.8f}{slope_i:15.8f}\n")
+
+
+def raytrace(
+    lens_table: LensTable,
+    electrode_groups: dict[int, str],
+    kinetic_energy: float,
+    root: Path = FOX_DIR,
+    spot_size: float = 0.1,
+    acceptance_angle: float = 60,
+    n_spots: int = 3,
+    n_angs: int = 10,
+    z_start: float = SAMPLE_Z,
+    z_end: float = DET_Z,
+    step: float = RAY_STEP,
+    grid: FieldGrid = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Trace the ray bundle through the model in `root` for `lens_table` and write
+    rays.txt and lensTable.txt there for `plot_rays`.
+
+    Args
+    ----
+    lens_table : LensTable
+        Electrode voltages.
+    electrode_groups : dict[int, str]
+        The electrode each voltage group of the model belongs to, see `group_voltages`.
+    kinetic_energy : float
+        Kinetic energy of the electrons at the sample (eV).
+    root : Path
+        Directory with the field model.
+    spot_size, acceptance_angle, n_spots, n_angs
+        The ray bundle, see `ray_bundle`.
+    z_start, z_end, step : float
+        Where to trace from and to and the integration step (mm).
+    grid : FieldGrid
+        Defaults to `FieldGrid.cached(root)`.
+
+    Returns
+    -------
+    z : np.ndarray
+        The z of every output step (mm).
+    r : np.ndarray
+        Radius of each ray at each output step (mm).
+    """
+    grid = FieldGrid.cached(root) if grid is None else grid
+    voltages = group_voltages(lens_table, electrode_groups)
+    r, slope = ray_bundle(spot_size, acceptance_angle, n_spots, n_angs)
+    z, r, slope = trace_rays(
+        grid,
+        voltages,
+        r,
+        slope,
+        kinetic_energy,
+        z_start * MM_TO_M,
+        z_end * MM_TO_M,
+        step * MM_TO_M,
+    )
+
+    write_rays(root / "rays.txt", z, r, slope)
+    with open(root / "lensTable.txt", "w") as f:
+        f.write(
+            f"python raytracing, KE={kinetic_energy}eV, spot size={spot_size}mm, "
+            f"acceptance angle={acceptance_angle}deg\n"
+        )
+        for name, voltage in lens_table.items():
+            f.write(f"{name}: {voltage}\n")
+
+    return z / MM_TO_M, r / MM_TO_M
@@ -0,0 +1,306 @@
+"""Designs for choosing the lens tables to simulate.
+
+Independent uniform draws leave large gaps in 10-15 dimensions. The samplers here fill
+the space more evenly for the same number of COSY runs:
+
+    UniformSampler         independent uniform draws, like before
+    SobolSampler           scrambled Sobol sequence
+    LatinHypercubeSampler  a Latin hypercube of a fixed size
+    StratifiedSampler      every electrode's range split into strata that are each
+                           visited once per block of points
+    UncertaintySampler     the candidates of another sampler where a surrogate model is
+                           least certain
+    TableSampler           a given list of lens tables
+
+Every sampler maps point indices to lens tables deterministically from its seed, so
+`points(start, n)` can be handed out to workers in blocks, and a design can be resumed
+in another job from the next index saved with `save_state`.
+
+```
+sampler = SobolSampler(lens_limits, seed=1)
+tables = sampler.sample(256)
+```
+"""
+
+import json, random, warnings
+from pathlib import Path
+
+import numpy as np
+from scipy.stats import qmc
+
+from .constants import Electrode
+
+__all__ = [
+    "Sampler",
+    "UniformSampler",
+    "SobolSampler",
+    "LatinHypercubeSampler",
+    "StratifiedSampler",
+    "UncertaintySampler",
+    "TableSampler",
+    "load_state",
+]
+
+
+class Sampler:
+    """
+    Base class of the designs. Subclasses implement `_unit_points`, the points in the
+    unit cube, which get scaled to `lens_limits`.
+    """
+
+    def __init__(
+        self, lens_limits: dict[Electrode, tuple[float, float]], seed: int = None
+    ) -> None:
+        self.lens_limits = lens_limits
+        self.seed = random.randrange(2**32) if seed is None else seed
+        # the index `sample` continues from
+        self.position = 0
+        # [start, stop) ranges before `position` that parallel data generation handed
+        # out but didn't simulate, to be handed out again when it resumes
+        self.skipped: list[list[int]] = []
+        limits = np.array(list(lens_limits.values()), dtype=float)
+        self._lower = limits[:, 0]
+        self._width = limits[:, 1] - limits[:, 0]
+
+    @property
+    def n_dimensions(self) -> int:
+        return len(self.lens_limits)
+
+    def _unit_points(self, start: int, n: int) -> np.ndarray:
+        raise NotImplementedError
+
+    def points(self, start: int, n: int) -> np.ndarray:
+        """
+        The lens tables with indices `start` to `start + n` as an (n, n_electrodes)
+        array. Fewer rows are returned if the design ends before that.
+        """
+        return self._lower + self._width * self._unit_points(start, n)
+
+    def sample(self, n: int) -> np.ndarray:
+        """The next `n` lens tables of the design."""
+        points = self.points(self.position, n)
+        self.position += n
+        return points
+
+    def state(self) -> dict:
+        return {
+            "sampler": type(self).__name__,
+            "seed": self.seed,
+            "electrodes": [str(name) for name in self.lens_limits],
+            "lens_limits": [
+                list(map(float, limits)) for limits in self.lens_limits.values()
+            ],
+            "position": self.position,
+            "skipped": self.skipped,
+        }
+
+    def save_state(self, path: Path) -> None:
+        """Write where the design is, for resuming it with `load_state`."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = path.with_suffix(".tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(self.state(), f, indent=4)
+        temporary_path.replace(path)
+
+    def resume(self, state: dict) -> None:
+        """Continue from a saved `state` of the same design, including its seed."""
+        for key, value in self.state().items():
+            if (
+                key not in ("seed", "position", "skipped")
+                and state.get(key) != value
+            ):
+                raise ValueError(
+                    f"can't resume a design with {key}={state.get(key)} as one with "
+                    f"{key}={value}"
+                )
+        self.seed = state["seed"]
+        self.position = state["position"]
+        self.skipped = state.get("skipped", [])
+        self._reset()
+
+    def _reset(self) -> None:
+        """Drop anything cached from the seed."""
+
+
+def load_state(path: Path) -> dict | None:
+    """The state saved with `Sampler.save_state`, or None if there is none yet."""
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class UniformSampler(Sampler):
+    """Independent uniform draws."""
+
+    def _unit_points(self, start: int, n: int) -> np.ndarray:
+        # every double takes one draw, so skip the draws of the earlier points
+        bit_generator = np.random.PCG64(self.seed).advance(start * self.n_dimensions)
+        return np.random.Generator(bit_generator).random((n, self.n_dimensions))
+
+
+class SobolSampler(Sampler):
+    """
+    A scrambled Sobol sequence. Its balance properties hold for blocks of a power of 2
+    points starting at a multiple of that power.
+    """
+
+    def __init__(
+        self, lens_limits: dict[Electrode, tuple[float, float]], seed: int = None
+    ) -> None:
+        super().__init__(lens_limits, seed)
+        self._engine = None
+
+    def _unit_points(self, start: int, n: int) -> np.ndarray:
+        # the engine only moves forward, so keep it while the blocks keep increasing
+        if self._engine is None or self._engine.num_generated > start:
+            self._engine = qmc.Sobol(self.n_dimensions, scramble=True, seed=self.seed)
+        if start > self._engine.num_generated:
+            self._engine.fast_forward(start - self._engine.num_generated)
+        with warnings.catch_warnings():
+            # about blocks that aren't powers of 2, see above
+            warnings.simplefilter("ignore", UserWarning)
+            return self._engine.random(n)
+
+    def _reset(self) -> None:
+        self._engine = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_engine"] = None
+        return state
+
+
+class LatinHypercubeSampler(Sampler):
+    """
+    A Latin hypercube of `n_points`: every electrode's range is split into `n_points`
+    strata which each get exactly one point. The design ends after `n_points`.
+    """
+
+    def __init__(
+        self,
+        lens_limits: dict[Electrode, tuple[float, float]],
+        n_points: int,
+        seed: int = None,
+        optimization: str = None,
+    ) -> None:
+        super().__init__(lens_limits, seed)
+        self.n_points = n_points
+        self.optimization = optimization
+        self._design = None
+
+    def _unit_points(self, start: int, n: int) -> np.ndarray:
+        if self._design is None:
+            self._design = qmc.LatinHypercube(
+                self.n_dimensions, optimization=self.optimization, seed=self.seed
+            ).random(self.n_points)
+        return self._design[start : start + n]
+
+    def _reset(self) -> None:
+        self._design = None
+
+    def state(self) -> dict:
+        return super().state() | {"n_points": self.n_points}
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_design"] = None
+        return state
+
+
+class StratifiedSampler(Sampler):
+    """
+    Every electrode's range is split into `n_strata` equal strata (an int for all or a
+    dict per electrode). Each block of `n_strata` consecutive points of an electrode
+    visits every one of its strata once, in a random order, at a random position.
+    """
+
+    def __init__(
+        self,
+        lens_limits: dict[Electrode, tuple[float, float]],
+        n_strata: int | dict[Electrode, int] = 10,
+        seed: int = None,
+    ) -> None:
+        super().__init__(lens_limits, seed)
+        if isinstance(n_strata, int):
+            n_strata = {name: n_strata for name in lens_limits}
+        self.n_strata = np.array([n_strata[name] for name in lens_limits])
+
+    def _unit_points(self, start: int, n: int) -> np.ndarray:
+        indices = np.arange(start, start + n)
+        points = np.empty((n, self.n_dimensions))
+        for dimension, n_strata in enumerate(self.n_strata):
+            blocks = indices // n_strata
+            for block in np.unique(blocks):
+                in_block = blocks == block
+                rng = np.random.default_rng([self.seed, dimension, block])
+                strata = rng.permutation(n_strata)
+                offsets = rng.random(n_strata)
+                positions = indices[in_block] % n_strata
+                points[in_block, dimension] = (
+                    strata[positions] + offsets[positions]
+                ) / n_strata
+        return points
+
+    def state(self) -> dict:
+        return super().state() | {"n_strata": self.n_strata.tolist()}
+
+
+class UncertaintySampler(Sampler):
+    """
+    Draws `oversampling` candidates per point from `candidates` and keeps the ones
+    where `surrogate` is least certain, going by its `uncertainty(lens_tables)`, e.g.
+    an `EnsembleSurrogate`, or the standard deviation from its `predict`. The
+    surrogate can be refit between calls.
+    """
+
+    def __init__(
+        self,
+        candidates: Sampler,
+        surrogate,
+        oversampling: int = 20,
+    ) -> None:
+        super().__init__(candidates.lens_limits, candidates.seed)
+        self.candidates = candidates
+        self.surrogate = surrogate
+        self.oversampling = oversampling
+
+    def points(self, start: int, n: int) -> np.ndarray:
+        candidates = self.candidates.points(
+            start * self.oversampling, n * self.oversampling
+        )
+        if self.surrogate is None or not len(candidates):
+            return candidates[:n]
+        if hasattr(self.surrogate, "uncertainty"):
+            std = self.surrogate.uncertainty(candidates)
+        else:
+            _, std = self.surrogate.predict(candidates)
+        return candidates[np.argsort(std)[::-1][:n]]
+
+    def _reset(self) -> None:
+        self.candidates.seed = self.seed
+        self.candidates._reset()
+
+    def state(self) -> dict:
+        return self.candidates.state() | {
+            "sampler": f"{type(self).__name__}({type(self.candidates).__name__})",
+            "oversampling": self.oversampling,
+            "position": self.position,
+            "skipped": self.skipped,
+        }
+
+
+class TableSampler(Sampler):
+    """The rows of `lens_tables`, in order. The design ends after the last one."""
+
+    def __init__(
+        self, lens_limits: dict[Electrode, tuple[float, float]], lens_tables: np.ndarray
+    ) -> None:
+        super().__init__(lens_limits, seed=0)
+        self.lens_tables = np.atleast_2d(lens_tables)
+
+    def points(self, start: int, n: int) -> np.ndarray:
+        return self.lens_tables[start : start + n]
+
+    def state(self) -> dict:
+        return super().state() | {"n_points": len(self.lens_tables)}
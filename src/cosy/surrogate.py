@@ -0,0 +1,131 @@
+"""A cheap surrogate of COSY results with an uncertainty estimate, for choosing where to
+simulate next.
+
+`EnsembleSurrogate` is a bootstrap ensemble of ridge regressions on random Fourier
+features, i.e. approximate Gaussian process means fit to resampled data. The spread
+of the members is the uncertainty: it grows away from the data and where the data
+disagree. Fitting is a few small linear solves, so it can be refit every round of
+`DataGenerator.active_data_gen`.
+
+```
+surrogate = EnsembleSurrogate(lens_limits).fit(lens_tables, outputs)
+mean, std = surrogate.predict(new_lens_tables)
+```
+"""
+
+import numpy as np
+
+from .constants import Electrode
+
+__all__ = ["EnsembleSurrogate"]
+
+# pairs used to pick the length scale from the median distance between lens tables
+MEDIAN_HEURISTIC_SAMPLES = 1000
+
+
+class EnsembleSurrogate:
+    """
+    Args
+    ----
+    lens_limits : dict
+        Inputs are scaled to the unit cube with these limits.
+    n_models : int
+        Members of the ensemble, each fit to a bootstrap resample of the data.
+    n_features : int
+        Random Fourier features per member.
+    length_scale : float
+        Of the approximated RBF kernel in the unit cube. Defaults to the median
+        distance between the training inputs.
+    ridge : float
+        Regularization of the standardized outputs.
+    seed : int
+        Of the features and the resampling.
+    """
+
+    def __init__(
+        self,
+        lens_limits: dict[Electrode, tuple[float, float]],
+        n_models: int = 10,
+        n_features: int = 300,
+        length_scale: float = None,
+        ridge: float = 1e-3,
+        seed: int = None,
+    ) -> None:
+        limits = np.array(list(lens_limits.values()), dtype=float)
+        self._lower = limits[:, 0]
+        self._width = limits[:, 1] - limits[:, 0]
+        self.n_models = n_models
+        self.n_features = n_features
+        self.length_scale = length_scale
+        self.ridge = ridge
+        self.rng = np.random.default_rng(seed)
+        self._weights = None
+
+    def _scale(self, x: np.ndarray) -> np.ndarray:
+        return (np.atleast_2d(x) - self._lower) / self._width
+
+    def _features(self, x: np.ndarray) -> np.ndarray:
+        """(n_models, n, n_features) random Fourier features of scaled inputs."""
+        return np.sqrt(2 / self.n_features) * np.cos(
+            x @ self._frequencies + self._phases[:, np.newaxis, :]
+        )
+
+    def fit(self, x: np.ndarray, y: np.ndarray) -> "EnsembleSurrogate":
+        """Fit to lens tables `x` (n, n_electrodes) and outputs `y` (n,) or (n, k)."""
+        x = self._scale(x)
+        y = np.asarray(y, dtype=float)
+        self._single_output = y.ndim == 1
+        y = y.reshape(len(y), -1)
+        self._y_mean = y.mean(axis=0)
+        self._y_std = y.std(axis=0)
+        self._y_std[self._y_std == 0] = 1
+        y = (y - self._y_mean) / self._y_std
+
+        length_scale = self.length_scale
+        if length_scale is None:
+            pairs = self.rng.integers(len(x), size=(MEDIAN_HEURISTIC_SAMPLES, 2))
+            distances = np.linalg.norm(x[pairs[:, 0]] - x[pairs[:, 1]], axis=1)
+            length_scale = np.median(distances[distances > 0])
+
+        n_dimensions = x.shape[1]
+        self._frequencies = (
+            self.rng.normal(size=(self.n_models, n_dimensions, self.n_features))
+            / length_scale
+        )
+        self._phases = self.rng.uniform(0, 2 * np.pi, (self.n_models, self.n_features))
+
+        features = self._features(x)
+        self._weights = np.empty((self.n_models, self.n_features, y.shape[1]))
+        identity = self.ridge * np.eye(self.n_features)
+        for model in range(self.n_models):
+            resample = self.rng.integers(len(x), size=len(x))
+            phi = features[model, resample]
+            self._weights[model] = np.linalg.solve(
+                phi.T @ phi + identity, phi.T @ y[resample]
+            )
+        return self
+
+    def predict(self, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns
+        -------
+        mean : np.ndarray
+            Mean prediction of the ensemble, shaped like the training outputs.
+        std : np.ndarray
+            Standard deviation of the members' predictions.
+        """
+        if self._weights is None:
+            raise RuntimeError("fit the surrogate before predicting")
+        predictions = np.einsum(
+            "mnf,mfk->mnk", self._features(self._scale(x)), self._weights
+        )
+        mean = predictions.mean(axis=0) * self._y_std + self._y_mean
+        std = predictions.std(axis=0) * self._y_std
+        if self._single_output:
+            return mean[:, 0], std[:, 0]
+        return mean, std
+
+    def uncertainty(self, x: np.ndarray) -> np.ndarray:
+        """One standard deviation per lens table, averaged over standardized outputs."""
+        _, std = self.predict(x)
+        return (std.reshape(len(std), -1) / self._y_std).mean(axis=1)
@@ -0,0 +1,125 @@
+"""Parametric geometry sweeps. A builder is any callable that takes geometry parameters
+as keyword arguments and returns a `Lens`. Each variant gets its own directory under
+`SWEEP_DIR` so the field models can be built and evaluated in parallel without
+shuffling files in `FOX_DIR`.
+
+```
+def builder(gap: float, radius: float) -> Lens:
+    ...
+
+sweep = GeometrySweep(builder, objectives, lens_table)
+results = sweep.run(GeometrySweep.grid(gap=[1, 2, 3], radius=[4, 5]))
+sweep.save(results, "gap_radius")
+```
+"""
+
+import os, csv, time, shutil
+from datetime import timedelta
+from itertools import product
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+from pathos.multiprocessing import ProcessingPool
+
+from .constants import FOX_DIR, RESULTS_DIR
+from .lens import Lens
+from .model import prepare_model_dir, build_model, ModelCache
+from .objective import ObjectiveFunction
+from .optimizer import SpeemOptimizer
+from .utils import LensTable
+
+__all__ = ["GeometrySweep"]
+
+SWEEP_DIR = FOX_DIR / "sweeps"
+RESULT_FOLDER = RESULTS_DIR / "sweeps"
+FAILED_OBJECTIVE = 1e9
+
+
+class GeometrySweep:
+    def __init__(
+        self,
+        builder: Callable[..., Lens],
+        objectives: list[ObjectiveFunction],
+        lens_table: LensTable,
+        beam_parameters: list[str] = None,
+        root: Path = SWEEP_DIR,
+        keep_models: bool = False,
+        cache: ModelCache = None,
+    ) -> None:
+        self.builder = builder
+        self.objectives = objectives
+        self.lens_table = lens_table
+        self.beam_parameters = beam_parameters
+        self.root = root
+        self.keep_models = keep_models
+        self.cache = cache
+
+    @staticmethod
+    def grid(**axes: list) -> list[dict]:
+        """All combinations of the parameter values in `axes`."""
+        names = list(axes.keys())
+        return [dict(zip(names, values)) for values in product(*axes.values())]
+
+    def variant_dir(self, variant_id: int) -> Path:
+        return self.root / f"variant_{variant_id}"
+
+    def evaluate(self, parameters: dict, variant_id: int) -> dict:
+        """Build the field model for one set of geometry parameters and evaluate it."""
+        start = time.perf_counter()
+        result = {"variant": variant_id, **parameters}
+        root = prepare_model_dir(self.variant_dir(variant_id))
+
+        try:
+            lens = self.builder(**parameters)
+            result["n_total"] = lens.table.n_total
+            if self.cache is None:
+                build_model(lens, root)
+            else:
+                result["cached"] = self.cache.build(lens, root)
+
+            optimizer = SpeemOptimizer(
+                objectives=self.objectives,
+                lens_limits={name: [v, v] for name, v in self.lens_table.items()},
+                default_lens_table=self.lens_table,
+                beam_parameters=self.beam_parameters,
+                fox_dir=root,
+            )
+            result["objective"] = optimizer.objective(
+                np.array(list(self.lens_table.values())), process_id=variant_id
+            )
+        except Exception as e:
+            print(f"variant {variant_id} with {parameters} failed with {e}")
+            result["objective"] = FAILED_OBJECTIVE
+
+        if not self.keep_models:
+            # can't remove the working directory on every platform
+            os.chdir(self.root)
+            shutil.rmtree(root, ignore_errors=True)
+
+        print(
+            f"variant {variant_id} done with obj={result['objective']} in "
+            f"{str(timedelta(seconds=(time.perf_counter()-start)))}"
+        )
+        return result
+
+    def run(self, parameters: list[dict], n_processes: int = 8) -> list[dict]:
+        """Evaluate every set of geometry `parameters` in parallel."""
+        with ProcessingPool(processes=n_processes) as pool:
+            results = pool.map(self.evaluate, parameters, range(len(parameters)))
+        return results
+
+    @staticmethod
+    def save(results: list[dict], filename: str) -> Path:
+        """Write the sweep results to a single csv table in `RESULT_FOLDER`."""
+        RESULT_FOLDER.mkdir(parents=True, exist_ok=True)
+        filepath = RESULT_FOLDER / f"{filename}.csv"
+
+        fieldnames = []
+        for result in results:
+            fieldnames += [key for key in result if key not in fieldnames]
+        with open(filepath, "x", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(results)
+        return filepath
@@ -0,0 +1,195 @@
+"""Truncated transfer maps exported from COSY and evaluated with NumPy.
+
+`PA` writes one line per monomial of the map: the coefficients of x, a, y, b and l
+followed by the exponents of x, a, y, b, l and d. `TransferMap` keeps those as arrays so
+the map can be saved once per lens table and then applied to any number of rays without
+COSY, e.g. for spot diagrams, conversion maps or aperture checks.
+
+```
+maps = optimizer.transfer_maps(lens_table)
+rays = ray_grid(spot_size=0.1, acceptance_angle=30, n_spots=101, n_angs=1001)
+final = maps["aper0Z"](rays)
+```
+"""
+
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+__all__ = ["TransferMap", "ray_grid", "aperture_rays", "clear_aperture"]
+
+# coordinates in COSY's order
+COORDINATES = ("x", "a", "y", "b", "l", "d")
+# PA prints maps of x, a, y, b and l; d is conserved
+N_OUTPUTS = 5
+
+# number of ray-monomial pairs evaluated at once
+DEFAULT_MAX_ELEMENTS = 2**24
+
+# layout of a PA line, see SpeemOptimizer._format_aberrations
+ITEM_LENGTH = 14
+
+
+def _parse_float(item: str) -> float:
+    item = item.strip().replace("D", "E")
+    return float(item) if item else 0.0
+
+
+@dataclass
+class TransferMap:
+    """
+    Polynomial map from initial to final (x, a, y, b, l, d). `coefficients` has shape
+    (n_terms, 5) and `exponents` (n_terms, 6).
+    """
+
+    coefficients: np.ndarray
+    exponents: np.ndarray
+    endpoint: str = ""
+    lens_table: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_aberrations(
+        cls, aberrations: list[list[str]], endpoint: str = "", lens_table: dict = None
+    ) -> "TransferMap":
+        """
+        Build a map from the output of `SpeemOptimizer._format_aberrations`, i.e. what
+        is stored under "aberrations" in an optimization record.
+        """
+        coefficients = []
+        exponents = []
+        for row in aberrations:
+            digits = [int(c) for c in row[-1] if c.isdigit()]
+            if len(digits) < len(COORDINATES):
+                continue
+            coefficients.append([_parse_float(item) for item in row[:N_OUTPUTS]])
+            exponents.append(digits[: len(COORDINATES)])
+
+        return cls(
+            np.array(coefficients, dtype=float).reshape(-1, N_OUTPUTS),
+            np.array(exponents, dtype=np.int8).reshape(-1, len(COORDINATES)),
+            endpoint,
+            {} if lens_table is None else dict(lens_table),
+        )
+
+    @classmethod
+    def from_file(
+        cls, path: Path, endpoint: str = "", lens_table: dict = None
+    ) -> "TransferMap":
+        """Read a map written by PA."""
+        with open(path, "rt") as f:
+            lines = f.readlines()[:-1]
+        aberrations = [
+            [
+                line[1 + i * ITEM_LENGTH : 1 + (i + 1) * ITEM_LENGTH]
+                for i in range(N_OUTPUTS)
+            ]
+            + [line[ITEM_LENGTH * N_OUTPUTS + 2 : -1]]
+            for line in lines
+        ]
+        return cls.from_aberrations(aberrations, endpoint, lens_table)
+
+    def __len__(self) -> int:
+        return len(self.coefficients)
+
+    @property
+    def order(self) -> int:
+        return int(self.exponents.sum(axis=1).max(initial=0))
+
+    def __call__(
+        self, rays: np.ndarray, max_elements: int = DEFAULT_MAX_ELEMENTS
+    ) -> np.ndarray:
+        """
+        Apply the map to `rays` of shape (N, 6) in COSY's coordinates. d is passed
+        through unchanged.
+        """
+        rays = np.atleast_2d(np.asarray(rays, dtype=float))
+        final = np.empty_like(rays)
+        final[:, N_OUTPUTS:] = rays[:, N_OUTPUTS:]
+
+        max_power = int(self.exponents.max(initial=0))
+        chunk_size = max(max_elements // max(len(self), 1), 1)
+        for start in range(0, len(rays), chunk_size):
+            chunk = rays[start : start + chunk_size]
+            # powers[p, i, v] = chunk[i, v]^p
+            powers = chunk[np.newaxis] ** np.arange(max_power + 1)[:, None, None]
+            monomials = np.ones((len(chunk), len(self)))
+            for v in range(len(COORDINATES)):
+                monomials *= powers[self.exponents[:, v], :, v].T
+            final[start : start + chunk_size, :N_OUTPUTS] = (
+                monomials @ self.coefficients
+            )
+        return final
+
+    def save(self, path: Path) -> None:
+        np.savez_compressed(
+            path,
+            coefficients=self.coefficients,
+            exponents=self.exponents,
+            endpoint=self.endpoint,
+            lens_table=json.dumps(self.lens_table),
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "TransferMap":
+        with np.load(path) as data:
+            return cls(
+                data["coefficients"],
+                data["exponents"],
+                str(data["endpoint"]),
+                json.loads(str(data["lens_table"])),
+            )
+
+
+def ray_grid(
+    spot_size: float,
+    acceptance_angle: float,
+    n_spots: int = 3,
+    n_angs: int = 10,
+    delta: float = 0,
+) -> np.ndarray:
+    """
+    Rays on a spot x angle grid in the x-a plane, symmetric about the axis, in COSY's
+    coordinates. `spot_size` is in the length units of the map and `acceptance_angle`
+    is the full angle in degrees.
+    """
+    spots = np.linspace(-spot_size / 2, spot_size / 2, n_spots)
+    angles = np.radians(
+        np.linspace(-acceptance_angle / 2, acceptance_angle / 2, n_angs)
+    )
+    x, angle = np.meshgrid(spots, angles, indexing="ij")
+    rays = np.zeros((x.size, len(COORDINATES)))
+    rays[:, 0] = x.ravel()
+    rays[:, 1] = np.sin(angle.ravel())
+    rays[:, 5] = delta
+    return rays
+
+
+def aperture_rays(
+    spot_size: float, acceptance_angle: float, n_spots: int = 2, n_angs: int = 10
+) -> np.ndarray:
+    """
+    The rays of ClearApertureObj, see `clear_aperture_objective_function`: spots from
+    the axis to half of `spot_size`, and angles with sines of the `n_angs` steps up to
+    half of `acceptance_angle` (degrees), leaving out 0.
+    """
+    spots = np.arange(n_spots) / max(n_spots - 1, 1) * spot_size / 2
+    angles = np.radians(np.arange(1, n_angs + 1) / n_angs * acceptance_angle / 2)
+    x, angle = np.meshgrid(spots, angles, indexing="ij")
+    rays = np.zeros((x.size, len(COORDINATES)))
+    rays[:, 0] = x.ravel()
+    rays[:, 1] = np.sin(angle.ravel())
+    return rays
+
+
+def clear_aperture(
+    transfer_map: TransferMap, rays: np.ndarray, aperture_d: float
+) -> float:
+    """
+    Sum of how far the rays land outside an aperture. With the rays of `aperture_rays`
+    for the same spot size, angle and sampling this is what ClearApertureObj returns,
+    up to the truncation of the map.
+    """
+    x = transfer_map(rays)[:, 0]
+    return float(np.maximum(np.abs(x) - aperture_d / 2, 0).sum())
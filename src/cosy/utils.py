@@ -78,10 +78,10 @@ def create_file_from_template(
         f.writelines(new_lines)
 
 
-def process_file(process_id: int, file: Path) -> Path:
-    """Append the `process_id` to the `file` and return the full `Path`."""
+def process_file(process_id: int, file: Path, root: Path = FOX_DIR) -> Path:
+    """Append the `process_id` to the `file` and return the full `Path` in `root`."""
     split_name = file.name.split(".")
-    return FOX_DIR / f"{split_name[0]}_{process_id}.{split_name[1]}"
+    return root / f"{split_name[0]}_{process_id}.{split_name[1]}"
 
 
 def lis_purge(folder: Path = FOX_DIR) -> None:
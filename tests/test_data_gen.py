@@ -0,0 +1,47 @@
+import random
+
+import numpy as np
+
+from cosy import data_gen
+from cosy.constants import FOX_DIR, Electrode
+from cosy.data_gen import DataGenerator
+from cosy.surrogate import EnsembleSurrogate
+
+LENS_LIMITS = {
+    Electrode.V00: (0, 600),
+    Electrode.V01: (0, 600),
+    Electrode.V11: (0, 600),
+}
+
+
+def test_active_rounds_never_repeat_a_lens_table(tmp_path, monkeypatch):
+    rows = [np.empty((0, 4))]
+    simulated = []
+
+    def parallel_data_gen(self, filename, n_processes, **kwargs):
+        lens_tables = self.sampler.lens_tables
+        simulated.append(lens_tables)
+        outputs = np.sin(lens_tables / 100).sum(axis=1, keepdims=True)
+        rows.append(np.hstack([lens_tables, outputs]))
+        return {"interrupted": False}
+
+    monkeypatch.setattr(DataGenerator, "parallel_data_gen", parallel_data_gen)
+    monkeypatch.setattr(
+        data_gen, "read_model_data", lambda *args: np.concatenate(rows)
+    )
+    # the seeds of the samplers, with which exploring and exploiting once picked the
+    # same candidate
+    random.seed(18)
+    generator = DataGenerator(LENS_LIMITS, FOX_DIR, tmp_path)
+
+    generator.active_data_gen(
+        "active",
+        n_rounds=4,
+        round_size=32,
+        objective=lambda outputs: -outputs[:, 0],
+        surrogate=EnsembleSurrogate(LENS_LIMITS, seed=18),
+    )
+
+    lens_tables = np.concatenate(simulated)
+    assert len(lens_tables) == 4 * 32
+    assert len(np.unique(lens_tables, axis=0)) == len(lens_tables)
@@ -0,0 +1,25 @@
+from cosy.model import GEOMETRY_FILES, MODEL_FILES, ModelCache
+
+
+class KeyedCache(ModelCache):
+    """Takes the key itself in place of a lens."""
+
+    key = staticmethod(lambda lens: lens)
+
+
+def test_evicting_keeps_fetched_models(tmp_path):
+    source, destination = tmp_path / "source", tmp_path / "destination"
+    source.mkdir()
+    destination.mkdir()
+    for file in MODEL_FILES + GEOMETRY_FILES:
+        (source / file).write_text(file)
+    cache = KeyedCache(tmp_path / "cache", max_bytes=0)
+
+    cache.store("a", source)
+    assert cache.fetch("a", destination)
+    # storing another model evicts "a" while destination still uses it
+    cache.store("b", source)
+
+    assert [entry.name for entry in cache.entries()] == ["b"]
+    for file in MODEL_FILES + GEOMETRY_FILES:
+        assert (destination / file).read_text() == file
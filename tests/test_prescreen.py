@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from cosy.constants import FOX_DIR, Electrode
+from cosy.noise import VoltageNoise
+from cosy.objective import StandardObjectiveFunction
+from cosy.optimizer import SpeemOptimizer
+from cosy.prescreen import FailureClassifier, Prescreen
+from cosy.raytrace import FieldGrid
+
+LENS_LIMITS = {
+    Electrode.V00: (0, 600),
+    Electrode.V01: (0, 600),
+    Electrode.V11: (0, 600),
+}
+
+
+@pytest.fixture
+def flat_grid(monkeypatch):
+    """A field grid without any potential, so nothing reflects."""
+    z = np.linspace(0, 1, 11)
+    r = np.array([0.0, 1e-3])
+    grid = FieldGrid(z, r, np.array([0]), np.zeros((1, 3, len(z), len(r))), "")
+    monkeypatch.setattr(FieldGrid, "cached", classmethod(lambda cls, root: grid))
+
+
+@pytest.fixture
+def optimizer(flat_grid, monkeypatch):
+    def make(aggregate: str) -> SpeemOptimizer:
+        optimizer = SpeemOptimizer(
+            [StandardObjectiveFunction.CLEAR_APERTURE_0],
+            LENS_LIMITS,
+            fox_dir=FOX_DIR,
+            trace_file=None,
+            voltage_noise=VoltageNoise(sigma=1.0, n_samples=4, aggregate=aggregate),
+            prescreen=Prescreen(
+                {0: Electrode.V00},
+                kinetic_energy=5,
+                classifier=FailureClassifier(LENS_LIMITS),
+            ),
+        )
+        optimizer.default_lens_table = {name: 100.0 for name in LENS_LIMITS}
+        return optimizer
+
+    def evaluate(self, lens_tables, template_lines, n_values, fill_value, n_processes):
+        # the first perturbation of every point makes COSY fail
+        objectives = np.full((len(lens_tables), 1), 10.0)
+        objectives[::4] = 1e9
+        return objectives
+
+    monkeypatch.setattr(SpeemOptimizer, "_evaluate_lens_tables", evaluate)
+    return make
+
+
+@pytest.mark.parametrize("aggregate", ["mean", "max"])
+def test_noise_labels_each_perturbation(optimizer, aggregate):
+    optimizer = optimizer(aggregate)
+    points = np.array([[100.0, 200.0, 300.0], [400.0, 500.0, 50.0]])
+
+    optimizer.batch_objective(points)
+
+    lens_tables, failed = optimizer.prescreen.observed()
+    assert len(lens_tables) == 8
+    assert failed.tolist() == [True, False, False, False] * 2
+    # the perturbed lens tables are learned, not the nominal ones
+    assert not np.isin(lens_tables, points).all(axis=1).any()
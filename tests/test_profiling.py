@@ -0,0 +1,26 @@
+from cosy.profiling import EvaluationProfiler, read_trace
+
+
+def test_every_run_traces_to_its_own_file(tmp_path):
+    first, second = EvaluationProfiler(tmp_path), EvaluationProfiler(tmp_path)
+    for profiler in (first, second, first):
+        profiler.begin()
+        with profiler.stage("compute"):
+            pass
+        profiler.end()
+
+    assert first.trace_file == tmp_path / f"{first.run_id}.jsonl"
+    assert sorted(tmp_path.iterdir()) == sorted([first.trace_file, second.trace_file])
+    assert len(read_trace(first.trace_file)) == 2
+    assert [entry["run"] for entry in read_trace(second.trace_file)] == [
+        second.run_id
+    ]
+
+
+def test_a_trace_file_is_kept(tmp_path):
+    trace_file = tmp_path / "trace.jsonl"
+    profiler = EvaluationProfiler(trace_file)
+    profiler.record("queue", delay=0.0)
+
+    assert profiler.trace_file == trace_file
+    assert read_trace(trace_file, run=profiler.run_id)[0]["event"] == "queue"